@@ -14,59 +14,153 @@
 #  DB 12   ; a decimal byte
 #  DB 0b0001 ; a binary byte
 
+import argparse
+import glob
+import os
 import sys
 import re
+from concurrent.futures import ProcessPoolExecutor
+
+# The binary image format and instruction set live with the emulator
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'ls8'))
+import image
+import opcodes
+import symbols
+
+# Bumped whenever the same source could assemble differently, cached
+# images are keyed on it
+ASM_VERSION = 2
+
+# Mnemonic -> (opcode, operand type), from the instruction set the emulator
+# runs
+INSTRUCTIONS = {
+    name: (opcode, op_type) for name, opcode, op_type in opcodes.INSTRUCTIONS
+}
+
+# Register operands
+REGISTERS = {f"R{i}": i for i in range(8)}
 
-# Opcodes
-OPCODES = {
-    "ADD":  {"type": 2, "code": "10100000"},
-    "AND":  {"type": 2, "code": "10101000"},
-    "CALL": {"type": 1, "code": "01010000"},
-    "CMP":  {"type": 2, "code": "10100111"},
-    "DEC":  {"type": 1, "code": "01100110"},
-    "DIV":  {"type": 2, "code": "10100011"},
-    "HLT":  {"type": 0, "code": "00000001"},
-    "INC":  {"type": 1, "code": "01100101"},
-    "INT":  {"type": 1, "code": "01010010"},
-    "IRET": {"type": 0, "code": "00010011"},
-    "JEQ":  {"type": 1, "code": "01010101"},
-    "JGE":  {"type": 1, "code": "01011010"},
-    "JGT":  {"type": 1, "code": "01010111"},
-    "JLE":  {"type": 1, "code": "01011001"},
-    "JLT":  {"type": 1, "code": "01011000"},
-    "JMP":  {"type": 1, "code": "01010100"},
-    "JNE":  {"type": 1, "code": "01010110"},
-    "LD":   {"type": 2, "code": "10000011"},
-    "LDI":  {"type": 8, "code": "10000010"},
-    "MOD":  {"type": 2, "code": "10100100"},
-    "MUL":  {"type": 2, "code": "10100010"},
-    "NOP":  {"type": 0, "code": "00000000"},
-    "NOT":  {"type": 1, "code": "01101001"},
-    "OR":   {"type": 2, "code": "10101010"},
-    "POP":  {"type": 1, "code": "01000110"},
-    "PRA":  {"type": 1, "code": "01001000"},
-    "PRN":  {"type": 1, "code": "01000111"},
-    "PUSH": {"type": 1, "code": "01000101"},
-    "RET":  {"type": 0, "code": "00010001"},
-    "SHL":  {"type": 2, "code": "10101100"},
-    "SHR":  {"type": 2, "code": "10101101"},
-    "ST":   {"type": 2, "code": "10000100"},
-    "SUB":  {"type": 2, "code": "10100001"},
-    "XOR":  {"type": 2, "code": "10101011"},
+# Register operands each operand type takes
+OPERAND_COUNTS = {
+    opcodes.NO_OPERANDS: 0,
+    opcodes.REGISTER: 1,
+    opcodes.TWO_REGISTERS: 2,
+    opcodes.IMMEDIATE: 2,
 }
 
 # Regex for matching lines
 # Capturing groups: label, opcode, operandA, operandB
-REGEX = r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?"
+REGEX = re.compile(r"(?:(\w+?):)?\s*(?:(\w+)\s*(?:(\w+)(?:\s*,\s*(\w+))?)?)?")
 
 # Regex for capturing DS and DB data
-REGEX_DS = r"(?:(\w+?):)?\s*DS\s*(.+)"  # insensitive
-REGEX_DB = r"(?:(\w+?):)?\s*DB\s*(.+)"  # insensitive
+REGEX_DS = re.compile(r"(?:(\w+?):)?\s*DS\s*(.+)", re.IGNORECASE)
+REGEX_DB = re.compile(r"(?:(\w+?):)?\s*DB\s*(.+)", re.IGNORECASE)
+
+
+# Preprocessor directives, see Preprocessor
+REGEX_INCLUDE = re.compile(r'\.include\s+"([^"]+)"\s*$', re.IGNORECASE)
+REGEX_MACRO = re.compile(r"\.macro\s+(\w+)\s*(.*)$", re.IGNORECASE)
+REGEX_ENDM = re.compile(r"\.endm\s*$", re.IGNORECASE)
+REGEX_CALL = re.compile(r"(?:(\w+?):)?\s*(\w+)\s*(.*)$")
+REGEX_PARAM = re.compile(r"\\(\w+|@)")
+
+# Deepest nesting of includes and macro expansions
+MAX_DEPTH = 64
+
+
+class AsmError(Exception):
+    """Raised for source that can't be assembled."""
+
+    def __init__(self, message, line_num=None, filename=None):
+        self.message = message
+        self.line_num = line_num
+        self.filename = filename
+        if line_num is not None:
+            message = f"line {line_num}: {message}"
+        if filename is not None:
+            message = f"{filename} {message}"
+        super().__init__(message)
+
+
+class Program:
+    """
+    The result of assembling a source: machine code, the symbol table and,
+    when asked for, the comments of the text listing.
+    """
+
+    def __init__(self):
+        self.code = bytearray()
+        # Label -> address
+        self.symbols = {}
+        # Address -> comment shown on that byte in the text listing
+        self.comments = {}
+        # (address, label) in source order, for the text listing
+        self.labels = []
+        # (code offset, label, line number) of operands naming a label
+        self.fixups = []
+        # (address, size, is_instruction) of every statement in order, when
+        # asked for
+        self.items = []
+        # (address, line number) of every statement in order, when asked
+        # for, for the debug map
+        self.lines = []
+
+    def backpatch(self):
+        """
+        Fill in the label operands now every label is known
+        """
+        code = self.code
+        sym = self.symbols
+        for offset, label, line_num in self.fixups:
+            addr = sym.get(label)
+            if addr is None:
+                raise AsmError(f"unknown symbol: {label}", line_num)
+            code[offset] = addr & 0xFF
+
+    def image(self):
+        """
+        Return the program as a binary image
+        """
+        return image.pack(self.code, symbols=self.symbols)
+
+    def text(self):
+        """
+        Return the program as a .ls8 text listing, one byte per line
+        """
+        comments = self.comments
+        labels = self.labels
+        next_label = 0
+        lines = []
+
+        for addr, byte in enumerate(self.code):
+            while next_label < len(labels) and labels[next_label][0] <= addr:
+                label_addr, label = labels[next_label]
+                lines.append(f"# {label} (address {label_addr}):")
+                next_label += 1
+
+            comment = comments.get(addr)
+            if comment is None:
+                lines.append(f"{byte:08b}")
+            else:
+                lines.append(f"{byte:08b} # {comment}")
+
+        # Labels at the very end
+        for addr, label in labels[next_label:]:
+            lines.append(f"# {label} (address {addr}):")
+
+        return "\n".join(lines) + "\n" if lines else ""
 
 
 def parse_commandline(argv):
     """
-    Usage: asm.py [inputfile] [outputfile]
+    Usage: asm.py [-O] [-g] [inputfile] [outputfile]
+           asm.py --batch ... (see batch_main)
+
+    An outputfile ending in .ls8b gets a binary image instead of text. -O
+    runs the peephole optimizer (see optimize.py). -g also writes a debug
+    map of labels and source lines next to outputfile (see
+    ls8/symbols.py).
     """
 
     if len(argv) == 1:
@@ -82,13 +176,13 @@ def parse_commandline(argv):
         outputfile = argv[2]
 
     else:
-        print("usage: asm.py [infile.asm] [outfile.ls8]", file=sys.stderr)
+        print("usage: asm.py [-O] [-g] [infile.asm] [outfile.ls8]", file=sys.stderr)
         sys.exit(1)
 
     return inputfile, outputfile
 
 
-def open_files(inputfile, outputfile):
+def open_files(inputfile, outputfile, binary=False):
     """
     Open files for reading and writing. If either of the files are named "-",
     stdin or stdout is returned as appropriate.
@@ -100,303 +194,585 @@ def open_files(inputfile, outputfile):
         inputfile = open(inputfile)
 
     if outputfile == "-":
-        outputfile = sys.stdout
+        outputfile = sys.stdout.buffer if binary else sys.stdout
     else:
-        outputfile = open(outputfile, "w")
+        outputfile = open(outputfile, "wb" if binary else "w")
 
     return inputfile, outputfile
 
 
-def normalize_line(groups):
+class Macro:
     """
-    Takes match groups and uppercases them if they're not None.
+    A macro defined with .macro, its body lines are kept with where they
+    came from
     """
 
-    result = []
-
-    for g in groups:
-        if g is None:
-            result.append(None)
-        else:
-            result.append(g.upper())
-
-    return result
-
-
-def p8(v):
-    return "{:08b}".format(v)
+    def __init__(self, name, params, origin):
+        self.name = name
+        self.params = params
+        self.origin = origin
+        self.body = []
 
 
-def pass1(inputfile, sym, code):
+class Preprocessor:
     """
-    Pass 1
+    Expands .include directives and macros into plain source lines
 
-    * Read the source code lines
-    * Parse labels, opcodes, and operands
-    * Record label offsets
-    * Emit machine code
-    """
-
-    # Source line number
-    line_num = 0
-
-    # Current code address (for labels)
-    addr = 0
+        .include "lib/print.asm"   ; relative to the including file
 
-    def get_reg(op, fatal=True):
-        """Get a register number from a string, e.g. "R2" -> 2"""
-
-        nonlocal line_num
+        .macro PRINTNUM reg, value
+            LDI \\reg,\\value
+            PRN \\reg
+        .endm
 
-        m = re.match(r"R([0-7])", op)
-
-        if m is None:
-            if fatal:
-                print(f"Line {line_num}: unknown register {op}",
-                      file=sys.stderr)
-                sys.exit(1)
-            else:
-                return None
+        PRINTNUM R0, 12
 
-        return int(m.group(1))
+    In a macro body \\name is replaced by the argument for parameter name
+    and \\@ by a number unique to each expansion, for labels local to it.
+    label_prefix goes in front of that number, so objects built separately
+    don't clash when linked.
 
-    def out0(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with zero operands"""
-
-        nonlocal addr
+    expand() returns the lines, origins holds the (filename, line number)
+    each one came from and dependencies every file read.
+    """
 
-        code.append(f"{machine_code} # {opcode}")
-        addr += 1
+    def __init__(self, include_path=(), label_prefix=""):
+        self.include_path = list(include_path)
+        self.label_prefix = label_prefix
+        # Name -> Macro
+        self.macros = {}
+        # Expansions so far, for \\@
+        self.expansions = 0
+        self.lines = []
+        self.origins = []
+        self.dependencies = []
+
+    def expand(self, inputfile, filename="-"):
+        """
+        Expand the source lines of inputfile, named filename, returns the
+        expanded lines
+        """
 
-    def out1(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with one operand"""
+        stack = [os.path.abspath(filename)] if filename != "-" else []
+        self.feed(inputfile, filename, stack)
+        return self.lines
 
-        nonlocal addr
+    def expand_file(self, filename):
+        with open(filename) as f:
+            self.dependencies.append(os.path.abspath(filename))
+            return self.expand(f, filename)
 
-        reg_a = get_reg(op_a)
-        code.append(f"{machine_code} # {opcode} {op_a}")
-        code.append(p8(reg_a))
-        addr += 2
+    def find(self, name, including):
+        """
+        Return the path of an included file
+        """
 
-    def out2(opcode, op_a, op_b, machine_code):
-        """Handle opcodes with two operands"""
+        directory = os.path.dirname(including) if including != "-" else ""
+        for base in [directory] + self.include_path:
+            path = os.path.join(base, name)
+            if os.path.exists(path):
+                return path
+        return None
 
-        nonlocal addr
+    def feed(self, inputfile, filename, stack):
+        """
+        Expand the lines of one file, stack holds the files including it
+        """
 
-        reg_a = get_reg(op_a)
-        reg_b = get_reg(op_b)
+        if len(stack) > MAX_DEPTH:
+            raise AsmError("includes nested too deeply", None, filename)
+        macro = None
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(p8(reg_b))
+        for line_num, line in enumerate(inputfile, 1):
+            origin = (filename, line_num)
+            code = line.split(";", 1)[0].strip()
 
-        addr += 3
+            if macro is not None:
+                # Inside a definition, keep everything up to .endm
+                if REGEX_ENDM.match(code):
+                    self.macros[macro.name] = macro
+                    macro = None
+                else:
+                    macro.body.append((line, origin))
+                continue
+
+            if not code.startswith("."):
+                self.line(line, code, origin, 0)
+                continue
+
+            m = REGEX_MACRO.match(code)
+            if m is not None:
+                params = [p.strip().upper() for p in m.group(2).split(",")
+                          if p.strip()]
+                macro = Macro(m.group(1).upper(), params, origin)
+                continue
+
+            m = REGEX_INCLUDE.match(code)
+            if m is None:
+                raise AsmError(f"unknown directive {code.split()[0]}",
+                               line_num, filename)
+            path = self.find(m.group(1), filename)
+            if path is None:
+                raise AsmError(f"can't find include {m.group(1)}",
+                               line_num, filename)
+            path = os.path.abspath(path)
+            if path in stack:
+                raise AsmError(f"{m.group(1)} includes itself",
+                               line_num, filename)
+            self.dependencies.append(path)
+            with open(path) as f:
+                self.feed(f, path, stack + [path])
+
+        if macro is not None:
+            filename, line_num = macro.origin
+            raise AsmError(f"missing .endm for {macro.name}", line_num, filename)
+
+    def line(self, line, code, origin, depth):
+        """
+        Emit one source line, expanding it if it uses a macro
+        """
 
-    def out8(opcode, op_a, op_b, machine_code):
-        """Handle LDI opcode (type 8)"""
+        m = REGEX_CALL.match(code) if self.macros else None
+        if m is None or m.group(2).upper() not in self.macros:
+            self.lines.append(line)
+            self.origins.append(origin)
+            return
+
+        if depth > MAX_DEPTH:
+            raise AsmError("macros nested too deeply", origin[1], origin[0])
+        label, name, rest = m.groups()
+        macro = self.macros[name.upper()]
+        args = [a.strip() for a in rest.split(",")] if rest.strip() else []
+        if len(args) != len(macro.params):
+            raise AsmError(f"{macro.name} takes {len(macro.params)} "
+                           f"arguments, got {len(args)}", origin[1], origin[0])
+        values = dict(zip(macro.params, args))
+        self.expansions += 1
+        unique = f"{self.label_prefix}{self.expansions}"
+
+        def substitute(m):
+            param = m.group(1).upper()
+            if param == "@":
+                return unique
+            if param not in values:
+                raise AsmError(f"{macro.name} has no parameter {param}",
+                               origin[1], origin[0])
+            return values[param]
+
+        if label is not None:
+            self.lines.append(f"{label}:")
+            self.origins.append(origin)
+        for body_line, body_origin in macro.body:
+            body_line = REGEX_PARAM.sub(substitute, body_line)
+            body_code = body_line.split(";", 1)[0].strip()
+            self.line(body_line, body_code, body_origin, depth + 1)
+
+
+def parse(inputfile, listing=False, items=False, resolve=True, debug=False):
+    """
+    Assemble the source lines of inputfile in a single pass
 
-        nonlocal addr
+    * Parse labels, opcodes, and operands
+    * Record label addresses
+    * Emit machine code, leaving a fixup for each label operand
+    * Patch the fixups once every label is known
 
-        reg_a = get_reg(op_a)
+    With listing, the comments of the text listing are recorded too, and
+    with items the address and size of every instruction and piece of data,
+    for optimize.py. Without resolve label operands are left as fixups,
+    for the linker in build.py. With debug the line number of every
+    statement is kept for the debug map.
 
-        try:
-            val_b = int(op_b, 0)
-            out_b = p8(val_b)
+    Returns a Program, raises AsmError.
+    """
 
-        except ValueError:
-            # If it's not a value, it might be a symbol
-            out_b = f"sym:{op_b}"
+    program = Program()
+    code = program.code
+    sym = program.symbols
+    comments = program.comments
+    labels = program.labels
+    fixups = program.fixups
+    record = program.items.append if items else None
+    record_line = program.lines.append if debug else None
+
+    match_line = REGEX.match
+    instructions = INSTRUCTIONS
+    registers = REGISTERS
+    operand_counts = OPERAND_COUNTS
+    immediate = opcodes.IMMEDIATE
+
+    def get_reg(op):
+        """Get a register number from a string, e.g. "R2" -> 2"""
 
-        code.append(f"{machine_code} # {opcode} {op_a},{op_b}")
-        code.append(p8(reg_a))
-        code.append(out_b)
+        reg = registers.get(op)
+        if reg is None:
+            raise AsmError(f"unknown register {op}", line_num)
+        return reg
 
-        addr += 3
+    for line_num, line in enumerate(inputfile, 1):
+        # Strip comments
+        comment_index = line.find(';')
+        if comment_index != -1:
+            line = line[:comment_index]
 
-    def handle_ds(line):
-        """
-        Handle DS pseudo-opcode
-        """
+        # Normalize
+        line = line.strip()
 
-        nonlocal addr
+        # Ignore blank lines
+        if not line:
+            continue
 
-        m = re.match(REGEX_DS, line, re.IGNORECASE)
+        label, opcode, op_a, op_b = match_line(line).groups()
 
-        if m is None or m.group(2) is None:
-            print(f"line {line_num}: missing argument to DS", file=sys.stderr)
-            sys.exit(2)
+        # Track label address
+        if label is not None:
+            label = label.upper()
+            sym[label] = len(code)
+            if listing:
+                labels.append((len(code), label))
 
-        data = m.group(2)
+        if opcode is None:
+            continue
+        opcode = opcode.upper()
+
+        if opcode == "DS":
+            m = REGEX_DS.match(line)
+            if m is None:
+                raise AsmError("missing argument to DS", line_num)
+            data = m.group(2)
+            try:
+                encoded = data.encode("latin-1")
+            except UnicodeEncodeError:
+                raise AsmError("DS string has characters outside Latin-1",
+                               line_num)
+            if listing:
+                for i, char in enumerate(data):
+                    comments[len(code) + i] = "[space]" if char == " " else char
+            if record:
+                record((len(code), len(data), False))
+            if record_line:
+                record_line((len(code), line_num))
+            code += encoded
+            continue
 
-        for i in range(len(data)):
-            print_char = data[i]
+        if opcode == "DB":
+            m = REGEX_DB.match(line)
+            if m is None:
+                raise AsmError("missing argument to DB", line_num)
+            data = m.group(2)
+            try:
+                val = int(data, 0)
+            except ValueError:
+                raise AsmError("invalid integer argument to DB", line_num)
+            if listing:
+                comments[len(code)] = data
+            if record:
+                record((len(code), 1, False))
+            if record_line:
+                record_line((len(code), line_num))
+            # Force to byte size
+            code.append(val & 0xFF)
+            continue
 
-            if print_char == ' ':
-                print_char = '[space]'
+        # Make sure we know this opcode at all
+        info = instructions.get(opcode)
+        if info is None:
+            raise AsmError(f"unknown opcode {opcode}", line_num)
+        machine_code, op_type = info
+
+        # Make sure we have right operand count
+        found = (op_a is not None) + (op_b is not None)
+        desired = operand_counts[op_type]
+        if found < desired:
+            raise AsmError(f"missing operand to {opcode}", line_num)
+        elif found > desired:
+            raise AsmError(f"unexpected operand to {opcode}", line_num)
 
-            code.append(f"{p8(ord(data[i]))} # {print_char}")
+        if op_a is not None:
+            op_a = op_a.upper()
+        if op_b is not None:
+            op_b = op_b.upper()
 
-        addr += len(data)
+        if listing:
+            if op_b is not None:
+                comments[len(code)] = f"{opcode} {op_a},{op_b}"
+            elif op_a is not None:
+                comments[len(code)] = f"{opcode} {op_a}"
+            else:
+                comments[len(code)] = opcode
+        if record:
+            record((len(code), desired + 1, True))
+        if record_line:
+            record_line((len(code), line_num))
+
+        code.append(machine_code)
+        if op_type == immediate:
+            code.append(get_reg(op_a))
+            try:
+                val = int(op_b, 0)
+            except ValueError:
+                # If it's not a value, it's a label, patched in below
+                fixups.append((len(code), op_b, line_num))
+                val = 0
+            code.append(val & 0xFF)
+        elif desired:
+            code.append(get_reg(op_a))
+            if desired == 2:
+                code.append(get_reg(op_b))
+
+    if resolve:
+        program.backpatch()
+    return program
+
+
+def assemble_file(filename, listing=False, items=False, resolve=True,
+                  preprocessor=None, debug=False):
+    """
+    Preprocess and assemble a source file, errors name the file and line
+    the offending source came from. Returns a Program.
+    """
 
-    def handle_db(line):
-        """
-        Handle the DB pseudo-opcode
-        """
+    if preprocessor is None:
+        preprocessor = Preprocessor()
+    lines = preprocessor.expand_file(filename)
+    program = parse_expanded(preprocessor, lines, listing, items, resolve,
+                             debug)
+    if debug:
+        source_lines(program, preprocessor)
+    return program
 
-        nonlocal addr
 
-        m = re.match(REGEX_DB, line, re.IGNORECASE)
+def parse_expanded(preprocessor, lines, listing=False, items=False,
+                   resolve=True, debug=False):
+    """
+    Parse lines expanded by preprocessor, mapping errors back to the
+    source they came from
+    """
 
-        if m is None or m.group(2) is None:
-            print(f"line {line}: missing argument to DB", file=sys.stderr)
-            sys.exit(2)
+    try:
+        return parse(lines, listing, items, resolve, debug)
+    except AsmError as e:
+        if e.line_num is None or e.filename is not None:
+            raise
+        filename, line_num = preprocessor.origins[e.line_num - 1]
+        raise AsmError(e.message, line_num, filename) from None
 
-        data = m.group(2)
 
-        try:
-            val = int(data, 0)
+def source_lines(program, preprocessor):
+    """
+    Turn the line numbers of program.lines, counted in the expanded
+    source, into (address, filename, line number) in the original files
+    """
 
-        except ValueError:
-            print(f"line {line_num}: invalid integer argument to DB",
-                  file=sys.stderr)
-            sys.exit(2)
+    origins = preprocessor.origins
+    program.lines = [(addr,) + tuple(origins[line_num - 1])
+                     for addr, line_num in program.lines]
 
-        # Force to byte size
-        val &= 0xff
 
-        code.append(f"{p8(val)} # {data}")
+def debug_map(program):
+    """
+    Return the symbols.SymbolMap of a Program assembled with debug=True
+    """
 
-        addr += 1
+    return symbols.SymbolMap(program.symbols, program.lines,
+                             max(len(program.code), 256))
 
-    def check_ops(opcode, op_a, op_b):
-        """Check operands for sanity with a particular opcode"""
 
-        def check_ops_count(desired, found):
-            # Makes sure we have right operand count
-            if found < desired:
-                print(f"Line {line_num}: missing operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
-            elif found > desired:
-                print(f"Line {line_num}: unexpected operand to {opcode}",
-                      file=sys.stderr)
-                sys.exit(1)
+def write_debug_map(program, outputfile):
+    """
+    Write the debug map of a Program next to outputfile
+    """
 
-        # Make sure we know this opcode at all
-        if opcode not in OPCODES:
-            print(f"line {line_num}: unknown opcode {opcode}", file=sys.stderr)
-            sys.exit(2)
+    symbols.write_map(symbols.map_path(outputfile), debug_map(program),
+                      program.code)
 
-        op_type = OPCODES[opcode]["type"]
 
-        total_operands = 0
+def assemble(inputfile):
+    """
+    Assemble the source open in inputfile, returns a binary image.
+    """
 
-        if op_a is not None:
-            total_operands += 1
+    return parse(inputfile).image()
 
-        if op_b is not None:
-            total_operands += 1
 
-        if op_type == 0 or op_type == 1 or op_type == 2:
-            # 0, 1, or 2 register operands
-            check_ops_count(op_type, total_operands)
+def batch_sources(patterns):
+    """
+    Expand directories (every .asm in them) and globs into a sorted list of
+    source files, without duplicates
+    """
 
-        elif op_type == 8:
-            # LDI r,i or LDI r,label
-            check_ops_count(2, total_operands)
+    sources = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            sources.update(glob.glob(os.path.join(pattern, "*.asm")))
+        elif glob.has_magic(pattern):
+            sources.update(glob.glob(pattern, recursive=True))
+        else:
+            sources.add(pattern)
+    return sorted(sources)
 
-    # Type to function mapping
-    type_f = {
-        0: out0,
-        1: out1,
-        2: out2,
-        8: out8,
-    }
 
-    for line in inputfile:
-        line_num += 1
+def batch_output(source, output_dir, binary):
+    """
+    Return the output file for a source: same name with .ls8 or .ls8b, in
+    output_dir or next to the source
+    """
 
-        # Strip comments
-        comment_index = line.find(';')
-        if comment_index != -1:
-            line = line[:comment_index]
+    name = os.path.splitext(source)[0] + (".ls8b" if binary else ".ls8")
+    if output_dir is not None:
+        name = os.path.join(output_dir, os.path.basename(name))
+    return name
 
-        # Normalize
-        line = line.strip()
 
-        # Ignore blank lines
-        if input == '':
-            continue
+def assemble_job(job):
+    """
+    Assemble one source in a worker, returns (source, output, error) with
+    error None on success
+    """
 
-        # print(line)  # debug
+    source, output, binary, optimizing, debug = job
+    try:
+        program = assemble_file(source, listing=not binary, items=optimizing,
+                                debug=debug)
+        if optimizing:
+            import optimize
+            program, _ = optimize.optimize(program)
+        data = program.image() if binary else program.text().encode()
+        # Write then rename so a failed run never leaves half a file
+        temp = f"{output}.{os.getpid()}.tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, output)
+        if debug:
+            write_debug_map(program, output)
+    except AsmError as e:
+        # Already names the file and line
+        return source, output, str(e)
+    except Exception as e:
+        # Anything else still only fails this source
+        return source, output, f"{source}: {type(e).__name__}: {e}"
+    return source, output, None
+
+
+def assemble_batch(sources, output_dir=None, binary=False, optimizing=False,
+                   workers=None, debug=False):
+    """
+    Assemble every source over a process pool, returns a list of
+    (source, output, error) in source order. A bad source only fails
+    itself.
+    """
 
-        m = re.match(REGEX, line)
+    jobs = [(source, batch_output(source, output_dir, binary), binary,
+             optimizing, debug) for source in sources]
 
-        if m is not None:
-            label, opcode, op_a, op_b = normalize_line(m.groups())
+    # Sources in different directories can't share an output
+    outputs = {}
+    for source, output, _, _, _ in jobs:
+        outputs.setdefault(output, []).append(source)
+    clashes = {output for output, names in outputs.items() if len(names) > 1}
 
-            # print(label, opcode, op_a, op_b)  # debug
+    results = [(source, output, f"{source}: output {output} also written by "
+                f"{', '.join(s for s in outputs[output] if s != source)}")
+               for source, output, _, _, _ in jobs if output in clashes]
+    jobs = [job for job in jobs if job[1] not in clashes]
 
-            # Track label address
-            if label is not None:
-                sym[label] = addr
-                # print(f"Label {label}: {addr}")  # debug
-                code.append(f'# {label} (address {addr}):')
+    workers = workers or os.cpu_count() or 1
+    # Bigger chunks keep the pickling overhead down on long job lists
+    chunksize = max(1, len(jobs) // (4 * workers))
 
-            if opcode is not None:
-                if opcode == 'DS':
-                    handle_ds(line)
-                elif opcode == 'DB':
-                    handle_db(line)
-                else:
-                    # Check operand count
-                    check_ops(opcode, op_a, op_b)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results += pool.map(assemble_job, jobs, chunksize=chunksize)
 
-                    # Handle opcodes
-                    op_info = OPCODES[opcode]
-                    handler = type_f[op_info["type"]]
-                    handler(opcode, op_a, op_b, op_info["code"])
-        else:
-            print(f"No match: {input}", file=sys.stderr)
-            sys.exit(3)
+    order = {source: i for i, source in enumerate(sources)}
+    return sorted(results, key=lambda result: order[result[0]])
 
 
-def pass2(outputfile, sym, code):
+def batch_main(argv):
     """
-    Output the code, substituting in any symbols.
-    """
-
-    for c in code:
-        # Replace symbols
-        if c[:4] == 'sym:':
-            s = c[4:].strip()
-
-            if s in sym:
-                c = p8(sym[s])
+    Usage: asm.py --batch [-O] [-g] [--binary] [-j N] [-o DIR] source...
 
-            else:
-                print(f"unknown symbol: {s}", file=sys.stderr)
-                sys.exit(2)
+    Each source is a file, a directory (every .asm in it) or a glob.
+    Outputs go next to their sources unless -o is given. Errors are
+    reported per file, the exit status is 1 if any file failed.
+    """
 
-        outputfile.write(f"{c}\n")
+    parser = argparse.ArgumentParser(
+        prog="asm.py --batch",
+        description="Assemble many LS-8 sources in parallel.")
+    parser.add_argument("sources", nargs="+",
+                        help="source files, directories or globs")
+    parser.add_argument("-o", "--output-dir", help="write the outputs here")
+    parser.add_argument("--binary", action="store_true",
+                        help="write .ls8b images instead of .ls8 text")
+    parser.add_argument("-O", dest="optimizing", action="store_true",
+                        help="run the peephole optimizer")
+    parser.add_argument("-g", dest="debug", action="store_true",
+                        help="write a debug map next to each output")
+    parser.add_argument("-j", "--workers", type=int, help="worker processes")
+    args = parser.parse_args(argv)
+
+    sources = batch_sources(args.sources)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    results = assemble_batch(sources, args.output_dir, args.binary,
+                             args.optimizing, args.workers, args.debug)
+
+    errors = 0
+    for source, output, error in results:
+        if error is not None:
+            errors += 1
+            print(error, file=sys.stderr)
+
+    print(f"{len(results)} files, {len(results) - errors} ok, {errors} errors",
+          file=sys.stderr)
+    return 1 if errors else 0
 
 
 def main(argv):
+    if "--batch" in argv:
+        return batch_main([arg for arg in argv[1:] if arg != "--batch"])
+
     # Parse command line
+    optimizing = "-O" in argv
+    debug = "-g" in argv
+    argv = [arg for arg in argv if arg not in ("-O", "-g")]
     inputfile, outputfile = parse_commandline(argv)
+    binary = outputfile.endswith(".ls8b")
+    if debug and outputfile == "-":
+        print("asm.py: -g needs an output file, the map goes next to it",
+              file=sys.stderr)
+        return 1
+    map_file = outputfile
 
     # Open files
-    inputfile, outputfile = open_files(inputfile, outputfile)
-
-    # Set up the symbol table
-    sym = {}
-
-    # Set up the machine code output
-    code = []
+    inputfile, outputfile = open_files(inputfile, outputfile, binary)
 
     # Assemble
-    pass1(inputfile, sym, code)
-    pass2(outputfile, sym, code)
+    try:
+        preprocessor = Preprocessor()
+        lines = preprocessor.expand(inputfile, inputfile.name
+                                    if inputfile is not sys.stdin else "-")
+        program = parse_expanded(preprocessor, lines, listing=not binary,
+                                 items=optimizing, debug=debug)
+        if debug:
+            source_lines(program, preprocessor)
+    except AsmError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    if optimizing:
+        import optimize
+        program, report = optimize.optimize(program)
+        print(optimize.format_report(report), end="", file=sys.stderr)
+
+    if binary:
+        outputfile.write(program.image())
+    else:
+        outputfile.write(program.text())
+
+    if debug:
+        write_debug_map(program, map_file)
 
     return 0
 
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Incremental builds of LS-8 programs made of several source files
+#
+# Usage: build.py [--build-dir DIR] [-I DIR] [-g] output.ls8b unit.asm...
+#
+# Each unit is assembled on its own into an object (code, symbols and the
+# label operands still to fill in) kept in the build directory, along with
+# the content hash of every file it read, includes too. A unit is only
+# assembled again when one of those files changed. The objects are then
+# linked: laid out one after the other in the order given, with one symbol
+# table across all of them, and every label operand patched. Execution
+# starts at the first unit.
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+from asm import (AsmError, ASM_VERSION, Preprocessor, Program, parse_expanded,
+                 source_lines, write_debug_map)
+
+# Where objects are kept by default
+BUILD_DIRECTORY = ".ls8build"
+
+# Bumped whenever the layout of objects changes
+OBJECT_FORMAT = 2
+
+
+def file_hash(path):
+    """
+    Return the SHA-256 of a file's contents
+    """
+
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def object_path(build_dir, unit):
+    """
+    Return the path of the object of a unit
+    """
+
+    name = hashlib.sha256(os.path.abspath(unit).encode()).hexdigest()[:16]
+    return os.path.join(build_dir, f"{os.path.basename(unit)}.{name}.json")
+
+
+def up_to_date(obj):
+    """
+    True if every file an object was built from is unchanged
+    """
+
+    if obj.get("version") != ASM_VERSION or obj.get("format") != OBJECT_FORMAT:
+        return False
+    for path, digest in obj["dependencies"].items():
+        try:
+            if file_hash(path) != digest:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def compile_unit(unit, include_path=()):
+    """
+    Assemble one unit into an object, a dict of plain data
+    """
+
+    # Keeps \@ labels of different units apart once linked
+    prefix = "U" + hashlib.sha256(os.path.abspath(unit).encode()).hexdigest()[:8] + "_"
+    preprocessor = Preprocessor(include_path, label_prefix=prefix)
+    lines = preprocessor.expand_file(unit)
+    program = parse_expanded(preprocessor, lines, listing=True, resolve=False,
+                             debug=True)
+    source_lines(program, preprocessor)
+
+    fixups = []
+    for offset, label, line_num in program.fixups:
+        filename, source_line = preprocessor.origins[line_num - 1]
+        fixups.append([offset, label, filename, source_line])
+
+    return {
+        "version": ASM_VERSION,
+        "format": OBJECT_FORMAT,
+        "unit": unit,
+        "dependencies": {path: file_hash(path)
+                         for path in preprocessor.dependencies},
+        "code": program.code.hex(),
+        "symbols": program.symbols,
+        "fixups": fixups,
+        # JSON keys are strings
+        "comments": {str(addr): comment
+                     for addr, comment in program.comments.items()},
+        "labels": program.labels,
+        # [offset, filename, line number] of every statement
+        "lines": program.lines,
+    }
+
+
+def load_unit(unit, build_dir, include_path=()):
+    """
+    Return the object of a unit and whether it had to be assembled
+    """
+
+    path = object_path(build_dir, unit)
+    try:
+        with open(path) as f:
+            obj = json.load(f)
+        if up_to_date(obj):
+            return obj, False
+    except (OSError, ValueError):
+        pass
+
+    obj = compile_unit(unit, include_path)
+    os.makedirs(build_dir, exist_ok=True)
+    temp = f"{path}.{os.getpid()}.tmp"
+    with open(temp, "w") as f:
+        json.dump(obj, f)
+    os.replace(temp, path)
+    return obj, True
+
+
+def link(objects):
+    """
+    Lay the objects out one after the other and resolve every label
+    operand against the symbols of all of them, returns a Program
+    """
+
+    program = Program()
+    # Label -> unit defining it, for duplicate errors
+    defined = {}
+    bases = []
+
+    for obj in objects:
+        base = len(program.code)
+        bases.append(base)
+        for label, addr in obj["symbols"].items():
+            if label in defined:
+                raise AsmError(f"{label} defined in both {defined[label]} "
+                               f"and {obj['unit']}")
+            defined[label] = obj["unit"]
+            program.symbols[label] = base + addr
+        for addr, comment in obj["comments"].items():
+            program.comments[base + int(addr)] = comment
+        program.labels += [(base + addr, label) for addr, label in obj["labels"]]
+        program.lines += [(base + addr, filename, line_num)
+                          for addr, filename, line_num in obj["lines"]]
+        program.code += bytes.fromhex(obj["code"])
+
+    for obj, base in zip(objects, bases):
+        for offset, label, filename, line_num in obj["fixups"]:
+            addr = program.symbols.get(label)
+            if addr is None:
+                raise AsmError(f"unknown symbol: {label}", line_num, filename)
+            program.code[base + offset] = addr & 0xFF
+
+    return program
+
+
+def build(units, build_dir=BUILD_DIRECTORY, include_path=()):
+    """
+    Build and link units, returns the Program and the units that had to be
+    assembled again
+    """
+
+    objects = []
+    rebuilt = []
+    for unit in units:
+        obj, assembled = load_unit(unit, build_dir, include_path)
+        objects.append(obj)
+        if assembled:
+            rebuilt.append(unit)
+    return link(objects), rebuilt
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Incrementally build an LS-8 program from several units.")
+    parser.add_argument("output", help="image (.ls8b) or text (.ls8) to write")
+    parser.add_argument("units", nargs="+", help="source files, in load order")
+    parser.add_argument("--build-dir", default=BUILD_DIRECTORY,
+                        help=f"where objects are kept (default {BUILD_DIRECTORY})")
+    parser.add_argument("-I", dest="include_path", action="append", default=[],
+                        help="also look for includes here")
+    parser.add_argument("-g", dest="debug", action="store_true",
+                        help="also write a debug map next to the output")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        program, rebuilt = build(args.units, args.build_dir, args.include_path)
+    except (AsmError, OSError) as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    if args.output.endswith(".ls8b"):
+        with open(args.output, "wb") as f:
+            f.write(program.image())
+    else:
+        with open(args.output, "w") as f:
+            f.write(program.text())
+    if args.debug:
+        write_debug_map(program, args.output)
+
+    print(f"{len(rebuilt)} of {len(args.units)} units assembled, "
+          f"{len(program.code)} bytes", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+# Peephole optimizer for assembled LS-8 programs
+#
+# Removes instructions that can't change what a program does:
+#
+#  NOP
+#  PUSH Rx followed by POP Rx
+#  LDI Rx,Label followed by JMP Rx or a conditional jump to Rx, where
+#    Label is the next instruction (the jump goes, the LDI stays)
+#  LDI Rx of a value that is overwritten before anything reads it
+#
+# then moves the code after each removal down and relocates labels, so
+# every LDI Rx,Label still loads the right address. Code addresses loaded
+# as plain numbers instead of labels are not relocated.
+
+from collections import Counter
+
+from asm import AsmError, Program
+from opcodes import *
+
+# Instructions the straight-line analysis doesn't look past
+ENDS_BLOCK = {HLT}
+
+# Registers used by the CPU itself (IM, IS, SP), never treated as dead
+RESERVED = {5, 6, 7}
+
+# Two register instructions that read both registers and write the first
+READ_WRITE_TWO = {ADD, AND, DIV, MOD, MUL, OR, SHL, SHR, SUB, XOR}
+
+# One register instructions that read and write it
+READ_WRITE_ONE = {DEC, INC, NOT}
+
+# One register instructions that only read it
+READ_ONE = {PRA, PRN, PUSH}
+
+CONDITIONAL_JUMPS = {JEQ, JGE, JGT, JLE, JLT, JNE}
+
+
+def effects(ir, op_a, op_b):
+    """
+    Return the registers an instruction reads and writes, as two sets
+    """
+
+    if ir in READ_WRITE_TWO:
+        return {op_a, op_b}, {op_a}
+    if ir == CMP or ir == ST:
+        return {op_a, op_b}, set()
+    if ir in READ_WRITE_ONE:
+        return {op_a}, {op_a}
+    if ir in READ_ONE:
+        return {op_a}, set()
+    if ir == LDI or ir == POP:
+        return set(), {op_a}
+    if ir == LD:
+        return {op_b}, {op_a}
+    return set(), set()
+
+
+def ends_block(ir):
+    """
+    True for instructions control may not fall through
+    """
+
+    return ir in ENDS_BLOCK or (ir >> 4) & 1
+
+
+class Optimizer:
+    """
+    Applies the rewrites to a Program assembled with items=True until none
+    apply, then builds the optimized Program.
+    """
+
+    def __init__(self, program):
+        if not program.items and program.code:
+            raise AsmError("program was assembled without items")
+        self.program = program
+        self.code = program.code
+        self.items = program.items
+        # Item indexes still in the program
+        self.live = list(range(len(program.items)))
+        # Addresses labels point at, control may arrive there from anywhere
+        self.targets = set(program.symbols.values())
+        # Offset of a label operand -> the label
+        self.references = {offset: label
+                           for offset, label, line_num in program.fixups}
+        # Rewrites applied, by name
+        self.fired = Counter()
+
+    def instruction(self, index):
+        """
+        Return (ir, op_a, op_b) of the item at index, None for data
+        """
+
+        addr, size, is_instruction = self.items[index]
+        if not is_instruction:
+            return None
+        code = self.code
+        op_a = code[addr + 1] if size > 1 else None
+        op_b = code[addr + 2] if size > 2 else None
+        return code[addr], op_a, op_b
+
+    def address(self, position):
+        """
+        Address of the live item at position, or the end of the program
+        """
+
+        if position < len(self.live):
+            return self.items[self.live[position]][0]
+        return len(self.code)
+
+    def dead_ldi(self, position, reg):
+        """
+        True if the register loaded by the LDI at position is overwritten
+        before being read, on the straight-line path after it
+        """
+
+        if reg in RESERVED:
+            return False
+        for index in self.live[position + 1:]:
+            instruction = self.instruction(index)
+            if instruction is None:
+                return False
+            ir, op_a, op_b = instruction
+            reads, writes = effects(ir, op_a, op_b)
+            if reg in reads:
+                return False
+            if reg in writes:
+                return True
+            if ends_block(ir):
+                return False
+        return False
+
+    def rewrite(self, position):
+        """
+        Try each rewrite on the live item at position, returns the positions
+        of the items to remove
+        """
+
+        instruction = self.instruction(self.live[position])
+        if instruction is None:
+            return []
+        ir, op_a, op_b = instruction
+        following = None
+        if position + 1 < len(self.live):
+            following = self.instruction(self.live[position + 1])
+            # Control can arrive at the following instruction without this one
+            if self.address(position + 1) in self.targets:
+                following = None
+
+        if ir == NOP:
+            self.fired["NOP"] += 1
+            return [position]
+
+        if ir == PUSH and following == (POP, op_a, None):
+            self.fired["PUSH Rx, POP Rx"] += 1
+            return [position, position + 1]
+
+        if ir == LDI and following is not None:
+            jump, jump_reg, _ = following
+            label = self.references.get(self.address(position) + 2)
+            if (label is not None and jump_reg == op_a
+                    and (jump == JMP or jump in CONDITIONAL_JUMPS)):
+                # Everything between the jump and the label has been removed
+                target = self.program.symbols[label]
+                jump_end = self.address(position + 1) + 2
+                if jump_end <= target <= self.address(position + 2):
+                    self.fired["jump to next instruction"] += 1
+                    return [position + 1]
+
+        if ir == LDI and self.dead_ldi(position, op_a):
+            self.fired["LDI overwritten before use"] += 1
+            return [position]
+
+        return []
+
+    def run(self):
+        """
+        Rewrite until nothing changes, returns the optimized Program
+        """
+
+        changed = True
+        while changed:
+            changed = False
+            position = 0
+            while position < len(self.live):
+                removed = self.rewrite(position)
+                if removed:
+                    for p in reversed(removed):
+                        del self.live[p]
+                    changed = True
+                else:
+                    position += 1
+
+        return self.relocate()
+
+    def relocate(self):
+        """
+        Build the Program made of the live items, moving labels, label
+        operands, listing comments and source lines along with the code
+        """
+
+        old = self.program
+        new = Program()
+        live = set(self.live)
+        # Old address -> new address, removed code maps to what follows it
+        moved = [0] * (len(old.code) + 1)
+
+        for index, (addr, size, is_instruction) in enumerate(self.items):
+            start = len(new.code)
+            if index in live:
+                for offset in range(size):
+                    moved[addr + offset] = start + offset
+                new.code += old.code[addr:addr + size]
+                new.items.append((start, size, is_instruction))
+            else:
+                for offset in range(size):
+                    moved[addr + offset] = start
+        moved[len(old.code)] = len(new.code)
+
+        new.symbols = {label: moved[addr] for label, addr in old.symbols.items()}
+        new.labels = [(moved[addr], label) for addr, label in old.labels]
+
+        kept = [False] * (len(old.code) + 1)
+        for index in live:
+            addr, size, _ = self.items[index]
+            kept[addr:addr + size] = [True] * size
+        new.comments = {moved[addr]: comment
+                        for addr, comment in old.comments.items() if kept[addr]}
+        new.fixups = [(moved[offset], label, line_num)
+                      for offset, label, line_num in old.fixups if kept[offset]]
+        new.lines = [(moved[line[0]],) + tuple(line[1:])
+                     for line in old.lines if kept[line[0]]]
+
+        new.backpatch()
+        return new
+
+
+def optimize(program):
+    """
+    Optimize a Program assembled with items=True
+
+    Returns the optimized Program and a report: a dict with the bytes and
+    instructions removed, and how often each rewrite fired. Every removed
+    instruction saves one cycle each time that code would have run.
+    """
+
+    optimizer = Optimizer(program)
+    optimized = optimizer.run()
+    removed = sum(optimizer.fired.values())
+    # PUSH/POP removes two instructions per rewrite
+    removed += optimizer.fired["PUSH Rx, POP Rx"]
+    report = {
+        "bytes": len(program.code) - len(optimized.code),
+        "cycles": removed,
+        "rewrites": dict(optimizer.fired),
+    }
+    return optimized, report
+
+
+def format_report(report):
+    """
+    Return the report from optimize() as text
+    """
+
+    lines = [f"Optimizer: saved {report['bytes']} bytes, "
+             f"{report['cycles']} cycles each time the changed code runs"]
+    for name, count in sorted(report["rewrites"].items()):
+        lines.append(f"  {name:<28} {count:>6}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""Asyncio device layer, runs interactive LS-8 sessions on one event loop."""
+
+import argparse
+import asyncio
+import sys
+from collections import deque
+
+from cpu import *
+import snapshot
+
+'''
+Usage:
+
+python(3) aio.py examples/keyboard.ls8 -> keyboard session on this terminal
+python(3) aio.py examples/keyboard.ls8 --serve 8008
+    -> one session per TCP connection, all on one event loop
+'''
+
+# Instructions run before yielding to the event loop
+SLICE_CYCLES = 10_000
+
+
+class WriterOutput:
+    '''
+    Output device writing to an asyncio StreamWriter
+
+    The transport buffers, the session awaits drain() between slices.
+    '''
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def flush(self):
+        pass
+
+
+class Session:
+    '''
+    Runs a CPU in slices of slice_cycles instructions, yielding to the event
+    loop in between, while feed() turns bytes from a reader into keyboard
+    interrupts.
+
+    Keys that arrive faster than the program takes them are queued, the next
+    one is delivered once the keyboard interrupt of the last one has been
+    serviced.
+    '''
+
+    def __init__(self, cpu, slice_cycles=SLICE_CYCLES, writer=None):
+        self.cpu = cpu
+        self.slice_cycles = slice_cycles
+        self.writer = writer
+        # Keys waiting to be delivered
+        self.keys = deque()
+        # Set once the reader is done
+        self.closed = False
+
+    def deliver_key(self):
+        '''
+        Press the next queued key once the CPU is ready for it
+        '''
+        cpu = self.cpu
+        pending = cpu.register[IS] & (1 << KEYBOARD)
+        if self.keys and not pending and cpu.interrupts_enabled:
+            cpu.press_key(self.keys.popleft())
+
+    def snapshot(self):
+        '''
+        Snapshot the CPU along with the keys still queued
+        '''
+        return snapshot.take(self.cpu, bytes(self.keys))
+
+    def restore(self, data):
+        self.keys = deque(snapshot.restore(self.cpu, data))
+
+    async def run(self):
+        '''
+        Run until the CPU halts or faults, or the reader closes and every key
+        has been delivered, returns the last RunResult, which carries the
+        Fault if there was one
+        '''
+        while True:
+            self.deliver_key()
+            result = self.cpu.run(max_cycles=self.slice_cycles)
+            if self.writer is not None:
+                await self.writer.drain()
+            if result.halted or result.reason == FAULT:
+                return result
+            if self.closed and not self.keys:
+                return result
+            # Let the other sessions and the readers have a go
+            await asyncio.sleep(0)
+
+    async def feed(self, reader):
+        '''
+        Queue every byte read from an asyncio StreamReader as a key press
+        '''
+        while True:
+            data = await reader.read(256)
+            if not data:
+                break
+            self.keys.extend(data)
+        self.closed = True
+
+
+async def stdin_reader():
+    '''
+    Return a StreamReader reading stdin without blocking the loop
+    '''
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                 sys.stdin)
+    return reader
+
+
+async def run_terminal(filename):
+    '''
+    Run one session on stdin and stdout
+    '''
+    cpu = CPU()
+    cpu.load(filename)
+    session = Session(cpu)
+    feeder = asyncio.create_task(session.feed(await stdin_reader()))
+    try:
+        return await session.run()
+    finally:
+        feeder.cancel()
+
+
+async def serve(filename, host, port):
+    '''
+    Run a fresh session of the program for every TCP connection
+    '''
+    async def handle(reader, writer):
+        cpu = CPU(output=WriterOutput(writer))
+        cpu.load(filename)
+        session = Session(cpu, writer=writer)
+        feeder = asyncio.create_task(session.feed(reader))
+        try:
+            result = await session.run()
+            if result.fault is not None:
+                writer.write(f'Fault: {result.fault}\n'.encode())
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            feeder.cancel()
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def report(result):
+    '''
+    Print the fault that stopped a session, returns the exit status
+    '''
+    if result.fault is None:
+        return 0
+    print(f'Fault: {result.fault}', file=sys.stderr)
+    return 1
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('program', help='program to run')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='serve sessions over TCP instead of the terminal')
+    parser.add_argument('--host', default='127.0.0.1')
+    args = parser.parse_args(argv[1:])
+
+    if args.serve is not None:
+        asyncio.run(serve(args.program, args.host, args.serve))
+        return 0
+
+    if not sys.stdin.isatty():
+        return report(asyncio.run(run_terminal(args.program)))
+
+    # Hand keys over as they are pressed instead of a line at a time
+    import termios
+    import tty
+    fd = sys.stdin.fileno()
+    saved = termios.tcgetattr(fd)
+    tty.setcbreak(fd)
+    try:
+        result = asyncio.run(run_terminal(args.program))
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+    return report(result)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,601 @@
+#!/usr/bin/env python3
+
+"""Static control flow analysis of LS-8 programs."""
+
+import argparse
+import json
+import sys
+
+from cpu import *
+
+'''
+Usage:
+
+python(3) analyze.py examples/call.ls8 -> prints blocks, calls, loops,
+    unreachable code and the deepest the stack can get
+python(3) analyze.py examples/call.ls8 --json call.json -> also as JSON
+
+Exits with 1 when the stack may overflow into the program.
+
+The analysis runs the program abstractly from its entry point. Each
+register holds the set of values it may have (up to MAX_VALUES of them,
+or unknown), so LDI Rx,Label followed by JMP Rx or CALL Rx resolves to
+Label. The stack is modelled too, so RET returns to the call sites that
+pushed its return address and POP gets what PUSH saved. A ST of a known
+address to an interrupt vector makes the stored address the entry of an
+interrupt handler, analysed the same way.
+'''
+
+# Most values tracked for one register before it counts as unknown
+MAX_VALUES = 32
+# Most stack entries tracked
+MAX_STACK = 256
+# Bytes pushed when an interrupt is serviced: PC, FL and R0-R6
+INTERRUPT_FRAME = 9
+# Where SP starts
+STACK_TOP = 0xF4
+
+# Jumps with a fall through
+CONDITIONAL_JUMPS = {JEQ, JGE, JGT, JLE, JLT, JNE}
+
+# Two register ALU instructions, as functions of the two values
+ALU = {
+    ADD: lambda a, b: a + b,
+    SUB: lambda a, b: a - b,
+    MUL: lambda a, b: a * b,
+    AND: lambda a, b: a & b,
+    OR: lambda a, b: a | b,
+    XOR: lambda a, b: a ^ b,
+    SHL: lambda a, b: a << b,
+    SHR: lambda a, b: a >> b,
+    DIV: lambda a, b: a // b,
+    MOD: lambda a, b: a % b,
+}
+
+# One register ALU instructions
+UNARY = {
+    INC: lambda a: a + 1,
+    DEC: lambda a: a - 1,
+    NOT: lambda a: ~a,
+}
+
+
+def limit(values):
+    '''
+    Return values as a value set, or None (unknown) if there are too many
+    '''
+    values = frozenset(value & 0xFF for value in values)
+    return values if len(values) <= MAX_VALUES else None
+
+
+def join_values(a, b):
+    if a is None or b is None:
+        return None
+    return limit(a | b)
+
+
+def join_stacks(a, b):
+    '''
+    Join two stacks, (entries bottom to top, complete). Stacks of different
+    depths keep the entries they have in common at the top.
+    '''
+    entries_a, complete_a = a
+    entries_b, complete_b = b
+    n = min(len(entries_a), len(entries_b))
+    top_a = entries_a[len(entries_a) - n:]
+    top_b = entries_b[len(entries_b) - n:]
+    entries = tuple(join_values(x, y) for x, y in zip(top_a, top_b))
+    complete = complete_a and complete_b and len(entries_a) == len(entries_b)
+    return entries, complete
+
+
+def join(a, b):
+    '''
+    Join two states, (registers, stack)
+    '''
+    registers = tuple(join_values(x, y) for x, y in zip(a[0], b[0]))
+    return registers, join_stacks(a[1], b[1])
+
+
+class Analysis:
+    '''
+    The results of analysing a program loaded in ram.
+
+    Addresses are of instruction starts. roots are where execution may
+    begin: the entry point, then interrupt handlers. functions are the CALL
+    targets, leaders the first instruction of every basic block and blocks
+    maps each leader to the addresses of its instructions.
+
+    successors holds the control flow inside functions, a CALL is followed
+    by its return site. calls maps each CALL to its targets.
+    '''
+
+    def __init__(self, ram, entry=0):
+        self.ram = ram
+        self.entry = entry
+        self.end = program_end(ram)
+        # Address -> (ir, op_a, op_b, size) of every instruction reached
+        self.instructions = {}
+        self.successors = {}
+        self.calls = {}
+        self.roots = [entry]
+        self.functions = set()
+        # Interrupt number -> handler address
+        self.handlers = {}
+        # Jumps, calls and returns whose target couldn't be worked out
+        self.unresolved = set()
+        # Unsupported opcodes reached
+        self.illegal = set()
+        # RET or POP with nothing on the stack
+        self.underflows = set()
+        # ST to an address holding code
+        self.code_writes = set()
+        # Lowest SP reached from each root, None if it's not known
+        self.lowest_sp = {}
+        # Address where SP first became unknown, per root
+        self.unknown_sp = {}
+        self.leaders = set()
+        self.blocks = {}
+        # (header, set of leaders in the loop), natural loops
+        self.loops = []
+        # (from, to) of edges into loops with several entries
+        self.irreducible = []
+
+    def operands(self, address):
+        ram = self.ram
+        ir = ram[address]
+        size = (ir >> 6) + 1
+        return ir, ram[(address + 1) & 0xFF], ram[(address + 2) & 0xFF], size
+
+    def explore(self, root, state):
+        '''
+        Run the program abstractly from root until the states of every
+        instruction reached stop changing
+        '''
+        states = {root: state}
+        work = [root]
+        # Handlers found from here
+        found = []
+
+        while work:
+            address = work.pop()
+            state = states[address]
+            for target, new in self.transfer(address, state, found):
+                old = states.get(target)
+                if old is not None:
+                    new = join(old, new)
+                    if new == old:
+                        continue
+                states[target] = new
+                work.append(target)
+
+        sps = [state[0][SP] for state in states.values()]
+        if any(sp is None for sp in sps):
+            self.lowest_sp[root] = None
+            self.unknown_sp[root] = min(address for address, state in states.items()
+                                        if state[0][SP] is None)
+        else:
+            self.lowest_sp[root] = min((value for sp in sps for value in sp),
+                                       default=STACK_TOP)
+        return found
+
+    def transfer(self, address, state, found):
+        '''
+        Return the (address, state) pairs control may go to after the
+        instruction at address runs in state
+        '''
+        ir, op_a, op_b, size = self.operands(address)
+        self.instructions[address] = (ir, op_a, op_b, size)
+        next_pc = (address + size) & 0xFF
+        registers, (stack, complete) = state
+        registers = list(registers)
+        successors = self.successors.setdefault(address, set())
+
+        def push(values):
+            nonlocal stack
+            registers[SP] = unary(lambda sp: sp - 1, registers[SP])
+            stack = (stack + (values,))[-MAX_STACK:]
+
+        def pop():
+            nonlocal stack
+            registers[SP] = unary(lambda sp: sp + 1, registers[SP])
+            if stack:
+                value = stack[-1]
+                stack = stack[:-1]
+                return value
+            if complete:
+                self.underflows.add(address)
+            return None
+
+        def after(pc):
+            return pc, (tuple(registers), (stack, complete))
+
+        def targets(values):
+            if values is None:
+                self.unresolved.add(address)
+                return []
+            return sorted(values)
+
+        if ir not in OPCODE_NAMES or bad_register(ir, op_a, op_b):
+            # Unsupported, or naming a register past R7
+            self.illegal.add(address)
+            return []
+
+        if ir == HLT:
+            return []
+
+        if ir == IRET:
+            for _ in range(INTERRUPT_FRAME):
+                pop()
+            return []
+
+        if ir == RET:
+            returns = pop()
+            return [after(pc) for pc in targets(returns)]
+
+        if ir == CALL:
+            callees = targets(registers[op_a])
+            successors.add(next_pc)
+            self.calls.setdefault(address, set()).update(callees)
+            self.functions.update(callees)
+            push(frozenset((next_pc,)))
+            return [after(pc) for pc in callees]
+
+        if ir == JMP:
+            jumps = targets(registers[op_a])
+            successors.update(jumps)
+            return [after(pc) for pc in jumps]
+
+        if ir in CONDITIONAL_JUMPS:
+            jumps = targets(registers[op_a])
+            successors.update(jumps)
+            successors.add(next_pc)
+            return [after(pc) for pc in jumps + [next_pc]]
+
+        # Everything else falls through
+        successors.add(next_pc)
+        # Writing SP other than through the stack loses track of the stack
+        stack_lost = False
+
+        if ir == LDI:
+            registers[op_a] = frozenset((op_b,))
+            stack_lost = op_a == SP
+        elif ir in ALU:
+            registers[op_a] = binary(ALU[ir], registers[op_a], registers[op_b],
+                                     ir in (DIV, MOD))
+            stack_lost = op_a == SP
+        elif ir in UNARY:
+            registers[op_a] = unary(UNARY[ir], registers[op_a])
+            stack_lost = op_a == SP
+        elif ir == LD:
+            registers[op_a] = None
+            stack_lost = op_a == SP
+        elif ir == PUSH:
+            push(registers[op_a])
+        elif ir == POP:
+            value = pop()
+            registers[op_a] = value
+            stack_lost = op_a == SP
+        elif ir == ST:
+            addresses = registers[op_a]
+            values = registers[op_b]
+            for target in addresses or ():
+                if target >= VECTORS and values is None:
+                    # Some handler nobody can see
+                    self.unresolved.add(address)
+                elif target >= VECTORS:
+                    for handler in values:
+                        if self.handlers.get(target - VECTORS) != handler:
+                            self.handlers[target - VECTORS] = handler
+                            found.append(handler)
+                elif target in self.instructions:
+                    self.code_writes.add(address)
+
+        if stack_lost:
+            stack, complete = (), False
+        return [after(next_pc)]
+
+    def run(self):
+        '''
+        Analyse from the entry point and every interrupt handler found,
+        then work out blocks and loops
+        '''
+        registers = tuple(frozenset((0,)) for _ in range(8))
+        registers = registers[:SP] + (frozenset((STACK_TOP,)),)
+        pending = self.explore(self.entry, (registers, ((), True)))
+
+        # A handler may start with any registers, on top of the frame the
+        # CPU pushed. SP is taken from the top so its depth is its own.
+        frame = ((None,) * INTERRUPT_FRAME, True)
+        handler_registers = (None,) * SP + (frozenset((STACK_TOP - INTERRUPT_FRAME,)),)
+        while pending:
+            handler = pending.pop()
+            if handler in self.roots:
+                continue
+            self.roots.append(handler)
+            pending += self.explore(handler, (handler_registers, frame))
+
+        self.find_blocks()
+        self.find_loops()
+        return self
+
+    def find_blocks(self):
+        '''
+        Split the instructions reached into basic blocks
+        '''
+        leaders = set(self.roots) | self.functions
+        for address, (ir, op_a, op_b, size) in self.instructions.items():
+            if (ir >> 4) & 1 or ir == HLT:
+                leaders.update(self.successors.get(address, ()))
+        leaders &= set(self.instructions)
+        self.leaders = leaders
+
+        for leader in leaders:
+            block = []
+            address = leader
+            while True:
+                block.append(address)
+                ir, op_a, op_b, size = self.instructions[address]
+                address = (address + size) & 0xFF
+                if ((ir >> 4) & 1 or ir == HLT or ir not in OPCODE_NAMES
+                        or address in leaders or address not in self.instructions
+                        or len(block) > 256):
+                    break
+            self.blocks[leader] = block
+
+    def block_successors(self, leader):
+        last = self.blocks[leader][-1]
+        return sorted(s for s in self.successors.get(last, ()) if s in self.blocks)
+
+    def find_loops(self):
+        '''
+        Find natural loops, from back edges to blocks dominating their
+        source, and flag cycles with several entries
+        '''
+        roots = set(self.roots) | self.functions
+        order = sorted(self.blocks)
+        predecessors = {leader: set() for leader in order}
+        for leader in order:
+            for successor in self.block_successors(leader):
+                predecessors[successor].add(leader)
+
+        # Iterative dominators, with every root hanging off a virtual entry
+        everything = set(order)
+        dominators = {leader: ({leader} if leader in roots else set(everything))
+                      for leader in order}
+        changed = True
+        while changed:
+            changed = False
+            for leader in order:
+                if leader in roots:
+                    continue
+                incoming = [dominators[p] for p in predecessors[leader]]
+                new = ({leader} | set.intersection(*incoming)) if incoming else {leader}
+                if new != dominators[leader]:
+                    dominators[leader] = new
+                    changed = True
+
+        for leader in order:
+            for successor in self.block_successors(leader):
+                if successor in dominators[leader]:
+                    body = {successor, leader}
+                    work = [leader]
+                    while work:
+                        block = work.pop()
+                        if block == successor:
+                            continue
+                        for p in predecessors[block]:
+                            if p not in body:
+                                body.add(p)
+                                work.append(p)
+                    self.loops.append((successor, body))
+
+        # Cycles found by a depth first walk that aren't natural loops
+        state = {}
+        for root in sorted(roots & everything):
+            stack = [(root, iter(self.block_successors(root)))]
+            state[root] = 1
+            while stack:
+                block, successors = stack[-1]
+                for successor in successors:
+                    if state.get(successor) == 1:
+                        if successor not in dominators[block]:
+                            self.irreducible.append((block, successor))
+                    elif successor not in state:
+                        state[successor] = 1
+                        stack.append((successor, iter(self.block_successors(successor))))
+                        break
+                else:
+                    state[block] = 2
+                    stack.pop()
+
+    def unreachable(self):
+        '''
+        Return (start, end) ranges of the program no instruction reached
+        covers, code that never runs or data
+        '''
+        covered = bytearray(256)
+        for address, (ir, op_a, op_b, size) in self.instructions.items():
+            for k in range(size):
+                covered[(address + k) & 0xFF] = 1
+        ranges = []
+        start = None
+        for address in range(self.end + 1):
+            if address < self.end and not covered[address]:
+                if start is None:
+                    start = address
+            elif start is not None:
+                ranges.append((start, address))
+                start = None
+        return ranges
+
+    def max_depth(self):
+        '''
+        Return the most bytes the stack may hold, None if that isn't known
+        (it grows in a loop, the program recurses or sets SP itself)
+        '''
+        main = self.lowest_sp.get(self.entry)
+        if main is None:
+            return None
+        depth = STACK_TOP - main
+        handlers = [self.lowest_sp.get(root) for root in self.roots[1:]]
+        if any(sp is None for sp in handlers):
+            return None
+        if handlers:
+            # An interrupt may come at the deepest point, handlers don't nest
+            depth += max(STACK_TOP - sp for sp in handlers)
+        return depth
+
+    def stack_space(self):
+        '''
+        Bytes between the end of the program and the top of the stack
+        '''
+        return STACK_TOP - self.end
+
+    def overflows(self, symbol_map=None):
+        '''
+        Return why the stack may overflow into the program, or None
+        '''
+        depth = self.max_depth()
+        if depth is None:
+            unknown = min(address for address in self.unknown_sp.values())
+            where = (symbol_map.describe(unknown) if symbol_map is not None
+                     else f'{unknown:02X}')
+            return (f'stack depth unbounded (recursion, pushes in a loop or SP '
+                    f'set directly), first at {where}')
+        if depth > self.stack_space():
+            return (f'stack may reach {depth} bytes, only '
+                    f'{self.stack_space()} free above the program')
+        return None
+
+    def to_dict(self, symbol_map=None):
+        '''
+        Return the analysis as plain data
+        '''
+        def name(address):
+            if symbol_map is None:
+                return f'{address:02X}'
+            return symbol_map.describe(address)
+
+        return {
+            'entry': name(self.entry),
+            'roots': [name(root) for root in self.roots],
+            'handlers': {str(n): name(address)
+                         for n, address in sorted(self.handlers.items())},
+            'functions': [name(address) for address in sorted(self.functions)],
+            'blocks': [{'start': name(leader), 'instructions': len(block),
+                        'successors': [name(s) for s in self.block_successors(leader)]}
+                       for leader, block in sorted(self.blocks.items())],
+            'calls': [{'from': name(address), 'to': [name(t) for t in sorted(targets)]}
+                      for address, targets in sorted(self.calls.items())],
+            'loops': [{'header': name(header), 'blocks': [name(b) for b in sorted(body)]}
+                      for header, body in self.loops],
+            'irreducible': [[name(a), name(b)] for a, b in self.irreducible],
+            'unreachable': [[name(start), end - start]
+                            for start, end in self.unreachable()],
+            'unresolved': [name(address) for address in sorted(self.unresolved)],
+            'illegal': [name(address) for address in sorted(self.illegal)],
+            'underflows': [name(address) for address in sorted(self.underflows)],
+            'code_writes': [name(address) for address in sorted(self.code_writes)],
+            'max_depth': self.max_depth(),
+            'stack_space': self.stack_space(),
+            'overflow': self.overflows(symbol_map),
+        }
+
+    def report(self, symbol_map=None):
+        '''
+        Return the analysis as text
+        '''
+        data = self.to_dict(symbol_map)
+        lines = [f"Entry {data['entry']}, {len(self.blocks)} blocks, "
+                 f"{len(self.functions)} functions, "
+                 f"{len(self.handlers)} interrupt handlers"]
+
+        lines.append('Blocks:')
+        for block in data['blocks']:
+            successors = ', '.join(block['successors']) or '-'
+            lines.append(f"  {block['start']:<32} {block['instructions']:>3}"
+                         f"  -> {successors}")
+
+        if data['handlers']:
+            lines.append('Interrupt handlers:')
+            for n, address in data['handlers'].items():
+                lines.append(f'  {n}: {address}')
+
+        if data['calls']:
+            lines.append('Calls:')
+            for call in data['calls']:
+                lines.append(f"  {call['from']} -> {', '.join(call['to']) or '?'}")
+
+        if data['loops']:
+            lines.append('Loops:')
+            for loop in data['loops']:
+                lines.append(f"  {loop['header']}, {len(loop['blocks'])} blocks")
+        for a, b in data['irreducible']:
+            lines.append(f'  {a} -> {b} enters a loop from the side')
+
+        if data['unreachable']:
+            lines.append('Not reached (dead code or data):')
+            for start, size in data['unreachable']:
+                lines.append(f'  {start}, {size} bytes')
+
+        for key, title in (('unresolved', 'Unknown target'),
+                           ('illegal', 'Illegal instruction'),
+                           ('underflows', 'Stack underflow'),
+                           ('code_writes', 'May write to code')):
+            for address in data[key]:
+                lines.append(f'{title} at {address}')
+
+        depth = data['max_depth']
+        depth = 'unbounded' if depth is None else f'at most {depth} bytes'
+        lines.append(f"Stack: {depth}, {data['stack_space']} bytes free")
+        if data['overflow']:
+            lines.append(f"  may overflow: {data['overflow']}")
+        return '\n'.join(lines) + '\n'
+
+
+def binary(op, a, b, divides=False):
+    '''
+    Apply op to every pair of values in value sets a and b
+    '''
+    if a is None or b is None:
+        return None
+    if divides:
+        # Dividing by zero faults, it doesn't produce a value
+        b = [value for value in b if value]
+    return limit(op(x, y) for x in a for y in b)
+
+
+def unary(op, a):
+    if a is None:
+        return None
+    return limit(op(x) for x in a)
+
+
+def analyze(cpu):
+    '''
+    Analyse the program loaded in a CPU, returns an Analysis
+    '''
+    return Analysis(bytes(cpu.ram), cpu.pc).run()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('program', help='program to analyse')
+    parser.add_argument('--json', help='also write the analysis to this file')
+    args = parser.parse_args(argv[1:])
+
+    cpu = CPU()
+    cpu.load(args.program)
+    analysis = analyze(cpu)
+    sys.stdout.write(analysis.report(cpu.symbol_map))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(analysis.to_dict(cpu.symbol_map), f, indent=2)
+
+    return 1 if analysis.overflows() else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
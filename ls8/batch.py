@@ -0,0 +1,312 @@
+"""Vectorized batch of LS-8 machines, requires NumPy."""
+
+import numpy as np
+
+from cpu import *
+
+
+class BatchCPU:
+    '''
+    Runs N LS-8 machines in lockstep.
+
+    RAM (N x 256), registers (N x 8), PC and FL of every machine live in
+    NumPy arrays. Each step, the running machines are grouped by the
+    instruction they are about to execute (opcode and both operand bytes),
+    and each group is executed as one array operation, so machines that
+    share a PC share the work and divergent ones just form more groups.
+    '''
+
+    def __init__(self, n):
+        """Construct a batch of n machines in the power on state."""
+        self.n = n
+        self.ram = np.zeros((n, 256), dtype=np.uint8)
+        self.register = np.zeros((n, 8), dtype=np.uint8)
+        self.register[:, SP] = 0xF4
+        self.pc = np.zeros(n, dtype=np.uint8)
+        self.fl = np.zeros(n, dtype=np.uint8)
+        self.halted = np.zeros(n, dtype=bool)
+        # Output bytes of each machine
+        self.output = [bytearray() for _ in range(n)]
+        # Fault message (as cpu.Fault words it) of each machine that stopped
+        # on one, by machine index
+        self.errors = {}
+        # Handler of every opcode, indexed by the opcode itself
+        # INT and IRET aren't supported, the batch has no interrupts
+        self.branchtable = dispatch_table(self, self.unsupported)
+
+    @classmethod
+    def from_cpu(cls, cpu, n):
+        '''
+        Make a batch of n copies of a CPU
+        '''
+        batch = cls(n)
+        batch.ram[:] = np.frombuffer(bytes(cpu.ram), dtype=np.uint8)
+        batch.register[:] = np.frombuffer(bytes(cpu.register), dtype=np.uint8)
+        batch.pc[:] = cpu.pc
+        batch.fl[:] = cpu.fl
+        return batch
+
+    def load(self, filename):
+        '''
+        Load the same program into every machine
+        '''
+        cpu = CPU()
+        cpu.load(filename)
+        self.ram[:] = np.frombuffer(bytes(cpu.ram), dtype=np.uint8)
+
+    def machine(self, i):
+        '''
+        Return a CPU in the current state of machine i
+        '''
+        cpu = CPU()
+        cpu.ram[:] = self.ram[i].tobytes()
+        cpu.register[:] = self.register[i].tobytes()
+        cpu.pc = int(self.pc[i])
+        cpu.fl = int(self.fl[i])
+        return cpu
+
+    def call(self, idx, op_a, op_b):
+        '''
+        Push the return address and jump to the address in register[op_a]
+        '''
+        sp = self.register[idx, SP] - np.uint8(1)
+        self.register[idx, SP] = sp
+        self.ram[idx, sp] = self.pc[idx] + np.uint8(2)
+        self.pc[idx] = self.register[idx, op_a]
+
+    def hlt(self, idx, op_a, op_b):
+        '''
+        Halt the machines
+        '''
+        self.halted[idx] = True
+
+    def jmp(self, idx, op_a, op_b):
+        '''
+        Jump to the address stored in register[op_a]
+        '''
+        self.pc[idx] = self.register[idx, op_a]
+
+    def jump_if(self, idx, taken, op_a):
+        '''
+        Jump the machines where taken is true to the address in
+        register[op_a], the others go on to the next instruction
+        '''
+        self.pc[idx] = np.where(taken, self.register[idx, op_a],
+                                self.pc[idx] + np.uint8(2))
+
+    def jeq(self, idx, op_a, op_b):
+        self.jump_if(idx, self.fl[idx] & FL_E != 0, op_a)
+
+    def jne(self, idx, op_a, op_b):
+        self.jump_if(idx, self.fl[idx] & FL_E == 0, op_a)
+
+    def jgt(self, idx, op_a, op_b):
+        self.jump_if(idx, self.fl[idx] & FL_G != 0, op_a)
+
+    def jlt(self, idx, op_a, op_b):
+        self.jump_if(idx, self.fl[idx] & FL_L != 0, op_a)
+
+    def jle(self, idx, op_a, op_b):
+        self.jump_if(idx, self.fl[idx] & (FL_L | FL_E) != 0, op_a)
+
+    def jge(self, idx, op_a, op_b):
+        self.jump_if(idx, self.fl[idx] & (FL_G | FL_E) != 0, op_a)
+
+    def ld(self, idx, op_a, op_b):
+        '''
+        Load register[op_a] from the address stored in register[op_b]
+        '''
+        self.register[idx, op_a] = self.ram[idx, self.register[idx, op_b]]
+
+    def ldi(self, idx, op_a, op_b):
+        '''
+        Set the value of register[op_a] to op_b
+        '''
+        self.register[idx, op_a] = op_b
+
+    def nop(self, idx, op_a, op_b):
+        pass
+
+    def pop(self, idx, op_a, op_b):
+        '''
+        Pop the value at the top of the stack into register[op_a]
+        '''
+        self.register[idx, op_a] = self.ram[idx, self.register[idx, SP]]
+        self.register[idx, SP] += np.uint8(1)
+
+    def pra(self, idx, op_a, op_b):
+        '''
+        Print alpha character value stored in register[op_a]
+        '''
+        for i, value in zip(idx, self.register[idx, op_a]):
+            self.output[i].append(value)
+
+    def prn(self, idx, op_a, op_b):
+        '''
+        Print numeric value stored in register[op_a]
+        '''
+        for i, value in zip(idx, self.register[idx, op_a]):
+            self.output[i] += b'%d\n' % value
+
+    def push(self, idx, op_a, op_b):
+        '''
+        Push the value in register[op_a] onto the stack
+        '''
+        sp = self.register[idx, SP] - np.uint8(1)
+        self.register[idx, SP] = sp
+        self.ram[idx, sp] = self.register[idx, op_a]
+
+    def ret(self, idx, op_a, op_b):
+        '''
+        Return from subroutine
+        '''
+        sp = self.register[idx, SP]
+        self.pc[idx] = self.ram[idx, sp]
+        self.register[idx, SP] = sp + np.uint8(1)
+
+    def st(self, idx, op_a, op_b):
+        '''
+        Store register[op_b] at the address stored in register[op_a]
+        '''
+        self.ram[idx, self.register[idx, op_a]] = self.register[idx, op_b]
+
+    # uint8 arithmetic wraps on its own
+    def add(self, idx, op_a, op_b):
+        self.register[idx, op_a] += self.register[idx, op_b]
+
+    def sub(self, idx, op_a, op_b):
+        self.register[idx, op_a] -= self.register[idx, op_b]
+
+    def mul(self, idx, op_a, op_b):
+        self.register[idx, op_a] *= self.register[idx, op_b]
+
+    def divide(self, idx, op_a, op_b, operation):
+        divisor = self.register[idx, op_b]
+        zero = divisor == 0
+        if zero.any():
+            # Machines dividing by zero stop, the rest carry on
+            self.fault(idx[zero], DIVIDE_BY_ZERO)
+            idx = idx[~zero]
+            divisor = divisor[~zero]
+        self.register[idx, op_a] = operation(self.register[idx, op_a], divisor)
+
+    def div(self, idx, op_a, op_b):
+        self.divide(idx, op_a, op_b, np.floor_divide)
+
+    def mod(self, idx, op_a, op_b):
+        self.divide(idx, op_a, op_b, np.remainder)
+
+    def inc(self, idx, op_a, op_b):
+        self.register[idx, op_a] += np.uint8(1)
+
+    def dec(self, idx, op_a, op_b):
+        self.register[idx, op_a] -= np.uint8(1)
+
+    def and_(self, idx, op_a, op_b):
+        self.register[idx, op_a] &= self.register[idx, op_b]
+
+    def or_(self, idx, op_a, op_b):
+        self.register[idx, op_a] |= self.register[idx, op_b]
+
+    def xor(self, idx, op_a, op_b):
+        self.register[idx, op_a] ^= self.register[idx, op_b]
+
+    def not_(self, idx, op_a, op_b):
+        self.register[idx, op_a] = ~self.register[idx, op_a]
+
+    # Shifts of 8 or more clear the register, as they do on the CPU, capped
+    # so NumPy never shifts past the width of the type
+    def shl(self, idx, op_a, op_b):
+        value = self.register[idx, op_a].astype(np.uint32)
+        shift = np.minimum(self.register[idx, op_b], 16)
+        self.register[idx, op_a] = (value << shift) & 0xFF
+
+    def shr(self, idx, op_a, op_b):
+        value = self.register[idx, op_a].astype(np.uint32)
+        shift = np.minimum(self.register[idx, op_b], 16)
+        self.register[idx, op_a] = value >> shift
+
+    def cmp(self, idx, op_a, op_b):
+        '''
+        Set FL to 00000LGE comparing register[op_a] with register[op_b]
+        '''
+        a = self.register[idx, op_a]
+        b = self.register[idx, op_b]
+        self.fl[idx] = np.where(a == b, FL_E, np.where(a < b, FL_L, FL_G))
+
+    def unsupported(self, idx, op_a, op_b):
+        # Machines running into an unknown opcode stop
+        self.fault(idx, ILLEGAL_INSTRUCTION, address=True)
+
+    def illegal_register(self, idx, op_a, op_b):
+        # So do machines naming a register past R7
+        self.fault(idx, ILLEGAL_REGISTER, address=True)
+
+    def fault(self, idx, kind, address=False):
+        '''
+        Halt the machines in idx on a fault of kind, with the faulting
+        instruction as the address when address is set
+        '''
+        for i in idx:
+            pc = int(self.pc[i])
+            fault = Fault(kind, pc, int(self.register[i, SP]),
+                          pc if address else None)
+            self.errors[int(i)] = str(fault)
+        self.halted[idx] = True
+
+    def step(self):
+        '''
+        Execute one instruction on every running machine, returns the number
+        of machines that ran
+        '''
+        rows = np.flatnonzero(~self.halted)
+        if len(rows) == 0:
+            return 0
+
+        ram = self.ram
+        pc = self.pc[rows].astype(np.intp)
+        ir = ram[rows, pc].astype(np.int64)
+        op_a = ram[rows, (pc + 1) & 0xFF].astype(np.int64)
+        op_b = ram[rows, (pc + 2) & 0xFF].astype(np.int64)
+
+        # Group machines by the whole instruction so one group needs one call
+        key = (ir << 16) | (op_a << 8) | op_b
+        order = np.argsort(key, kind='stable')
+        key = key[order]
+        rows = rows[order]
+        starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+        ends = np.r_[starts[1:], len(key)]
+
+        for start, end in zip(starts, ends):
+            k = int(key[start])
+            ir, op_a, op_b = k >> 16, (k >> 8) & 0xFF, k & 0xFF
+            idx = rows[start:end]
+            handler = self.branchtable[ir]
+            if bad_register(ir, op_a, op_b):
+                handler = self.illegal_register
+            handler(idx, op_a, op_b)
+            # To handle ops that set pc, machines that halted or faulted
+            # stay where they stopped
+            if not (ir >> 4) & 0b1:
+                idx = idx[~self.halted[idx]]
+                self.pc[idx] += np.uint8((ir >> 6) + 1)
+
+        return len(rows)
+
+    def run(self, max_steps=None):
+        '''
+        Run until every machine halts or max_steps steps have been taken,
+        returns the number of steps taken
+        '''
+        steps = 0
+        while max_steps is None or steps < max_steps:
+            if not self.step():
+                break
+            steps += 1
+        return steps
+
+    def outputs(self):
+        '''
+        Return the output bytes of every machine
+        '''
+        return [bytes(out) for out in self.output]
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for the LS-8 emulator and assembler."""
+
+import argparse
+import glob
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from cpu import *
+import image
+from blocks import BlockEngine
+
+# The assembler lives next door
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'asm'))
+import asm
+
+'''
+Usage:
+
+python(3) bench.py -> runs everything, prints a summary
+python(3) bench.py --out new.json -> also writes the results as JSON
+python(3) bench.py --compare old.json -> flags anything slower than old.json
+'''
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = os.path.join(HERE, 'examples')
+
+# Instructions each program runs for, programs that never halt are cut off
+MAX_CYCLES = 200_000
+# Lines in the generated assembler benchmark source
+ASM_LINES = 20_000
+# A benchmark this much slower than the baseline is a regression
+REGRESSION = 1.10
+
+ENGINES = {
+    'interpreter': lambda cpu: cpu,
+    'blocks': BlockEngine,
+}
+
+
+def loop(body):
+    '''
+    Wrap assembly source in an infinite loop
+    '''
+    return f'    LDI R6,Loop\nLoop:\n{body}    JMP R6\n'
+
+
+def call_chain(depth):
+    '''
+    Source for a loop calling a chain of depth nested subroutines
+    '''
+    lines = ['    LDI R6,Loop', 'Loop:', '    LDI R0,F0', '    CALL R0',
+             '    JMP R6']
+    for i in range(depth):
+        lines.append(f'F{i}:')
+        if i + 1 < depth:
+            lines += [f'    LDI R0,F{i + 1}', '    CALL R0']
+        lines.append('    RET')
+    return '\n'.join(lines) + '\n'
+
+
+# Synthetic workloads, all run until MAX_CYCLES
+SYNTHETIC = {
+    'alu': loop('    LDI R1,3\n    ADD R0,R1\n    MUL R2,R1\n'
+                '    SUB R3,R0\n    DIV R2,R1\n'),
+    'calls': call_chain(32),
+    'stack': loop(''.join(f'    PUSH R{i}\n' for i in range(6)) +
+                  ''.join(f'    POP R{i}\n' for i in reversed(range(6)))),
+    'output': loop('    LDI R0,65\n    PRA R0\n    LDI R0,10\n    PRA R0\n'),
+}
+
+
+def programs():
+    '''
+    Yield (name, image bytes) for every example and synthetic workload
+    '''
+    for filename in sorted(glob.glob(os.path.join(EXAMPLES, '*.ls8'))):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        with open(filename) as f:
+            yield name, image.pack(image.parse_text(f))
+    for name, source in SYNTHETIC.items():
+        yield f'synthetic/{name}', asm.assemble(io.StringIO(source))
+
+
+def bench_program(data, engine):
+    '''
+    Time one program on one engine
+    '''
+    start = time.perf_counter()
+    cpu = CPU()
+    cpu.load_bytes(data)
+    cpu = ENGINES[engine](cpu)
+    startup = time.perf_counter() - start
+
+    start = time.perf_counter()
+    try:
+        result = cpu.run(max_cycles=MAX_CYCLES, capture=True)
+    except Exception as e:
+        # A program that crashes the emulator still gets a row
+        return {'error': f'{type(e).__name__}: {e}'}
+    seconds = time.perf_counter() - start
+
+    # Separate short run for memory, tracemalloc slows everything down
+    tracemalloc.start()
+    cpu = CPU()
+    cpu.load_bytes(data)
+    ENGINES[engine](cpu).run(max_cycles=MAX_CYCLES // 10, capture=True)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'reason': result.reason,
+        'cycles': result.cycles,
+        'seconds': seconds,
+        'ips': result.cycles / seconds if seconds else 0.0,
+        'startup_seconds': startup,
+        'peak_bytes': peak,
+    }
+
+
+def bench_assembler(lines=ASM_LINES):
+    '''
+    Time asm.py on a large generated source
+    '''
+    body = []
+    for i in range(lines // 4):
+        body += [f'L{i}:', f'    LDI R{i % 8},L{i}', '    ADD R0,R1',
+                 '    DS hi']
+    source = '\n'.join(body) + '\n'
+
+    start = time.perf_counter()
+    asm.parse(io.StringIO(source), listing=True).text()
+    seconds = time.perf_counter() - start
+
+    return {'lines': lines, 'seconds': seconds, 'lines_per_second': lines / seconds}
+
+
+def run_all():
+    results = {'programs': {}, 'assembler': bench_assembler()}
+    for name, data in programs():
+        results['programs'][name] = {
+            engine: bench_program(data, engine) for engine in ENGINES
+        }
+    return results
+
+
+def compare(results, baseline):
+    '''
+    Return the benchmarks that got slower than the baseline, as
+    (name, old, new) instructions per second
+    '''
+    slower = []
+    for name, engines in results['programs'].items():
+        for engine, new in engines.items():
+            old = baseline.get('programs', {}).get(name, {}).get(engine)
+            if not old or 'error' in old or 'error' in new:
+                continue
+            if new['ips'] * REGRESSION < old['ips']:
+                slower.append((f'{name} [{engine}]', old['ips'], new['ips']))
+    old = baseline.get('assembler')
+    new = results['assembler']
+    if old and new['lines_per_second'] * REGRESSION < old['lines_per_second']:
+        slower.append(('assembler', old['lines_per_second'],
+                       new['lines_per_second']))
+    return slower
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results to compare against')
+    args = parser.parse_args(argv[1:])
+
+    results = run_all()
+
+    print(f"{'program':<22} {'engine':<12} {'instr/s':>12} {'startup us':>11}"
+          f" {'peak KB':>8}")
+    for name, engines in results['programs'].items():
+        for engine, r in engines.items():
+            if 'error' in r:
+                print(f"{name:<22} {engine:<12} {r['error']}")
+                continue
+            print(f"{name:<22} {engine:<12} {r['ips']:>12,.0f}"
+                  f" {r['startup_seconds'] * 1e6:>11.1f}"
+                  f" {r['peak_bytes'] / 1024:>8.1f}")
+    a = results['assembler']
+    print(f"assembler: {a['lines']} lines in {a['seconds']:.3f}s"
+          f" ({a['lines_per_second']:,.0f} lines/s)")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(results, json.load(f))
+        for name, old, new in slower:
+            print(f'REGRESSION {name}: {old:,.0f}/s -> {new:,.0f}/s')
+        return 1 if slower else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
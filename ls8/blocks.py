@@ -0,0 +1,403 @@
+"""Basic block compiler for the LS-8."""
+
+import re
+
+from cpu import *
+
+# Longest run of instructions compiled into one block
+MAX_BLOCK = 64
+# Shorter blocks are interpreted, a call to them costs more than it saves
+MIN_BLOCK = 3
+# Runs of a block's entry before it is compiled, code that runs once or
+# twice isn't worth compiling
+HOT = 8
+
+# Instructions that end a block after they run
+TERMINATORS = {CALL, HLT, IRET, JMP, RET}
+
+# Python expressions for the FL tests of the conditional jumps
+CONDITIONS = {
+    JEQ: f'cpu.fl & {FL_E}',
+    JNE: f'not cpu.fl & {FL_E}',
+    JGT: f'cpu.fl & {FL_G}',
+    JLT: f'cpu.fl & {FL_L}',
+    JLE: f'cpu.fl & {FL_L | FL_E}',
+    JGE: f'cpu.fl & {FL_G | FL_E}',
+}
+
+# Operators of the two register ALU instructions that can't overflow a byte
+BITWISE = {AND: '&', OR: '|', XOR: '^', SHR: '>>'}
+
+
+class Leave(Exception):
+    '''
+    Raised by a block that wrote over its own code, it left after running
+    only its first executed instructions
+    '''
+
+    def __init__(self, pc, executed):
+        self.pc = pc
+        self.executed = executed
+
+
+class BlockEngine:
+    '''
+    Runs a CPU by compiling straight-line runs of instructions (basic blocks)
+    into Python functions, so dispatch happens once per block instead of once
+    per instruction.
+
+    Code is interpreted until a block's entry has run HOT times, then the
+    block is compiled, unless it is shorter than MIN_BLOCK instructions.
+    Each block function holds the registers it uses in locals while it runs,
+    writes the ones it changes back to the CPU when it leaves and returns
+    the next PC. A block that writes over its own code raises Leave instead,
+    so only the instructions that ran are counted.
+    '''
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # Compiled block starting at each address
+        self.blocks = [None] * 256
+        # Number of instructions in each compiled block
+        self.lengths = [0] * 256
+        # Runs of each address as a block entry, up to HOT
+        self.heat = [0] * 256
+        # Addresses of the instructions in each compiled block
+        self.addresses = [()] * 256
+        # Start addresses of the compiled blocks covering each address
+        self.owners = [[] for _ in range(256)]
+        # Addresses of code that was written to after being compiled
+        self.dirty = bytearray(256)
+        # Route every memory write through us so stale blocks get dropped
+        cpu.ram_write = self.ram_write
+        cpu.code_changed = self.code_changed
+        # And have cpu.run() execute blocks
+        cpu.execute = self.execute
+
+    def ram_write(self, mar, mdr):
+        '''
+        Write to ram and drop any compiled block covering the address
+        '''
+        CPU.ram_write(self.cpu, mar, mdr)
+        owners = self.owners[mar]
+        if owners:
+            for start in owners:
+                self.blocks[start] = None
+                # May compile again, without the code that changed
+                self.heat[start] = 0
+            owners.clear()
+            # Code that changes at runtime is left to the interpreter
+            self.dirty[mar] = 1
+
+    def code_changed(self):
+        '''
+        Drop every compiled block after ram was replaced wholesale
+        '''
+        CPU.code_changed(self.cpu)
+        self.blocks[:] = [None] * 256
+        self.lengths[:] = [0] * 256
+        self.heat[:] = [0] * 256
+        self.addresses[:] = [()] * 256
+        for owners in self.owners:
+            owners.clear()
+        self.dirty[:] = bytes(256)
+
+    def find_block(self, start):
+        '''
+        Return the decoded instructions of the block starting at start as a
+        list of (address, ir, op_a, op_b, run_counter)
+        '''
+        ram = self.cpu.ram
+        instructions = []
+        address = start
+
+        # The pc wraps at the end of ram, a block stops there instead
+        while len(instructions) < MAX_BLOCK and address < 256:
+            ir = ram[address]
+            run_counter = (ir >> 6) + 1
+            # Stop before code that runs off the end of ram or has been
+            # written to
+            if address + run_counter > 256:
+                break
+            if any(self.dirty[address:address + run_counter]):
+                break
+            op_a = ram[address + 1] if run_counter > 1 else None
+            op_b = ram[address + 2] if run_counter > 2 else None
+            if bad_register(ir, op_a, op_b):
+                # Left to the interpreter, which faults on it
+                break
+            instructions.append((address, ir, op_a, op_b, run_counter))
+            address += run_counter
+            # Anything that sets the pc ends the block
+            if ir in TERMINATORS or (ir >> 4) & 0b1:
+                break
+
+        return instructions
+
+    def compile(self, start):
+        '''
+        Compile the block starting at start and cache it, returns None when
+        it is left to the interpreter
+        '''
+        self.heat[start] = HOT
+        instructions = self.find_block(start)
+        if len(instructions) < MIN_BLOCK:
+            return None
+
+        end = instructions[-1][0] + instructions[-1][4]
+        namespace = {'cpu': self.cpu, 'write': self.ram_write, 'Fault': Fault,
+                     'Leave': Leave, 'DIVIDE_BY_ZERO': DIVIDE_BY_ZERO,
+                     'blocks': self.blocks}
+        source = generate(start, end, instructions, namespace, self.cpu)
+        code = compile(source, f'<ls8 block {start:02X}>', 'exec')
+        exec(code, namespace)
+        block = namespace['block']
+
+        self.blocks[start] = block
+        self.lengths[start] = len(instructions)
+        self.addresses[start] = tuple(address for address, *_ in instructions)
+        for address in range(start, end):
+            self.owners[address].append(start)
+        return block
+
+    def precompile(self, leaders):
+        '''
+        Compile the blocks starting at leaders now instead of once they are
+        hot, e.g. the loops found by analyze.py
+        '''
+        for start in leaders:
+            if self.blocks[start] is None:
+                self.compile(start)
+
+    def execute(self, n):
+        '''
+        Execute up to n instructions a block at a time, returns the number
+        executed
+        '''
+        cpu = self.cpu
+        decoded = cpu.decoded
+        blocks = self.blocks
+        lengths = self.lengths
+        heat = self.heat
+        count = 0
+
+        while count < n:
+            start = cpu.pc
+            block = blocks[start]
+            if block is None and heat[start] < HOT:
+                heat[start] += 1
+                if heat[start] == HOT:
+                    block = self.compile(start)
+            try:
+                if block is not None and count + lengths[start] <= n:
+                    length = lengths[start]
+                    covered = self.addresses[start]
+                    count += length
+                    cpu.pc = block(cpu.register, cpu.ram)
+                    continue
+                # Not compiled, or not enough budget left for the whole
+                # block, interpret up to the next block or cold address
+                covered = ()
+                pc = start
+                while True:
+                    entry = decoded[pc]
+                    if entry is None:
+                        entry = cpu.decode(pc)
+                    if count + entry[5] > n:
+                        # Not enough budget left for the whole fused entry
+                        entry = cpu.decode_one(pc)
+                    handler, op_a, op_b, run_counter, set_pc, length = entry
+                    count += length
+                    handler(op_a, op_b)
+                    if set_pc:
+                        pc = cpu.pc
+                    else:
+                        pc = cpu.pc = (pc + run_counter) & 0xFF
+                    if count >= n or blocks[pc] is not None or heat[pc] < HOT:
+                        break
+            except Leave as e:
+                cpu.pc = e.pc
+                count += e.executed - length
+            except Break:
+                # Raised before the instruction ran
+                count -= length
+                break
+            except Stop:
+                break
+            except Fault as e:
+                # Only the instructions before the faulting one ran
+                ran = covered.index(cpu.pc) if covered else 0
+                e.executed = count - length + ran
+                raise
+
+        return count
+
+    def run(self, **kwargs):
+        '''
+        Run the CPU one block at a time, takes the same arguments as
+        CPU.run()
+        '''
+        return self.cpu.run(**kwargs)
+
+
+# Placeholder lines, replaced once the registers a block uses are known
+LOAD = 'LOAD'
+WRITEBACK = 'WRITEBACK'
+
+
+def generate(start, end, instructions, namespace, cpu):
+    '''
+    Generate the Python source of a block function
+    '''
+    lines = ['def block(reg, ram):', f'    {LOAD}']
+    writeback = WRITEBACK
+
+    def emit(line):
+        lines.append('    ' + line)
+
+    def store(address, value, check=True):
+        emit(f'addr = {address}')
+        emit(f'write(addr, {value})')
+        if not check:
+            return
+        # Writes into this very block have to leave it before the stale code
+        # runs, the engine has already dropped it
+        emit(f'if {start} <= addr < {end}:')
+        emit(f'    {writeback}')
+        emit(f'    raise Leave({next_pc & 0xFF}, {executed})')
+
+    def divide_by_zero(address, divisor):
+        emit(f'if r{divisor} == 0:')
+        emit(f'    {writeback}')
+        emit(f'    cpu.pc = {address}')
+        emit(f'    raise Fault(DIVIDE_BY_ZERO, {address}, r7)')
+
+    # Memory instructions go through the checking handlers when protected
+    protected = cpu.protection is not None
+
+    for executed, (address, ir, op_a, op_b, run_counter) in enumerate(
+            instructions, 1):
+        next_pc = address + run_counter
+
+        if ir == LDI:
+            emit(f'r{op_a} = {op_b}')
+        elif ir == ADD:
+            emit(f'r{op_a} = (r{op_a} + r{op_b}) & 0xFF')
+        elif ir == SUB:
+            emit(f'r{op_a} = (r{op_a} - r{op_b}) & 0xFF')
+        elif ir == MUL:
+            emit(f'r{op_a} = (r{op_a} * r{op_b}) & 0xFF')
+        elif ir == DIV:
+            divide_by_zero(address, op_b)
+            emit(f'r{op_a} = r{op_a} // r{op_b}')
+        elif ir == MOD:
+            divide_by_zero(address, op_b)
+            emit(f'r{op_a} = r{op_a} % r{op_b}')
+        elif ir == INC:
+            emit(f'r{op_a} = (r{op_a} + 1) & 0xFF')
+        elif ir == DEC:
+            emit(f'r{op_a} = (r{op_a} - 1) & 0xFF')
+        elif ir in BITWISE:
+            emit(f'r{op_a} = r{op_a} {BITWISE[ir]} r{op_b}')
+        elif ir == SHL:
+            emit(f'r{op_a} = (r{op_a} << r{op_b}) & 0xFF')
+        elif ir == NOT:
+            emit(f'r{op_a} = r{op_a} ^ 0xFF')
+        elif ir == CMP:
+            emit(f'if r{op_a} == r{op_b}:')
+            emit(f'    cpu.fl = {FL_E}')
+            emit(f'elif r{op_a} < r{op_b}:')
+            emit(f'    cpu.fl = {FL_L}')
+            emit('else:')
+            emit(f'    cpu.fl = {FL_G}')
+        elif ir == NOP:
+            pass
+        elif ir == LD and not protected:
+            emit(f'r{op_a} = ram[r{op_b}]')
+        elif ir == PRN:
+            emit(f"cpu.output.write(b'%d\\n' % r{op_a})")
+        elif ir == PRA:
+            emit(f'cpu.output.write(bytes((r{op_a},)))')
+        elif ir == PUSH and not protected:
+            emit('r7 = (r7 - 1) & 0xFF')
+            store('r7', f'r{op_a}')
+        elif ir == POP and not protected:
+            emit(f'r{op_a} = ram[r7]')
+            emit('r7 = (r7 + 1) & 0xFF')
+        elif ir == ST and not protected:
+            store(f'r{op_a}', f'r{op_b}')
+        elif ir == CALL and not protected:
+            emit('r7 = (r7 - 1) & 0xFF')
+            # The block ends here anyway
+            store('r7', next_pc & 0xFF, check=False)
+            emit(writeback)
+            emit(f'return r{op_a}')
+        elif ir == RET and not protected:
+            emit('pc = ram[r7]')
+            emit('r7 = (r7 + 1) & 0xFF')
+            emit(writeback)
+            emit('return pc')
+        elif ir == JMP:
+            emit(writeback)
+            emit(f'return r{op_a}')
+        elif ir in CONDITIONS:
+            emit(writeback)
+            emit(f'return r{op_a} if {CONDITIONS[ir]} else {next_pc & 0xFF}')
+        elif ir == HLT:
+            emit(writeback)
+            emit(f'cpu.pc = {address}')
+            emit('cpu.hlt()')
+            emit(f'return {address}')
+        else:
+            # Anything else goes through the interpreter's handler with the
+            # registers synced around the call
+            handler = f'h{address}'
+            namespace[handler] = cpu.decode_one(address)[0]
+            emit(writeback)
+            emit(f'cpu.pc = {address}')
+            emit(f'{handler}({op_a}, {op_b})')
+            if (ir >> 4) & 0b1:
+                emit('return cpu.pc')
+                break
+            if ir in (ST, PUSH):
+                # A protected write into this very block dropped it, leave
+                # before the stale code runs
+                emit(f'if blocks[{start}] is None:')
+                emit(f'    raise Leave({next_pc & 0xFF}, {executed})')
+            emit(LOAD)
+
+    else:
+        if ir not in TERMINATORS and not (ir >> 4) & 0b1:
+            # Fell off the end of a block that was cut short
+            emit(writeback)
+            emit(f'return {next_pc & 0xFF}')
+
+    return sync_registers(lines)
+
+
+def sync_registers(lines):
+    '''
+    Replace the placeholder lines with loads of the registers the block uses
+    and writebacks of the ones it changes, returns the source
+    '''
+    body = '\n'.join(lines)
+    used = sorted(set(re.findall(r'\br([0-7])\b', body)))
+    written = sorted(set(re.findall(r'\br([0-7]) = ', body)))
+    sync = {
+        LOAD: (used, '{names} = {items}'),
+        WRITEBACK: (written, '{items} = {names}'),
+    }
+    source = []
+    for line in lines:
+        placeholder = line.strip()
+        if placeholder not in sync:
+            source.append(line)
+            continue
+        registers, form = sync[placeholder]
+        if not registers:
+            continue
+        names = ', '.join(f'r{i}' for i in registers)
+        items = ', '.join(f'reg[{i}]' for i in registers)
+        indent = line[:len(line) - len(line.lstrip())]
+        source.append(indent + form.format(names=names, items=items))
+    return '\n'.join(source) + '\n'
@@ -1,82 +1,226 @@
 """CPU functionality."""
 
-import sys
-
-CALL = 0b01010000
-HLT = 0b00000001
-IRET = 0b00010011
-JMP = 0b01010100
-LDI = 0b10000010
-POP = 0b01000110
-PRA = 0b01001000
-PRN = 0b01000111
-PUSH = 0b01000101
-RET = 0b00010001
-ST = 0b10000100
-# ALU ops
-MUL = 0b10100010
-ADD = 0b10100000
-DIV = 0b10100011
-SUB = 0b10100001
+import io
+import time
+
+import image
+import symbols
+from devices import BufferedOutput, MemoryOutput
+from opcodes import *
+
+# FL bits
+FL_L = 0b100
+FL_G = 0b010
+FL_E = 0b001
+
+# Reserved registers
+IM = 5
+IS = 6
 SP = 7
 
+# Interrupts
+TIMER = 0
+KEYBOARD = 1
+# Most recent key pressed
+KEY_ADDRESS = 0xF4
+# Handler address of interrupt n is at VECTORS + n
+VECTORS = 0xF8
+# Instructions between checks for pending interrupts
+POLL = 1024
+
+# Longest instruction in bytes, a write to any of the bytes before an address
+# may land inside an instruction that was decoded there
+MAX_INSTRUCTION = 3
+# Files that are loaded as binary images instead of text
+BINARY_EXTENSIONS = ('.ls8b', '.bin')
+# Instructions run between checks of the cycle and time budgets
+SLICE = 4096
+
+# Why run() returned
+HALTED = 'halted'
+CYCLE_LIMIT = 'cycle limit'
+TIME_LIMIT = 'time limit'
+PAUSED = 'paused'
+FAULT = 'fault'
+
+# Kinds of Fault
+STACK_OVERFLOW = 'stack overflow'
+STACK_UNDERFLOW = 'stack underflow'
+READ_FAULT = 'read from protected memory'
+WRITE_FAULT = 'write to protected memory'
+DIVIDE_BY_ZERO = 'divide by zero'
+ILLEGAL_INSTRUCTION = 'illegal instruction'
+ILLEGAL_REGISTER = 'illegal register'
+
+
+class Stop(Exception):
+    """Raised by a handler to end the current slice of instructions."""
+
+
+class Break(Stop):
+    """Raised instead of running an instruction, ends the slice without
+    counting it."""
+
+
+class Fault(Exception):
+    """Raised when a program does something the machine doesn't allow."""
+
+    def __init__(self, kind, pc, sp, address=None):
+        # One of the kinds above
+        self.kind = kind
+        # Address of the faulting instruction and SP at the time
+        self.pc = pc
+        self.sp = sp
+        # Memory address involved, if any
+        self.address = address
+        # Instructions of the interrupted slice that ran before the fault,
+        # set by the engine running it
+        self.executed = 0
+        message = f'{kind} at PC={pc:02X} SP={sp:02X}'
+        if address is not None:
+            message += f' address={address:02X}'
+        super().__init__(message)
+
+    def describe(self, symbol_map):
+        '''
+        Return the message, with the label and source line of the faulting
+        instruction when symbol_map (see symbols.py) knows them
+        '''
+        where = symbol_map.locate(self.pc)
+        if where is None:
+            return str(self)
+        return f'{self} in {where}'
+
+
+class RunResult:
+    """What happened during a call to CPU.run()."""
+
+    def __init__(self, reason, cycles, output, pc, registers, fl, fault=None):
+        # One of HALTED, CYCLE_LIMIT, TIME_LIMIT, PAUSED or FAULT
+        self.reason = reason
+        # Instructions executed
+        self.cycles = cycles
+        # Output bytes when run() was asked to capture them, otherwise None
+        self.output = output
+        self.pc = pc
+        self.registers = registers
+        self.fl = fl
+        # The Fault that stopped the CPU, when reason is FAULT
+        self.fault = fault
+
+    @property
+    def halted(self):
+        return self.reason == HALTED
+
+    def __repr__(self):
+        return (f'RunResult(reason={self.reason!r}, cycles={self.cycles}, '
+                f'pc={self.pc})')
+
+
+def program_end(ram, top=KEY_ADDRESS):
+    '''
+    Return the address after the last non-zero byte below top
+    '''
+    end = top
+    while end > 0 and not ram[end - 1]:
+        end -= 1
+    return end
+
+
 class CPU:
     """Main CPU class."""
 
-    def __init__(self):
-        """Construct a new CPU."""
-        self.ram = [0] * 256
-        self.register = [0] * 8
+    def __init__(self, output=None, timer_cycles=None):
+        """Construct a new CPU.
+
+        The timer interrupt fires once a second of wall time, or once every
+        timer_cycles instructions when that is given, which makes interrupt
+        driven programs deterministic.
+        """
+        # Byte buffers, so every value is kept to 8 bits like the hardware
+        self.ram = bytearray(256)
+        self.register = bytearray(8)
         self.pc = 0
         self.fl = 0
         self.register[SP] = 0xF4
-        self.branchtable = {
-            CALL: self.call,
-            HLT : self.hlt,
-            IRET: self.iret,
-            JMP: self.jmp,
-            LDI : self.ldi,
-            POP : self.pop,
-            PRA: self.pra,
-            PRN : self.prn,
-            PUSH: self.push,
-            RET: self.ret,
-            ST: self.st,
-            MUL : self.alu,
-            ADD : self.alu,
-            DIV : self.alu,
-            SUB : self.alu
-        }
+        self.halted = False
+        # Set by a debugger to make run() return before the next instruction
+        self.paused = False
+        # Where PRN and PRA write, anything with write(bytes) and flush()
+        self.output = output if output is not None else BufferedOutput()
+        # Instructions executed over the life of the CPU
+        self.cycles = 0
+        # Label addresses, when the loaded image carries them
+        self.symbols = {}
+        # Names addresses in reports, filled in from a .map file next to
+        # the program when there is one (see symbols.py)
+        self.symbol_map = symbols.SymbolMap()
+        self.interrupts_enabled = True
+        # Cycle count at which run() next services interrupts
+        self.deadline = 0
+        self.timer_cycles = timer_cycles
+        # Cycle count (virtual time) or monotonic time of the next timer tick
+        self.next_timer = timer_cycles if timer_cycles is not None else None
+        # Handler of every opcode, indexed by the opcode itself
+        self.branchtable = dispatch_table(self, self.unsupported)
+        # Predecoded instructions, indexed by address
+        # Each entry is (handler, op_a, op_b, run_counter, set_pc,
+        # instructions), instructions is more than 1 for fused entries
+        self.decoded = [None] * 256
+        # Most bytes a decoded entry covers
+        self.decode_span = MAX_INSTRUCTION
+        # Most instructions a decoded entry runs
+        self.max_fused = 1
+        # Runs up to n instructions and returns how many ran, other engines
+        # swap themselves in here
+        self.execute = self.interpret
+        # Memory protection in force, see protection.py
+        self.protection = None
+        # Called with the RunResult whenever run() returns
+        self.on_stop = []
     
     def call(self, op_a, op_b=None):
         '''
         Calls a subroutine(function) at address stored in register[op_a]
         '''
         # Decriment SP
-        self.register[SP] -= 1
-        self.ram_write(self.register[SP], self.pc + 2)
+        self.register[SP] = (self.register[SP] - 1) & 0xFF
+        self.ram_write(self.register[SP], (self.pc + 2) & 0xFF)
         self.pc = self.register[op_a]
     
     # No operands but again was cleaner to pass as unused paramters here
     def hlt(self, op_a=None, op_b=None):
         '''
-        Halt cpu and exit emulator
+        Halt cpu, run() returns
         '''
-        sys.exit()
+        self.halted = True
+        raise Stop
 
     def iret(self, op_a, op_b=None):
         '''
         Return from interrupt
         '''
         # Pop R6-R0 off the stack in that order
-        for i in (6, -1, -1):
-            self.register[i] = self.ram_read(self.register[SP])
-            self.register[SP] += 1
-        # TODO: FL register is popped off the stack
-
-        # TODO: Return address is popped of the stack and stored in PC
+        for i in range(6, -1, -1):
+            self.register[i] = self.stack_pop()
+        # FL register is popped off the stack
+        self.fl = self.stack_pop()
+        # Return address is popped of the stack and stored in PC
+        self.pc = self.stack_pop()
+        # Re-enable interrupts, anything pending is serviced right away
+        self.interrupts_enabled = True
+        self.deadline = 0
+        raise Stop
 
-        # TODO: Re-enable interrupts
+    def int(self, op_a, op_b=None):
+        '''
+        Issue the interrupt number stored in register[op_a]
+        '''
+        self.register[IS] |= 1 << (self.register[op_a] & 0b111)
+        self.pc = (self.pc + 2) & 0xFF
+        # Serviced before the next instruction
+        self.deadline = 0
+        raise Stop
     
     def jmp(self, op_a, op_b=None):
         '''
@@ -84,12 +228,52 @@ class CPU:
         '''
         self.pc = self.register[op_a]
     
+    def jump_if(self, condition, op_a):
+        '''
+        Jump to the address stored in register[op_a] if condition holds,
+        otherwise carry on with the next instruction
+        '''
+        if condition:
+            self.pc = self.register[op_a]
+        else:
+            self.pc = (self.pc + 2) & 0xFF
+
+    def jeq(self, op_a, op_b=None):
+        self.jump_if(self.fl & FL_E, op_a)
+
+    def jne(self, op_a, op_b=None):
+        self.jump_if(not self.fl & FL_E, op_a)
+
+    def jgt(self, op_a, op_b=None):
+        self.jump_if(self.fl & FL_G, op_a)
+
+    def jlt(self, op_a, op_b=None):
+        self.jump_if(self.fl & FL_L, op_a)
+
+    def jle(self, op_a, op_b=None):
+        self.jump_if(self.fl & (FL_L | FL_E), op_a)
+
+    def jge(self, op_a, op_b=None):
+        self.jump_if(self.fl & (FL_G | FL_E), op_a)
+
+    def ld(self, op_a, op_b):
+        '''
+        Load register[op_a] with the value at the address stored in
+        register[op_b]
+        '''
+        self.register[op_a] = self.ram_read(self.register[op_b])
+
     def ldi(self, op_a, op_b):
         '''
         Set the value of register[op_a] to op_b
         '''
         self.register[op_a] = op_b 
     
+    def nop(self, op_a=None, op_b=None):
+        '''
+        Do nothing
+        '''
+
     def pop(self, op_a, op_b=None):
         '''
         Pop the value at the top of the stack into register[op_a]
@@ -99,28 +283,29 @@ class CPU:
         # Set register at address given to value
         self.register[op_a] = value
         # Increment SP
-        self.register[SP] += 1
+        self.register[SP] = (self.register[SP] + 1) & 0xFF
         return value
       
     def pra(self, op_a, op_b=None):
         '''
         Print alpha character value stored in the given register
         '''
-        print(chr(self.register[op_a]))
+        # The raw byte, no newline
+        self.output.write(bytes((self.register[op_a],)))
         
     # Only one operand but was cleaner to just pass them as unused parameters here
     def prn(self, op_a, op_b=None):
         '''
         Print numeric value stored in register[op_a]
         '''
-        print(self.register[op_a])
+        self.output.write(b'%d\n' % self.register[op_a])
 
     def push(self, op_a, op_b=None):
         '''
         Push the value in the register[op_a] onto the stack
         '''
         # Decriment SP
-        self.register[SP] -= 1
+        self.register[SP] = (self.register[SP] - 1) & 0xFF
         # Write value given to ram at SP address
         self.ram_write(self.register[SP], self.register[op_a])
     
@@ -129,7 +314,7 @@ class CPU:
         Return from subroutine
         '''
         self.pc = self.ram_read(self.register[SP])
-        self.register[SP] += 1
+        self.register[SP] = (self.register[SP] + 1) & 0xFF
 
     def st(self, op_a, op_b):
         '''
@@ -141,40 +326,130 @@ class CPU:
     def load(self, filename):
         """Load a program into memory."""
 
-        # Counter
-        address = 0
-
-        # Open ls8 file
-        with open(filename) as f:
-            # Read each line
-            for line in f:
-                # Split on # to remove comments
-                line = line.split('#')
-                # Remove empty spaces
-                line = line[0].strip()
-                if line == '':
-                    continue
-                # Convert to int (base 2 binary) and save to ram at address
-                self.ram[address] = int(line, 2)
-                # Incriment address counter
-                address += 1
+        if filename.endswith(BINARY_EXTENSIONS) or image.is_image(filename):
+            self.load_image(filename)
+        else:
+            # Open ls8 file
+            with open(filename) as f:
+                program = image.parse_text(f)
+            if len(program) > len(self.ram):
+                raise image.ImageError(f'program does not fit in {len(self.ram)} bytes')
+            self.ram[:len(program)] = program
+            self.symbol_map = symbols.SymbolMap()
+
+            # Anything decoded before the load is stale now
+            self.code_changed()
+
+        # Labels and source lines, when the assembler left a map
+        symbol_map = symbols.read_map(symbols.map_path(filename), self.ram)
+        if symbol_map is not None:
+            self.symbol_map = symbol_map
+            if not self.symbols:
+                self.symbols = dict(symbol_map.symbols)
+
+    def load_image(self, filename):
+        '''
+        Load a binary image (see image.py) straight into ram
+        '''
+        with open(filename, 'rb') as f:
+            self.load_stream(f)
+
+    def load_bytes(self, data):
+        '''
+        Load a binary image held in memory
+        '''
+        self.load_stream(io.BytesIO(data))
+
+    def load_stream(self, f):
+        '''
+        Load a binary image from an open binary file
+        '''
+        header = image.load_into(f, self.ram)
+
+        if header is not None:
+            self.pc = header.entry
+            self.symbols = header.symbols
+            self.symbol_map = symbols.SymbolMap(header.symbols)
+
+        self.code_changed()
+
+    def code_changed(self):
+        '''
+        Forget every decoded instruction, for when ram was replaced without
+        going through ram_write
+        '''
+        self.decoded[:] = [None] * 256
 
     def alu(self, op, reg_a, reg_b):
         """ALU operations."""
 
-        if op == ADD:
-            self.register[reg_a] += self.register[reg_b]
-        elif op == SUB:
-            self.register[reg_a] -= self.register[reg_b]
-        elif op == MUL:
-            self.register[reg_a] *= self.register[reg_b]
-        elif op == DIV:
-            if self.register[reg_b] != 0:
-                self.register[reg_a] /= self.register[reg_b]
-            else:
-                raise Exception("Cannot divide by 0")
+        # Each operation has its own handler in the branchtable
+        self.branchtable[op](reg_a, reg_b)
+
+    # Results are kept to 8 bits by the register bytearray, masked first
+    def add(self, reg_a, reg_b):
+        reg = self.register
+        reg[reg_a] = (reg[reg_a] + reg[reg_b]) & 0xFF
+
+    def sub(self, reg_a, reg_b):
+        reg = self.register
+        reg[reg_a] = (reg[reg_a] - reg[reg_b]) & 0xFF
+
+    def mul(self, reg_a, reg_b):
+        reg = self.register
+        reg[reg_a] = (reg[reg_a] * reg[reg_b]) & 0xFF
+
+    def div(self, reg_a, reg_b):
+        reg = self.register
+        if reg[reg_b] == 0:
+            raise Fault(DIVIDE_BY_ZERO, self.pc, reg[SP])
+        reg[reg_a] //= reg[reg_b]
+
+    def mod(self, reg_a, reg_b):
+        reg = self.register
+        if reg[reg_b] == 0:
+            raise Fault(DIVIDE_BY_ZERO, self.pc, reg[SP])
+        reg[reg_a] %= reg[reg_b]
+
+    def inc(self, reg_a, reg_b=None):
+        reg = self.register
+        reg[reg_a] = (reg[reg_a] + 1) & 0xFF
+
+    def dec(self, reg_a, reg_b=None):
+        reg = self.register
+        reg[reg_a] = (reg[reg_a] - 1) & 0xFF
+
+    def and_(self, reg_a, reg_b):
+        self.register[reg_a] &= self.register[reg_b]
+
+    def or_(self, reg_a, reg_b):
+        self.register[reg_a] |= self.register[reg_b]
+
+    def xor(self, reg_a, reg_b):
+        self.register[reg_a] ^= self.register[reg_b]
+
+    def not_(self, reg_a, reg_b=None):
+        self.register[reg_a] ^= 0xFF
+
+    def shl(self, reg_a, reg_b):
+        reg = self.register
+        reg[reg_a] = (reg[reg_a] << reg[reg_b]) & 0xFF
+
+    def shr(self, reg_a, reg_b):
+        self.register[reg_a] >>= self.register[reg_b]
+
+    def cmp(self, reg_a, reg_b):
+        '''
+        Set FL to 00000LGE comparing register[reg_a] with register[reg_b]
+        '''
+        a = self.register[reg_a]
+        b = self.register[reg_b]
+        if a == b:
+            self.fl = FL_E
+        elif a < b:
+            self.fl = FL_L
         else:
-            raise Exception("Unsupported ALU operation")
+            self.fl = FL_G
 
     def ram_read(self, mar):
         '''
@@ -188,38 +463,263 @@ class CPU:
         Stores 'value' (MDR) at given 'address' (MAR) in ram
         '''
         self.ram[mar] = mdr
+        # Drop any predecoded instruction that covers this address
+        decoded = self.decoded
+        for address in range(mar - self.decode_span + 1, mar + 1):
+            decoded[address & 0xFF] = None
 
-    def run(self):
+    def decode(self, pc):
         '''
-        Run the CPU
+        Decode the instruction at pc and cache it for the next visit
         '''
+        entry = self.decode_one(pc)
+        self.decoded[pc] = entry
+        return entry
 
-        # TODO: Include interupt handler
-        
-        while True:
-            # Get opcodes and operands
-            ir = self.ram[self.pc]
-            op_a = self.ram_read(self.pc + 1)
-            op_b = self.ram_read(self.pc + 2)
-            # To update self.pc counter
-            run_counter = (ir >> 6) + 1
-            # To handle alu operations
-            # NOTE: Less code but adds another if statement, may be quicker to implement
-                  # individual helper functions that call ALU with specified operations
-            alu_op = bool(((ir >> 5) & 0b1))
-            # To handle ops that set pc
-            set_pc = ((ir >> 4) & 0b1)
-    
-            if ir in self.branchtable:
-                if alu_op:
-                    self.branchtable[ir](ir, op_a, op_b)
-                else:
-                    self.branchtable[ir](op_a, op_b)
-            else:
-                print('Unsupported operation')
-            if not set_pc:
-                self.pc += run_counter
-    
+    def decode_one(self, pc):
+        '''
+        Decode the single instruction at pc without caching it, for when a
+        fused entry has to run one instruction at a time
+        '''
+        # Get opcodes and operands
+        ir = self.ram[pc]
+        op_a = self.ram_read((pc + 1) & 0xFF)
+        op_b = self.ram_read((pc + 2) & 0xFF)
+        # To update self.pc counter
+        run_counter = (ir >> 6) + 1
+        # To handle ops that set pc
+        set_pc = ((ir >> 4) & 0b1)
+
+        handler = self.branchtable[ir]
+        if bad_register(ir, op_a, op_b):
+            handler = self.illegal_register
+
+        return (handler, op_a, op_b, run_counter, set_pc, 1)
+
+    def unsupported(self, op_a=None, op_b=None):
+        '''
+        Handler for opcodes that aren't in the instruction set
+        '''
+        raise Fault(ILLEGAL_INSTRUCTION, self.pc, self.register[SP], self.pc)
+
+    def illegal_register(self, op_a=None, op_b=None):
+        '''
+        Handler for instructions naming a register past R7
+        '''
+        raise Fault(ILLEGAL_REGISTER, self.pc, self.register[SP], self.pc)
+
+    def interpret(self, n):
+        '''
+        Execute up to n instructions, returns the number executed
+        '''
+        decoded = self.decoded
+        count = 0
+        # Any entry fits in the budget up to here
+        limit = n - self.max_fused + 1
+
+        try:
+            while count < limit:
+                # Decode only on the first visit to an address
+                entry = decoded[self.pc]
+                if entry is None:
+                    entry = self.decode(self.pc)
+                handler, op_a, op_b, run_counter, set_pc, instructions = entry
+
+                handler(op_a, op_b)
+                if not set_pc:
+                    self.pc = (self.pc + run_counter) & 0xFF
+                count += instructions
+            while count < n:
+                # Fused entries that don't fit run one instruction at a time
+                entry = decoded[self.pc]
+                if entry is None:
+                    entry = self.decode(self.pc)
+                if count + entry[5] > n:
+                    entry = self.decode_one(self.pc)
+                handler, op_a, op_b, run_counter, set_pc, instructions = entry
+
+                handler(op_a, op_b)
+                if not set_pc:
+                    self.pc = (self.pc + run_counter) & 0xFF
+                count += instructions
+        except Break:
+            # Nothing ran
+            pass
+        except Stop:
+            # The handler that stopped us still ran
+            count += 1
+        except Fault as e:
+            e.executed = count
+            raise
+
+        return count
+
+    def run(self, max_cycles=None, max_seconds=None, capture=False):
+        '''
+        Run the CPU until it halts or runs out of budget
+
+        max_cycles limits the number of instructions executed and max_seconds
+        the wall time, both are checked between slices of instructions. With
+        capture the output of this run is collected into the result instead
+        of going to the output device. A Fault ends the run with reason
+        FAULT instead of propagating.
+
+        Returns a RunResult.
+        '''
+
+        self.halted = False
+        self.paused = False
+        cycles = 0
+        reason = None
+        fault = None
+        if max_seconds is not None:
+            stop_time = time.monotonic() + max_seconds
+        if self.timer_cycles is None and self.next_timer is None:
+            self.next_timer = time.monotonic() + 1
+        if capture:
+            device = self.output
+            self.output = MemoryOutput()
+
+        try:
+            while True:
+                # Interrupts are only looked at when a deadline comes up
+                if self.cycles >= self.deadline:
+                    self.service_interrupts()
+
+                n = min(SLICE, self.deadline - self.cycles)
+                if max_cycles is not None:
+                    n = min(n, max_cycles - cycles)
+                    if n <= 0:
+                        reason = CYCLE_LIMIT
+                        break
+
+                ran = self.execute(n)
+                cycles += ran
+                self.cycles += ran
+
+                if self.halted:
+                    reason = HALTED
+                    break
+                if self.paused:
+                    reason = PAUSED
+                    break
+                if max_seconds is not None and time.monotonic() >= stop_time:
+                    reason = TIME_LIMIT
+                    break
+        except Fault as e:
+            # The faulting instruction itself isn't counted
+            cycles += e.executed
+            self.cycles += e.executed
+            reason = FAULT
+            fault = e
+        finally:
+            self.output.flush()
+            if capture:
+                captured = self.output.getvalue()
+                self.output = device
+
+        result = RunResult(
+            reason,
+            cycles,
+            captured if capture else None,
+            self.pc,
+            bytes(self.register),
+            self.fl,
+            fault
+        )
+        for hook in self.on_stop:
+            hook(result)
+        return result
+
+    def service_interrupts(self):
+        '''
+        Raise the timer interrupt if it is due, start the handler of the
+        lowest pending interrupt and set the next deadline
+        '''
+        now = self.cycles
+        self.deadline = now + POLL
+
+        if self.timer_cycles is not None:
+            # Virtual time, the timer is a cycle deadline of its own
+            if now >= self.next_timer:
+                self.register[IS] |= 1 << TIMER
+                while self.next_timer <= now:
+                    self.next_timer += self.timer_cycles
+            self.deadline = min(self.deadline, self.next_timer)
+        else:
+            t = time.monotonic()
+            if t >= self.next_timer:
+                self.register[IS] |= 1 << TIMER
+                # One tick however long the host stalled, skip the missed ones
+                while self.next_timer <= t:
+                    self.next_timer += 1
+
+        if not self.interrupts_enabled or self.halted:
+            return
+        masked = self.register[IM] & self.register[IS]
+        if not masked:
+            return
+
+        if self.timer_cycles is None:
+            # Someone may be watching in real time, show what came before
+            self.output.flush()
+
+        # Lowest numbered interrupt first
+        n = (masked & -masked).bit_length() - 1
+        self.interrupts_enabled = False
+        self.register[IS] &= ~(1 << n) & 0xFF
+        self.stack_push(self.pc)
+        self.stack_push(self.fl)
+        for i in range(7):
+            self.stack_push(self.register[i])
+        self.pc = self.ram_read(VECTORS + n)
+
+    def raise_interrupt(self, n):
+        '''
+        Raise interrupt n from outside the CPU, it is serviced when run()
+        next looks at interrupts
+        '''
+        self.register[IS] |= 1 << n
+        self.deadline = self.cycles
+
+    def press_key(self, key):
+        '''
+        Store a key press where programs expect it and raise the keyboard
+        interrupt
+        '''
+        self.ram_write(KEY_ADDRESS, key)
+        self.raise_interrupt(KEYBOARD)
+
+    def stack_push(self, value):
+        '''
+        Push a value onto the stack
+        '''
+        self.register[SP] = (self.register[SP] - 1) & 0xFF
+        self.ram_write(self.register[SP], value)
+
+    def stack_pop(self):
+        '''
+        Pop the value at the top of the stack
+        '''
+        value = self.ram_read(self.register[SP])
+        self.register[SP] = (self.register[SP] + 1) & 0xFF
+        return value
+
+    def copy(self):
+        '''
+        Return a new CPU in the same state as this one
+        '''
+        other = CPU(self.output, self.timer_cycles)
+        # Single buffer copies
+        other.ram[:] = self.ram
+        other.register[:] = self.register
+        other.pc = self.pc
+        other.fl = self.fl
+        other.cycles = self.cycles
+        other.interrupts_enabled = self.interrupts_enabled
+        other.deadline = self.deadline
+        other.next_timer = self.next_timer
+        return other
 
     def trace(self):
         """
@@ -227,16 +727,16 @@ class CPU:
         from run() if you need help debugging.
         """
 
-        print(f"TRACE: %02X | %02X %02X %02X |" % (
+        print(f"TRACE: %02X | %02X | %02X %02X %02X |" % (
             self.pc,
-            #self.fl,
+            self.fl,
             #self.ie,
             self.ram_read(self.pc),
-            self.ram_read(self.pc + 1),
-            self.ram_read(self.pc + 2)
+            self.ram_read((self.pc + 1) & 0xFF),
+            self.ram_read((self.pc + 2) & 0xFF)
         ), end='')
 
         for i in range(8):
-            print(" %02X" % self.reg[i], end='')
+            print(" %02X" % self.register[i], end='')
 
         print()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+
+"""Debugger for the LS-8, with breakpoints, watchpoints and single-step."""
+
+import cmd
+import operator
+import re
+import sys
+
+from cpu import *
+
+'''
+Usage:
+
+python(3) debugger.py examples/call.ls8 -> debugger prompt, try help
+
+Or from Python:
+
+    cpu = CPU()
+    cpu.load('examples/call.ls8')
+    debugger = Debugger(cpu)
+    debugger.add_breakpoint(0x18)
+    debugger.cont()          # RunResult with reason PAUSED
+    debugger.step()
+'''
+
+# Comparisons allowed in register conditions
+COMPARISONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+class Debugger:
+    '''
+    Stops a CPU at PC breakpoints, on writes to watched addresses and when
+    register conditions become true.
+
+    Nothing is added to the interpreter loop. A breakpoint replaces the
+    predecoded entry at its address with one that pauses the CPU, so only
+    that address pays for it. Watchpoints and conditions need a look after
+    every instruction, so while any are set the CPU's ram_write and execute
+    are swapped for checking versions, and put back when the last one is
+    removed.
+
+    Breakpoints work with engines that run predecoded entries (the
+    interpreter and the profiler). The block engine only sees them at
+    addresses it interprets.
+    '''
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        # Addresses to stop at
+        self.breakpoints = set()
+        # Addresses whose writes stop the CPU
+        self.watchpoints = set()
+        # Description -> predicate called with the CPU after each instruction
+        self.conditions = {}
+        # Why the CPU last paused
+        self.reason = None
+        # Breakpoint address to run through once when resuming from it
+        self.skip = None
+        # Real decoded entry under each breakpoint
+        self.real = {}
+        # Writes to watched addresses during the current instruction
+        self.writes = []
+        # What gets swapped out
+        self.next_decode = cpu.decode
+        self.next_write = cpu.ram_write
+        self.engine = cpu.execute
+        cpu.decode = self.decode
+
+    def decode(self, pc):
+        '''
+        Decode pc as usual, then cover breakpoints with a pausing entry
+        '''
+        entry = self.next_decode(pc)
+        if pc not in self.breakpoints:
+            return entry
+        self.real[pc] = entry
+        entry = (self.hit, pc, None, 0, 1, 1)
+        self.cpu.decoded[pc] = entry
+        return entry
+
+    def hit(self, pc, op_b=None):
+        '''
+        Handler of a breakpoint entry, pauses the CPU unless we are resuming
+        from this breakpoint
+        '''
+        cpu = self.cpu
+        if self.skip != pc:
+            self.pause(f'breakpoint at {self.describe(pc)}')
+            raise Break
+        self.skip = None
+        entry = self.real[pc]
+        if entry[5] > 1:
+            # Step off the breakpoint one instruction at a time
+            entry = cpu.decode_one(pc)
+        handler, op_a, op_b, run_counter, set_pc, instructions = entry
+        handler(op_a, op_b)
+        if not set_pc:
+            cpu.pc = (pc + run_counter) & 0xFF
+
+    def pause(self, reason):
+        self.reason = reason
+        self.cpu.paused = True
+
+    def forget(self, address):
+        '''
+        Drop decoded entries covering address so they are decoded again
+        '''
+        decoded = self.cpu.decoded
+        for start in range(address - self.cpu.decode_span + 1, address + 1):
+            decoded[start & 0xFF] = None
+
+    def add_breakpoint(self, address):
+        self.breakpoints.add(address)
+        self.forget(address)
+
+    def remove_breakpoint(self, address):
+        self.breakpoints.discard(address)
+        self.real.pop(address, None)
+        self.forget(address)
+
+    def add_watchpoint(self, address):
+        self.watchpoints.add(address)
+        self.update()
+
+    def remove_watchpoint(self, address):
+        self.watchpoints.discard(address)
+        self.update()
+
+    def break_when(self, description, predicate):
+        '''
+        Pause after any instruction that leaves predicate(cpu) true
+        '''
+        self.conditions[description] = predicate
+        self.update()
+
+    def break_on_change(self, register):
+        '''
+        Pause after any instruction that changes register
+        '''
+        last = self.cpu.register[register]
+
+        def changed(cpu):
+            nonlocal last
+            value = cpu.register[register]
+            if value == last:
+                return False
+            last = value
+            return True
+
+        self.break_when(f'R{register} changes', changed)
+
+    def remove_condition(self, description):
+        self.conditions.pop(description, None)
+        self.update()
+
+    def update(self):
+        '''
+        Swap the checking ram_write and execute in or out
+        '''
+        cpu = self.cpu
+        cpu.ram_write = self.ram_write if self.watchpoints else self.next_write
+        checking = self.watchpoints or self.conditions
+        cpu.execute = self.execute if checking else self.engine
+
+    def ram_write(self, mar, mdr):
+        '''
+        Write to ram, noting writes to watched addresses
+        '''
+        self.next_write(mar, mdr)
+        if mar in self.watchpoints:
+            self.writes.append((mar, mdr))
+
+    def check(self):
+        '''
+        Pause if the last instruction hit a watchpoint or a condition
+        '''
+        if self.writes:
+            mar, mdr = self.writes[0]
+            self.writes.clear()
+            self.pause(f'write of {mdr:02X} to {self.describe(mar)}')
+            return True
+        for description, predicate in self.conditions.items():
+            if predicate(self.cpu):
+                self.pause(description)
+                return True
+        return False
+
+    def execute(self, n):
+        '''
+        Execute up to n instructions like CPU.interpret, checking watchpoints
+        and conditions after each one
+        '''
+        cpu = self.cpu
+        decoded = cpu.decoded
+        count = 0
+
+        while count < n:
+            entry = decoded[cpu.pc]
+            if entry is None:
+                entry = cpu.decode(cpu.pc)
+            if count + entry[5] > n:
+                # Not enough budget left for the whole fused entry
+                entry = cpu.decode_one(cpu.pc)
+            handler, op_a, op_b, run_counter, set_pc, instructions = entry
+
+            try:
+                handler(op_a, op_b)
+            except Break:
+                break
+            except Stop:
+                count += 1
+                self.check()
+                break
+            except Fault as e:
+                e.executed = count
+                raise
+            if not set_pc:
+                cpu.pc = (cpu.pc + run_counter) & 0xFF
+            count += instructions
+            if self.check():
+                break
+
+        return count
+
+    def cont(self, max_cycles=None):
+        '''
+        Run until the CPU halts, pauses or runs max_cycles instructions,
+        returns the RunResult
+        '''
+        cpu = self.cpu
+        self.reason = None
+        if cpu.pc in self.breakpoints:
+            # We are sitting on it, run the instruction this time
+            self.skip = cpu.pc
+        result = cpu.run(max_cycles=max_cycles)
+        self.skip = None
+        return result
+
+    def step(self, n=1):
+        '''
+        Run n instructions, or fewer if the CPU halts or pauses
+        '''
+        return self.cont(max_cycles=n)
+
+    def describe(self, address):
+        '''
+        Return address in hex, with its label+offset and source line when
+        they are known
+        '''
+        return self.cpu.symbol_map.describe(address)
+
+    def state(self):
+        '''
+        Return the PC, FL, the bytes at PC and the registers as one line
+        '''
+        cpu = self.cpu
+        ram = cpu.ram
+        pc = cpu.pc
+        name = OPCODE_NAMES.get(ram[pc], '???')
+        registers = ' '.join(f'R{i}={value:02X}'
+                             for i, value in enumerate(cpu.register))
+        return (f'PC={pc:02X} FL={cpu.fl:03b} | {ram[pc]:02X} '
+                f'{ram[(pc + 1) & 0xFF]:02X} {ram[(pc + 2) & 0xFF]:02X} '
+                f'{name:<4} | {registers}')
+
+
+class DebuggerShell(cmd.Cmd):
+    '''
+    Command prompt for a Debugger
+    '''
+
+    prompt = '(ls8) '
+
+    def __init__(self, debugger):
+        super().__init__()
+        self.debugger = debugger
+        self.cpu = debugger.cpu
+        self.intro = 'LS-8 debugger, type help for commands\n' + debugger.state()
+
+    def address(self, arg):
+        '''
+        Parse an address given as a label, hex (0x1F) or decimal
+        '''
+        arg = arg.strip()
+        if arg.upper() in self.cpu.symbols:
+            return self.cpu.symbols[arg.upper()]
+        try:
+            value = int(arg, 0)
+        except ValueError:
+            raise ValueError(f'bad address {arg!r}')
+        if not 0 <= value <= 0xFF:
+            raise ValueError(f'address {arg!r} out of range')
+        return value
+
+    def onecmd(self, line):
+        try:
+            return super().onecmd(line)
+        except ValueError as e:
+            print(e)
+
+    def show(self, result):
+        debugger = self.debugger
+        if result.reason == PAUSED:
+            print(f'Paused: {debugger.reason}')
+        elif result.reason == HALTED:
+            print(f'Halted after {result.cycles} instructions')
+        elif result.reason == FAULT:
+            print(f'Fault: {result.fault.describe(self.cpu.symbol_map)}')
+        print(debugger.state())
+
+    def do_break(self, arg):
+        '''break ADDRESS: stop before the instruction at ADDRESS'''
+        if not arg:
+            for address in sorted(self.debugger.breakpoints):
+                print(self.debugger.describe(address))
+            return
+        self.debugger.add_breakpoint(self.address(arg))
+
+    def do_delete(self, arg):
+        '''delete ADDRESS: remove the breakpoint at ADDRESS'''
+        self.debugger.remove_breakpoint(self.address(arg))
+
+    def do_watch(self, arg):
+        '''watch ADDRESS: stop after any write to ADDRESS'''
+        if not arg:
+            for address in sorted(self.debugger.watchpoints):
+                print(self.debugger.describe(address))
+            return
+        self.debugger.add_watchpoint(self.address(arg))
+
+    def do_unwatch(self, arg):
+        '''unwatch ADDRESS: remove the watchpoint on ADDRESS'''
+        self.debugger.remove_watchpoint(self.address(arg))
+
+    def do_when(self, arg):
+        '''when Rn changes | when Rn OP VALUE: stop once the condition holds,
+        OP is one of == != < <= > >='''
+        if not arg:
+            for description in self.debugger.conditions:
+                print(description)
+            return
+        m = re.fullmatch(r'\s*R([0-7])\s+changes\s*', arg, re.I)
+        if m:
+            self.debugger.break_on_change(int(m.group(1)))
+            return
+        m = re.fullmatch(r'\s*R([0-7])\s*(==|!=|<=|>=|<|>)\s*(\w+)\s*', arg, re.I)
+        if m is None:
+            raise ValueError(f'bad condition {arg!r}')
+        register = int(m.group(1))
+        compare = COMPARISONS[m.group(2)]
+        value = self.address(m.group(3))
+        self.debugger.break_when(
+            f'R{register} {m.group(2)} {value:02X}',
+            lambda cpu: compare(cpu.register[register], value))
+
+    def do_unless(self, arg):
+        '''unless CONDITION: remove a condition, as listed by when'''
+        self.debugger.remove_condition(arg.strip())
+
+    def do_step(self, arg):
+        '''step [N]: run N instructions, one by default'''
+        self.show(self.debugger.step(int(arg) if arg else 1))
+
+    def do_continue(self, arg):
+        '''continue: run until a breakpoint, watchpoint or condition'''
+        self.show(self.debugger.cont())
+
+    def do_regs(self, arg):
+        '''regs: show the PC, FL, current instruction and registers'''
+        print(self.debugger.state())
+
+    def do_mem(self, arg):
+        '''mem ADDRESS [COUNT]: dump COUNT bytes of ram, 16 by default'''
+        parts = arg.split()
+        if not parts:
+            raise ValueError('mem needs an address')
+        start = self.address(parts[0])
+        count = int(parts[1], 0) if len(parts) > 1 else 16
+        ram = self.cpu.ram
+        for row in range(start, min(start + count, 256), 16):
+            values = ' '.join(f'{ram[address]:02X}'
+                              for address in range(row, min(row + 16, start + count, 256)))
+            print(f'{row:02X}: {values}')
+
+    def do_quit(self, arg):
+        '''quit: leave the debugger'''
+        return True
+
+    do_b = do_break
+    do_s = do_step
+    do_c = do_continue
+    do_q = do_quit
+    do_EOF = do_quit
+
+
+def main(argv):
+    if len(argv) != 2:
+        print('usage: debugger.py program.ls8', file=sys.stderr)
+        return 1
+    cpu = CPU()
+    cpu.load(argv[1])
+    DebuggerShell(Debugger(cpu)).cmdloop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,71 @@
+"""Output devices for the LS-8."""
+
+import sys
+
+# Bytes held by a BufferedOutput before it writes them out
+BUFFER_SIZE = 4096
+
+
+class BufferedOutput:
+    '''
+    Collects output bytes and writes them to a binary stream in chunks
+
+    The stream defaults to stdout, looked up when flushing so it follows
+    any redirection of sys.stdout.
+    '''
+
+    def __init__(self, stream=None, size=BUFFER_SIZE):
+        self.stream = stream
+        self.size = size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        stream = self.stream
+        if stream is None:
+            stream = getattr(sys.stdout, 'buffer', None)
+        if stream is None:
+            # A text stream without a binary buffer, e.g. io.StringIO
+            sys.stdout.write(self.buffer.decode('latin-1'))
+            sys.stdout.flush()
+        else:
+            stream.write(self.buffer)
+            stream.flush()
+        self.buffer.clear()
+
+    def pending(self):
+        """Bytes written but not flushed yet."""
+        return bytes(self.buffer)
+
+    def restore(self, data):
+        self.buffer[:] = data
+
+
+class MemoryOutput:
+    '''
+    Keeps all output in memory, for batch runs and tests
+    '''
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, data):
+        self.data += data
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return bytes(self.data)
+
+    def pending(self):
+        return bytes(self.data)
+
+    def restore(self, data):
+        self.data[:] = data
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+"""Run many LS-8 programs in parallel over a process pool."""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from cpu import *
+from analyze import analyze
+from imagecache import DEFAULT_DIRECTORY, ImageCache
+
+'''
+Usage:
+
+python(3) farm.py examples/*.ls8 -> runs every program, one per core
+python(3) farm.py examples/mult.ls8 --states seeds.json
+    -> runs one program once per initial state in seeds.json
+python(3) farm.py examples/*.ls8 --check -> skips programs whose stack
+    analyze.py can't show stays clear of the program
+
+An initial state is a JSON object with any of:
+    "registers": {"0": 5, "1": 7}   register number -> value
+    "ram": {"240": 1}               address -> value
+    "pc": 0
+'''
+
+
+def apply_state(cpu, state):
+    '''
+    Set the registers, ram and pc of a loaded CPU from an initial state
+    '''
+    for reg, value in state.get('registers', {}).items():
+        cpu.register[int(reg)] = value
+    for address, value in state.get('ram', {}).items():
+        cpu.ram_write(int(address), value)
+    cpu.pc = state.get('pc', cpu.pc)
+
+
+def run_job(job):
+    '''
+    Run one program in a worker and return its result as a dict
+    '''
+    filename, state, max_cycles, cache, check = job
+    result = {'program': filename, 'state': state, 'error': None,
+              'reason': None, 'cycles': 0, 'output': ''}
+    cpu = CPU()
+
+    try:
+        if cache is not None:
+            ImageCache(cache).load(cpu, filename)
+        else:
+            cpu.load(filename)
+        if state is not None:
+            apply_state(cpu, state)
+        problem = analyze(cpu).overflows(cpu.symbol_map) if check else None
+        if problem is not None:
+            # Not worth the cycles
+            result['error'] = f'Rejected: {problem}'
+        else:
+            run = cpu.run(max_cycles=max_cycles, capture=True)
+            result['reason'] = run.reason
+            result['cycles'] = run.cycles
+            result['output'] = run.output.decode('latin-1')
+            if run.fault is not None:
+                result['error'] = f'Fault: {run.fault.describe(cpu.symbol_map)}'
+    except Exception as e:
+        result['error'] = f'{type(e).__name__}: {e}'
+
+    result['pc'] = cpu.pc
+    result['fl'] = cpu.fl
+    result['registers'] = list(cpu.register)
+    result['ram'] = cpu.ram.hex()
+    return result
+
+
+def run_farm(filenames, states=None, workers=None, max_cycles=None,
+             cache=None, check=False):
+    '''
+    Run every program (or one program per initial state when states is
+    given) over a process pool, returns the results in job order
+
+    max_cycles stops programs that never halt. With a cache directory,
+    programs (including .asm sources) are loaded through an ImageCache.
+    With check, programs whose stack may overflow (see analyze.py) are
+    rejected instead of run.
+    '''
+    if states is None:
+        states = [None]
+    jobs = [(filename, state, max_cycles, cache, check)
+            for filename in filenames for state in states]
+
+    workers = workers or os.cpu_count() or 1
+    # Bigger chunks keep the pickling overhead down on long job lists
+    chunksize = max(1, len(jobs) // (4 * workers))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(run_job, jobs, chunksize=chunksize))
+
+
+def summarize(results):
+    '''
+    Return counts of the runs that finished and the ones that errored
+    '''
+    errors = sum(1 for r in results if r['error'] is not None)
+    return {'runs': len(results), 'ok': len(results) - errors, 'errors': errors}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('programs', nargs='+', help='programs to run')
+    parser.add_argument('--states', help='JSON file with a list of initial states')
+    parser.add_argument('-j', '--workers', type=int, help='worker processes')
+    parser.add_argument('--max-cycles', type=int, default=10_000_000,
+                        help='stop programs after this many instructions')
+    parser.add_argument('--cache', nargs='?', const=DEFAULT_DIRECTORY,
+                        help='load programs, .asm too, through an image cache')
+    parser.add_argument('--check', action='store_true',
+                        help='reject programs whose stack may overflow')
+    parser.add_argument('--json', help='write every result to this file')
+    args = parser.parse_args(argv[1:])
+
+    states = None
+    if args.states:
+        with open(args.states) as f:
+            states = json.load(f)
+
+    results = run_farm(args.programs, states, args.workers, args.max_cycles,
+                       args.cache, args.check)
+
+    for r in results:
+        status = r['error'] or r['reason']
+        print(f"{r['program']}: {status}")
+        for line in r['output'].splitlines():
+            print(f'    {line}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    summary = summarize(results)
+    print(f"{summary['runs']} runs, {summary['ok']} ok, {summary['errors']} errors")
+    return 1 if summary['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
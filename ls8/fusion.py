@@ -0,0 +1,184 @@
+"""Superinstructions, common opcode sequences decoded as one entry."""
+
+from collections import Counter
+
+from cpu import *
+
+# Most bytes a fused entry covers (LDI, CMP, Jcc)
+MAX_FUSED = 8
+# Most instructions a fused entry runs
+MAX_INSTRUCTIONS = 3
+
+# FL test of each conditional jump
+CONDITIONS = {
+    JEQ: lambda fl: fl & FL_E,
+    JNE: lambda fl: not fl & FL_E,
+    JGT: lambda fl: fl & FL_G,
+    JLT: lambda fl: fl & FL_L,
+    JLE: lambda fl: fl & (FL_L | FL_E),
+    JGE: lambda fl: fl & (FL_G | FL_E),
+}
+
+
+def compare(a, b):
+    '''
+    Return the FL value CMP sets for a and b
+    '''
+    if a == b:
+        return FL_E
+    return FL_L if a < b else FL_G
+
+
+class Fuser:
+    '''
+    Decodes common sequences emitted by asm.py into single predecoded
+    entries, so they cost one dispatch instead of two or three:
+
+    * LDI Rx,addr then JMP/CALL/Jcc Rx
+    * CMP Ra,Rb then Jcc Rc
+    * LDI Rx,addr, CMP Ra,Rb then Jcc Rx
+    * PUSH Rx then POP Ry
+
+    Attaching a Fuser replaces the CPU's decode, so fusion happens once per
+    address and costs nothing per instruction. A fused entry counts as all
+    of its instructions against cycle budgets, and runs them one at a time
+    when less budget than that is left, so interrupts land where they would
+    without fusion. fired counts how often each fusion ran.
+    '''
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.fired = Counter()
+        cpu.decode = self.decode
+        # Writes have to drop fused entries that start further back
+        cpu.decode_span = MAX_FUSED
+        cpu.max_fused = MAX_INSTRUCTIONS
+        cpu.code_changed()
+
+    def decode(self, pc):
+        '''
+        Decode the instruction at pc, fusing it with the ones after it when
+        they form a known sequence
+        '''
+        entry = self.fuse(pc)
+        if entry is None:
+            return CPU.decode(self.cpu, pc)
+        self.cpu.decoded[pc] = entry
+        return entry
+
+    def fuse(self, pc):
+        '''
+        Return a fused entry for the sequence at pc, or None
+        '''
+        if pc + MAX_FUSED > 256:
+            # Don't bother near the end of ram
+            return None
+
+        ram = self.cpu.ram
+        # Fusions that touch memory would skip the checks of protection.py
+        protected = self.cpu.protection is not None
+        first = ram[pc]
+        second_pc = pc + (first >> 6) + 1
+        second = ram[second_pc]
+        op_a, op_b = ram[pc + 1], ram[pc + 2]
+        op_c, op_d = ram[second_pc + 1], ram[second_pc + 2]
+        if bad_register(first, op_a, op_b) or bad_register(second, op_c, op_d):
+            # Left to decode, which makes them fault
+            return None
+
+        if first == LDI:
+            jump = second == JMP or second in CONDITIONS
+            if jump or (second == CALL and not protected):
+                if op_c == op_a:
+                    return self.ldi_jump(pc, op_a, op_b, second)
+            elif second == CMP:
+                third_pc = second_pc + 3
+                third = ram[third_pc]
+                if third in CONDITIONS and ram[third_pc + 1] == op_a:
+                    return self.ldi_cmp_jump(pc, op_a, op_b, op_c, op_d, third)
+        elif first == CMP and second in CONDITIONS:
+            return self.cmp_jump(pc, op_a, op_b, op_c, second)
+        elif first == PUSH and second == POP and not protected:
+            return self.push_pop(op_a, op_c)
+
+        return None
+
+    def ldi_jump(self, pc, reg_x, value, jump):
+        cpu = self.cpu
+        reg = cpu.register
+        fired = self.fired
+        return_address = (pc + 5) & 0xFF
+
+        if jump == JMP:
+            def handler(op_a, op_b):
+                fired['LDI+JMP'] += 1
+                reg[reg_x] = value
+                cpu.pc = value
+        elif jump == CALL:
+            def handler(op_a, op_b):
+                fired['LDI+CALL'] += 1
+                reg[reg_x] = value
+                reg[SP] = (reg[SP] - 1) & 0xFF
+                cpu.ram_write(reg[SP], return_address)
+                cpu.pc = value
+        else:
+            condition = CONDITIONS[jump]
+            name = 'LDI+' + OPCODE_NAMES[jump]
+
+            def handler(op_a, op_b):
+                fired[name] += 1
+                reg[reg_x] = value
+                cpu.pc = value if condition(cpu.fl) else return_address
+
+        return (handler, None, None, 5, 1, 2)
+
+    def cmp_jump(self, pc, reg_a, reg_b, reg_c, jump):
+        cpu = self.cpu
+        reg = cpu.register
+        fired = self.fired
+        condition = CONDITIONS[jump]
+        next_pc = (pc + 5) & 0xFF
+
+        def handler(op_a, op_b):
+            fired['CMP+Jcc'] += 1
+            cpu.fl = compare(reg[reg_a], reg[reg_b])
+            cpu.pc = reg[reg_c] if condition(cpu.fl) else next_pc
+
+        return (handler, None, None, 5, 1, 2)
+
+    def ldi_cmp_jump(self, pc, reg_x, value, reg_a, reg_b, jump):
+        cpu = self.cpu
+        reg = cpu.register
+        fired = self.fired
+        condition = CONDITIONS[jump]
+        next_pc = (pc + 8) & 0xFF
+
+        def handler(op_a, op_b):
+            fired['LDI+CMP+Jcc'] += 1
+            reg[reg_x] = value
+            cpu.fl = compare(reg[reg_a], reg[reg_b])
+            cpu.pc = value if condition(cpu.fl) else next_pc
+
+        return (handler, None, None, 8, 1, 3)
+
+    def push_pop(self, reg_x, reg_y):
+        cpu = self.cpu
+        push = cpu.push
+        pop = cpu.pop
+        fired = self.fired
+
+        def handler(op_a, op_b):
+            fired['PUSH+POP'] += 1
+            push(reg_x)
+            pop(reg_y)
+
+        return (handler, None, None, 4, 0, 2)
+
+    def report(self):
+        '''
+        Return how often each fusion ran, as text
+        '''
+        lines = ['Fusions:']
+        for name, count in self.fired.most_common():
+            lines.append(f'  {name:<12} {count:>8}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,140 @@
+"""Binary image format for LS-8 programs.
+
+An image is a header followed by the raw program bytes:
+
+    magic     4 bytes   b'LS8B'
+    version   1 byte
+    entry     1 byte    address execution starts at
+    size      2 bytes   number of program bytes
+    checksum  4 bytes   CRC-32 of the program bytes
+    symbols   2 bytes   number of symbol table entries
+
+then for each symbol a 1 byte name length, the name (ASCII) and a 2 byte
+address, then the program bytes. Multi-byte fields are little endian.
+
+A file that doesn't start with the magic is taken to be raw program bytes
+loaded at address 0.
+"""
+
+import struct
+import zlib
+
+MAGIC = b'LS8B'
+VERSION = 1
+
+HEADER = struct.Struct('<4sBBHIH')
+SYMBOL_ADDRESS = struct.Struct('<H')
+
+
+class ImageError(Exception):
+    """Raised for a malformed or corrupt image."""
+
+
+class Header:
+    """The parsed header of an image."""
+
+    def __init__(self, entry, size, checksum, symbols):
+        self.entry = entry
+        self.size = size
+        self.checksum = checksum
+        # name -> address
+        self.symbols = symbols
+
+
+def pack(code, entry=0, symbols=None):
+    '''
+    Return the image bytes for a program
+    '''
+    symbols = symbols or {}
+    if len(code) > 0xFFFF or len(symbols) > 0xFFFF:
+        raise ImageError('program too large for an image')
+    parts = [HEADER.pack(MAGIC, VERSION, entry, len(code), zlib.crc32(code),
+                         len(symbols))]
+    for name, address in symbols.items():
+        name = name.encode('ascii')
+        parts.append(bytes((len(name),)) + name + SYMBOL_ADDRESS.pack(address))
+    parts.append(bytes(code))
+    return b''.join(parts)
+
+
+def read_header(f):
+    '''
+    Read the header of the image open in binary file f, leaving f at the
+    start of the program bytes
+
+    Returns None, with f rewound, if the file has no header.
+    '''
+    start = f.tell()
+    raw = f.read(HEADER.size)
+    if raw[:len(MAGIC)] != MAGIC:
+        f.seek(start)
+        return None
+    if len(raw) < HEADER.size:
+        raise ImageError('truncated header')
+
+    magic, version, entry, size, checksum, count = HEADER.unpack(raw)
+    if version != VERSION:
+        raise ImageError(f'unsupported image version {version}')
+
+    symbols = {}
+    for _ in range(count):
+        length = f.read(1)
+        if not length:
+            raise ImageError('truncated symbol table')
+        name = f.read(length[0]).decode('ascii')
+        address, = SYMBOL_ADDRESS.unpack(f.read(SYMBOL_ADDRESS.size))
+        symbols[name] = address
+
+    return Header(entry, size, checksum, symbols)
+
+
+def load_into(f, buffer):
+    '''
+    Read the image open in binary file f straight into buffer (e.g. the
+    CPU's ram), returns the Header, or None for a raw image
+    '''
+    header = read_header(f)
+    view = memoryview(buffer)
+
+    if header is None:
+        f.readinto(view)
+        if f.read(1):
+            raise ImageError(f'program does not fit in {len(buffer)} bytes')
+        return None
+
+    if header.size > len(buffer):
+        raise ImageError(f'program does not fit in {len(buffer)} bytes')
+    if f.readinto(view[:header.size]) != header.size:
+        raise ImageError('truncated program')
+    if zlib.crc32(view[:header.size]) != header.checksum:
+        raise ImageError('checksum mismatch')
+    return header
+
+
+def parse_text(f):
+    '''
+    Parse a text .ls8 program (one binary byte per line, # comments) open in
+    f, returns the program bytes
+    '''
+    program = bytearray()
+
+    # Read each line
+    for line in f:
+        # Split on # to remove comments
+        line = line.split('#')
+        # Remove empty spaces
+        line = line[0].strip()
+        if line == '':
+            continue
+        # Convert to int (base 2 binary)
+        program.append(int(line, 2))
+
+    return program
+
+
+def is_image(filename):
+    '''
+    Return True if the file starts with the image magic
+    '''
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
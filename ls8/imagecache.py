@@ -0,0 +1,181 @@
+"""On-disk cache of assembled and parsed program images."""
+
+import hashlib
+import io
+import os
+import sys
+
+import image
+
+# The assembler lives next door
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'asm'))
+import asm
+
+# Where images are kept unless told otherwise
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'ls8')
+# Total size the cache is trimmed down to
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+class ImageCache:
+    '''
+    Content addressed cache of binary images (see image.py)
+
+    Images are keyed by the SHA-256 of the source file, every file it
+    includes and the assembler version. The includes found by the last build
+    of each .asm file are kept in a small .deps file, so a warm start hashes
+    the files again without expanding, assembling or parsing anything. The
+    least recently used images are evicted once the cache grows past
+    max_bytes.
+
+    The predecoded instruction table is not stored, it is rebuilt lazily
+    from ram on the first visit to each address and holds bound methods
+    that can't be written to disk anyway.
+    '''
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = (directory or os.environ.get('LS8_CACHE')
+                          or DEFAULT_DIRECTORY)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, source, kind, includes=()):
+        '''
+        Return the cache key for the source bytes of a given kind
+        ('asm' or 'ls8'), and the paths of the files it includes
+        '''
+        h = hashlib.sha256()
+        h.update(f'{kind}:{asm.ASM_VERSION}:{image.VERSION}:'.encode())
+        h.update(source)
+        for path in includes:
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.ls8b')
+
+    def deps_path(self, filename):
+        name = hashlib.sha256(os.path.abspath(filename).encode()).hexdigest()
+        return os.path.join(self.directory, name + '.deps')
+
+    def get_deps(self, filename):
+        '''
+        Return the files the last build of filename included, or None
+        '''
+        try:
+            with open(self.deps_path(filename)) as f:
+                return f.read().splitlines()
+        except FileNotFoundError:
+            return None
+
+    def put_deps(self, filename, includes):
+        '''
+        Remember the files a build of filename included
+        '''
+        path = self.deps_path(filename)
+        temp = f'{path}.{os.getpid()}.tmp'
+        with open(temp, 'w') as f:
+            f.write(''.join(include + '\n' for include in includes))
+        os.replace(temp, path)
+
+    def get(self, key):
+        '''
+        Return the cached image for key, or None
+        '''
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # Mark it as recently used
+        os.utime(path)
+        return data
+
+    def put(self, key, data):
+        '''
+        Store an image, then trim the cache
+        '''
+        path = self.path(key)
+        # Write then rename so concurrent readers never see half a file
+        temp = f'{path}.{os.getpid()}.tmp'
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.replace(temp, path)
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used images until the cache fits in
+        max_bytes
+        '''
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.ls8b'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another process got there first
+                pass
+            total -= size
+
+    def image_for(self, filename):
+        '''
+        Return the binary image for a .asm, .ls8 or .ls8b file, building and
+        caching it on a miss. A .asm file is only expanded when its includes
+        aren't known or the image for them isn't cached.
+        '''
+        with open(filename, 'rb') as f:
+            source = f.read()
+
+        if source[:len(image.MAGIC)] == image.MAGIC or filename.endswith('.ls8b'):
+            # Already an image
+            return source
+
+        if not filename.endswith('.asm'):
+            key = self.key(source, 'ls8')
+            data = self.get(key)
+            if data is None:
+                data = image.pack(image.parse_text(io.StringIO(source.decode())))
+                self.put(key, data)
+            return data
+
+        includes = self.get_deps(filename)
+        if includes is not None:
+            try:
+                data = self.get(self.key(source, 'asm', includes))
+            except FileNotFoundError:
+                # An include is gone, the source must have changed
+                data = None
+            if data is not None:
+                return data
+
+        # Expanding finds every file the program is built from, the first
+        # being the source itself
+        preprocessor = asm.Preprocessor()
+        lines = preprocessor.expand_file(filename)
+        includes = preprocessor.dependencies[1:]
+        key = self.key(source, 'asm', includes)
+        data = self.get(key)
+        if data is None:
+            data = asm.parse_expanded(preprocessor, lines).image()
+            self.put(key, data)
+        self.put_deps(filename, includes)
+        return data
+
+    def load(self, cpu, filename):
+        '''
+        Load a program into a CPU through the cache
+        '''
+        cpu.load_bytes(self.image_for(filename))
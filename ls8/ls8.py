@@ -5,28 +5,126 @@
 import os
 import sys
 from cpu import *
+from analyze import analyze
+from blocks import BlockEngine
+from debugger import Debugger, DebuggerShell
+from fusion import Fuser
+from imagecache import ImageCache
+from profiler import Profiler
+from protection import Protection
+from tracer import Tracer
 '''
 Usage:
 
 python(3) ls8.py call -> loads ../examples/call.ls8 into cpu
+python(3) ls8.py ../../asm/call.asm -> assembles the source first (through
+    the image cache, see imagecache.py), paths are relative to examples/
+python(3) ls8.py /tmp/call.ls8b -> loads a binary image, such as the one
+    ../asm/asm.py ../asm/call.asm /tmp/call.ls8b writes
+python(3) ls8.py call --profile -> prints a profile to stderr when it halts
+python(3) ls8.py call --profile=call.json -> also writes the profile as JSON
+python(3) ls8.py call --fuse -> fuses common instruction sequences, prints
+    how often each fusion ran to stderr when it halts or faults
+python(3) ls8.py call --trace -> prints the last 1024 instructions to stderr
+    when it halts, overflows its stack or crashes
+python(3) ls8.py call --trace=50 -> only the last 50
+python(3) ls8.py stackoverflow --protect -> faults when the stack reaches the
+    program or a program writes to its own code
+python(3) ls8.py call --debug -> debugger prompt instead of running
+python(3) ls8.py call --blocks -> runs compiled basic blocks, compiling the
+    loops analyze.py finds up front and the rest once they run often
+python(3) ls8.py stackoverflow --check -> refuses to run a program whose
+    stack analyze.py can't show stays clear of the program
+python(3) ls8.py interrupts --timer-cycles=1000 -> timer interrupt every 1000
+    instructions instead of every second
+
+--profile, --trace and --blocks each run the program their own way, so only
+one of them can be given.
 
 To load new programs, add program file to /examples folder
+
+A program assembled with asm.py -g has a .map file next to it, which is
+loaded too: profiles, traces, faults and the debugger then show addresses
+as LABEL+offset (file:line).
 '''
-# Gets current working directory and appends \examples\
+# Options start with --, the program is the first other argument
+options = [arg for arg in sys.argv[1:] if arg.startswith('--')]
+args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+
+# Gets current working directory and appends examples
 # So we don't need to type it every time
-current_dir = os.getcwd() + '\examples\\'
+current_dir = os.path.join(os.getcwd(), 'examples')
 
 # Combines CL argument with cwd
 # So we don't need to type it every time
-if sys.argv[1][-4] == '.':
-    # Checks if CL args have a file type included (i.e. '.txt')
+extension = os.path.splitext(args[0])[1]
+if extension:
+    # Checks if CL args have a file type included (i.e. '.ls8b' or '.asm')
     # allowing users to use programs not ending in ls8
-    command = current_dir + sys.argv[1]
+    command = os.path.join(current_dir, args[0])
 else:
     # If not, add .ls8 by default
-    command = current_dir + sys.argv[1] + '.ls8'
+    extension = '.ls8'
+    command = os.path.join(current_dir, args[0] + extension)
+
+# Each of these swaps in its own execute hook
+engines = [option for option in options
+           if option.split('=', 1)[0] in ('--profile', '--trace', '--blocks')]
+if len(engines) > 1:
+    sys.exit(f"{' and '.join(engines)} can't be used together")
+
+timer_cycles = None
+for option in options:
+    if option.startswith('--timer-cycles='):
+        timer_cycles = int(option.split('=', 1)[1])
+
+cpu = CPU(timer_cycles=timer_cycles)
 
-cpu = CPU()
+for option in options:
+    if option == '--profile':
+        Profiler(cpu)
+    elif option.startswith('--profile='):
+        Profiler(cpu, json_path=option.split('=', 1)[1])
+    elif option == '--trace':
+        Tracer(cpu)
+    elif option.startswith('--trace='):
+        Tracer(cpu, size=int(option.split('=', 1)[1]))
+    elif option == '--fuse':
+        fuser = Fuser(cpu)
 
-cpu.load(command)
-cpu.run()
\ No newline at end of file
+        def report_fusions(result):
+            # Once at the end, not after every slice of a debugger or session
+            if result.reason in (HALTED, FAULT):
+                sys.stderr.write(fuser.report())
+
+        cpu.on_stop.append(report_fusions)
+    elif option == '--blocks':
+        engine = BlockEngine(cpu)
+
+if extension == '.asm':
+    # Assembled on the way in
+    ImageCache().load(cpu, command)
+else:
+    # .ls8 text or a .ls8b image, other files are told apart by contents
+    cpu.load(command)
+if '--protect' in options:
+    # Protects what was loaded
+    Protection(cpu)
+
+if '--check' in options or '--blocks' in options:
+    analysis = analyze(cpu)
+    if '--check' in options:
+        problem = analysis.overflows(cpu.symbol_map)
+        if problem is not None:
+            sys.exit(f'Rejected: {problem}')
+    if '--blocks' in options:
+        # Straight-line code outside loops isn't worth compiling
+        loops = [body for header, body in analysis.loops]
+        engine.precompile(set().union(*loops))
+
+if '--debug' in options:
+    DebuggerShell(Debugger(cpu)).cmdloop()
+else:
+    result = cpu.run()
+    if result.fault is not None:
+        sys.exit(f'Fault: {result.fault.describe(cpu.symbol_map)}')
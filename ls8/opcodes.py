@@ -0,0 +1,124 @@
+"""The LS-8 instruction set, shared by the emulator and the assembler."""
+
+import keyword
+
+# Operand types, as the assembler checks them
+NO_OPERANDS = 0
+REGISTER = 1
+TWO_REGISTERS = 2
+# A register and an immediate value or label
+IMMEDIATE = 8
+
+ADD = 0b10100000
+AND = 0b10101000
+CALL = 0b01010000
+CMP = 0b10100111
+DEC = 0b01100110
+DIV = 0b10100011
+HLT = 0b00000001
+INC = 0b01100101
+INT = 0b01010010
+IRET = 0b00010011
+JEQ = 0b01010101
+JGE = 0b01011010
+JGT = 0b01010111
+JLE = 0b01011001
+JLT = 0b01011000
+JMP = 0b01010100
+JNE = 0b01010110
+LD = 0b10000011
+LDI = 0b10000010
+MOD = 0b10100100
+MUL = 0b10100010
+NOP = 0b00000000
+NOT = 0b01101001
+OR = 0b10101010
+POP = 0b01000110
+PRA = 0b01001000
+PRN = 0b01000111
+PUSH = 0b01000101
+RET = 0b00010001
+SHL = 0b10101100
+SHR = 0b10101101
+ST = 0b10000100
+SUB = 0b10100001
+XOR = 0b10101011
+
+# Mnemonic, opcode and operand type of every instruction
+INSTRUCTIONS = [
+    ('ADD', ADD, TWO_REGISTERS),
+    ('AND', AND, TWO_REGISTERS),
+    ('CALL', CALL, REGISTER),
+    ('CMP', CMP, TWO_REGISTERS),
+    ('DEC', DEC, REGISTER),
+    ('DIV', DIV, TWO_REGISTERS),
+    ('HLT', HLT, NO_OPERANDS),
+    ('INC', INC, REGISTER),
+    ('INT', INT, REGISTER),
+    ('IRET', IRET, NO_OPERANDS),
+    ('JEQ', JEQ, REGISTER),
+    ('JGE', JGE, REGISTER),
+    ('JGT', JGT, REGISTER),
+    ('JLE', JLE, REGISTER),
+    ('JLT', JLT, REGISTER),
+    ('JMP', JMP, REGISTER),
+    ('JNE', JNE, REGISTER),
+    ('LD', LD, TWO_REGISTERS),
+    ('LDI', LDI, IMMEDIATE),
+    ('MOD', MOD, TWO_REGISTERS),
+    ('MUL', MUL, TWO_REGISTERS),
+    ('NOP', NOP, NO_OPERANDS),
+    ('NOT', NOT, REGISTER),
+    ('OR', OR, TWO_REGISTERS),
+    ('POP', POP, REGISTER),
+    ('PRA', PRA, REGISTER),
+    ('PRN', PRN, REGISTER),
+    ('PUSH', PUSH, REGISTER),
+    ('RET', RET, NO_OPERANDS),
+    ('SHL', SHL, TWO_REGISTERS),
+    ('SHR', SHR, TWO_REGISTERS),
+    ('ST', ST, TWO_REGISTERS),
+    ('SUB', SUB, TWO_REGISTERS),
+    ('XOR', XOR, TWO_REGISTERS),
+]
+
+# Mnemonics, for reports
+OPCODE_NAMES = {opcode: name for name, opcode, _ in INSTRUCTIONS}
+
+# Number of operands of each instruction that name a register
+REGISTER_OPERANDS = {
+    opcode: {NO_OPERANDS: 0, REGISTER: 1, TWO_REGISTERS: 2, IMMEDIATE: 1}[op_type]
+    for name, opcode, op_type in INSTRUCTIONS
+}
+
+
+def bad_register(ir, op_a, op_b):
+    '''
+    True if the instruction ir names a register past R7, which makes it as
+    illegal as an unknown opcode
+    '''
+    count = REGISTER_OPERANDS.get(ir, 0)
+    return max((op_a, op_b)[:count], default=0) > 7
+
+
+def handler_name(name):
+    '''
+    Return the name of the method executing the instruction called name,
+    e.g. 'ADD' -> 'add', and 'AND' -> 'and_' as and is a Python keyword
+    '''
+    name = name.lower()
+    if keyword.iskeyword(name):
+        name += '_'
+    return name
+
+
+def dispatch_table(machine, default):
+    '''
+    Return a list of 256 handlers indexed by opcode, each the method of
+    machine named by handler_name(), or default for opcodes it lacks
+    '''
+    table = [default] * 256
+    for name, opcode, _ in INSTRUCTIONS:
+        table[opcode] = getattr(machine, handler_name(name), default)
+    return table
+
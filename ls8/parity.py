@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+"""Differential checks of every engine against the interpreter."""
+
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+
+from cpu import *
+import image
+import snapshot
+from protection import Protection
+from batch import BatchCPU
+from blocks import BlockEngine
+from fusion import Fuser
+
+# The assembler lives next door
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'asm'))
+import asm
+
+'''
+Usage:
+
+python(3) parity.py -> checks everything, prints each mismatch and a summary
+python(3) parity.py -v -> also prints every check that passed
+
+Every program (the examples plus the cases below) is run on CPU.interpret,
+one instruction per call to run() and on each engine in ENGINES, and the
+final states have to match. The batch has no interrupts and is compared
+on the programs that halt or fault. Images come back from image.pack()
+the same as they went in, and a program snapshotted half way finishes
+like one that ran straight through. The .map written for each source in
+../asm loads back the same.
+'''
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = os.path.join(HERE, 'examples')
+SOURCES = os.path.join(HERE, '..', 'asm')
+
+# Instructions each program runs for, programs that never halt are cut off
+MAX_CYCLES = 20_000
+# Virtual timer period, so interrupt driven programs run the same each time
+TIMER_CYCLES = 1000
+
+# Hand assembled programs for corner cases the examples don't reach
+CASES = {
+    # Runs NOPs through 0xFF and wraps around to 0 once before halting
+    'wrap around': [
+        0x65, 0x01,             # 00 INC R1
+        0x82, 0x00, 0x12,       # 02 LDI R0,Done
+        0x82, 0x02, 0x02,       # 05 LDI R2,2
+        0xA7, 0x01, 0x02,       # 08 CMP R1,R2
+        0x55, 0x00,             # 0B JEQ R0
+        0x82, 0x00, 0xFD,       # 0D LDI R0,0xFD
+        0x54, 0x00,             # 10 JMP R0
+        0x01,                   # 12 Done: HLT
+    ],
+    # Stores a HLT over a NOP further down its own block
+    'self-modifying': [
+        0x82, 0x00, 0x0A,       # 00 LDI R0,0x0A
+        0x82, 0x01, 0x01,       # 03 LDI R1,HLT
+        0x84, 0x00, 0x01,       # 06 ST R0,R1
+        0x00,                   # 09 NOP
+        0x00,                   # 0A NOP, becomes HLT
+        0x82, 0x02, 0x09,       # 0B LDI R2,9
+        0x47, 0x02,             # 0E PRN R2
+        0x01,                   # 10 HLT
+    ],
+    # Faults on the third instruction
+    'divide by zero': [
+        0x82, 0x00, 0x01,       # 00 LDI R0,1
+        0x82, 0x01, 0x00,       # 03 LDI R1,0
+        0xA3, 0x00, 0x01,       # 06 DIV R0,R1
+        0x01,                   # 09 HLT
+    ],
+}
+
+
+
+class Uncached:
+    '''
+    Runs a CPU like CPU.interpret but decodes every instruction again each
+    time it runs, the reference the predecoded instructions have to match
+    '''
+
+    def __init__(self, cpu):
+        self.cpu = cpu
+        cpu.execute = self.execute
+
+    def execute(self, n):
+        cpu = self.cpu
+        count = 0
+        try:
+            while count < n:
+                entry = cpu.decode_one(cpu.pc)
+                handler, op_a, op_b, run_counter, set_pc, instructions = entry
+                handler(op_a, op_b)
+                if not set_pc:
+                    cpu.pc = (cpu.pc + run_counter) & 0xFF
+                count += 1
+        except Break:
+            pass
+        except Stop:
+            count += 1
+        except Fault as e:
+            e.executed = count
+            raise
+        return count
+
+
+# Engines compared with CPU.interpret on every program, name -> function
+# attaching the engine to a CPU
+ENGINES = {
+    'uncached': Uncached,
+    'blocks': BlockEngine,
+    'fusion': Fuser,
+}
+
+
+def programs():
+    '''
+    Yield (name, image bytes) for every example and case
+    '''
+    for filename in sorted(glob.glob(os.path.join(EXAMPLES, '*.ls8'))):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        with open(filename) as f:
+            yield name, image.pack(image.parse_text(f))
+    for name, code in CASES.items():
+        yield f'case/{name}', image.pack(bytes(code))
+
+
+def machine(data, engine=None, protect=False):
+    '''
+    Return a CPU with the image loaded, on engine when given, and with
+    memory protection when protect is set
+    '''
+    cpu = CPU(timer_cycles=TIMER_CYCLES)
+    if engine is not None:
+        engine(cpu)
+    cpu.load_bytes(data)
+    if protect:
+        # Protected instructions take other paths, writes to code included
+        Protection(cpu, code_end=0)
+    return cpu
+
+
+def run_stepped(cpu, max_cycles):
+    '''
+    Run cpu one instruction per call to run(), returns a RunResult for the
+    whole run. No slice is ever cut short, so this checks how run() counts
+    and captures across slices.
+    '''
+    cycles = 0
+    output = b''
+    while True:
+        result = cpu.run(max_cycles=1, capture=True)
+        cycles += result.cycles
+        output += result.output
+        if result.reason != CYCLE_LIMIT or cycles >= max_cycles:
+            break
+    result.cycles = cycles
+    result.output = output
+    return result
+
+
+def final_state(cpu, max_cycles=MAX_CYCLES, stepped=False):
+    '''
+    Run cpu and return everything it ended up with as a dict
+    '''
+    try:
+        if stepped:
+            result = run_stepped(cpu, max_cycles)
+        else:
+            result = cpu.run(max_cycles=max_cycles, capture=True)
+    except Exception as e:
+        # Crashing the same way still counts as agreeing
+        return {'error': f'{type(e).__name__}: {e}'}
+    return {
+        'reason': result.reason,
+        'fault': str(result.fault) if result.fault else None,
+        'cycles': result.cycles,
+        'output': result.output,
+        'pc': result.pc,
+        'registers': result.registers,
+        'fl': result.fl,
+        'ram': bytes(cpu.ram),
+    }
+
+
+def differences(expected, actual, ignore=()):
+    '''
+    Return the names of the fields that differ between two final states
+    '''
+    keys = sorted(set(expected) | set(actual))
+    return [key for key in keys
+            if key not in ignore and expected.get(key) != actual.get(key)]
+
+
+def check_engines(name, data):
+    '''
+    Yield (check, differing fields) for each engine on one program
+    '''
+    for protect in (False, True):
+        suffix = ', protected' if protect else ''
+        expected = final_state(machine(data, protect=protect))
+
+        actual = final_state(machine(data, protect=protect), stepped=True)
+        yield f'{name} [stepped{suffix}]', differences(expected, actual)
+
+        for engine, attach in ENGINES.items():
+            actual = final_state(machine(data, attach, protect))
+            yield f'{name} [{engine}{suffix}]', differences(expected, actual)
+
+
+def check_batch(name, data):
+    '''
+    Run two copies of a program that halts or faults on a BatchCPU, yields
+    (check, fields either gets different from the interpreter)
+    '''
+    expected = final_state(machine(data))
+    if expected.get('reason') not in (HALTED, FAULT):
+        return
+    faulted = expected['reason'] == FAULT
+
+    batch = BatchCPU.from_cpu(machine(data), 2)
+    steps = batch.run(MAX_CYCLES)
+    wrong = []
+    if list(batch.errors.values()) != [expected['fault']] * 2 * faulted:
+        wrong.append('fault')
+    if not batch.halted.all():
+        wrong.append('reason')
+    # The step that faulted doesn't count on the CPU
+    if steps - faulted != expected['cycles']:
+        wrong.append('cycles')
+    for i, output in enumerate(batch.outputs()):
+        cpu = batch.machine(i)
+        actual = {
+            'output': output,
+            'pc': cpu.pc,
+            'registers': bytes(cpu.register),
+            'fl': cpu.fl,
+            'ram': bytes(cpu.ram),
+        }
+        for key in actual:
+            if actual[key] != expected[key] and key not in wrong:
+                wrong.append(key)
+    yield f'{name} [batch]', wrong
+
+
+def check_image(data):
+    '''
+    Pack, parse and load an image, returns the fields that came back
+    different
+    '''
+    ram = machine(data).ram
+    code = bytes(ram[:program_end(ram)])
+    labels = {'Start': 0, 'End': len(code)}
+    packed = image.pack(code, entry=1, symbols=labels)
+    cpu = CPU()
+    cpu.load_bytes(packed)
+    wrong = []
+    if bytes(cpu.ram[:len(code)]) != code or any(cpu.ram[len(code):]):
+        wrong.append('ram')
+    if cpu.pc != 1:
+        wrong.append('entry')
+    if cpu.symbols != labels:
+        wrong.append('symbols')
+    return wrong
+
+
+def check_snapshot(data):
+    '''
+    Stop a program half way, snapshot it and finish on a restored copy,
+    returns the fields that end up different from one uninterrupted run
+    '''
+    expected = final_state(machine(data))
+    if 'error' in expected:
+        return []
+    first = expected['cycles'] // 2
+
+    cpu = machine(data)
+    before = final_state(cpu, first)
+    restored = CPU()
+    snapshot.restore(restored, snapshot.take(cpu))
+    actual = final_state(restored, MAX_CYCLES - before['cycles'])
+    actual['output'] = before['output'] + actual['output']
+    actual['cycles'] += before['cycles']
+    if before['reason'] == HALTED:
+        # Halted before the second half even started
+        actual = before
+    return differences(expected, actual)
+
+
+def check_wall_timer():
+    '''
+    Snapshot a wall clock timer that is overdue, returns ['next_timer'] if
+    it isn't due any more once restored
+    '''
+    cpu = CPU()
+    cpu.next_timer = time.monotonic() - 1
+    restored = snapshot.fork(snapshot.take(cpu))
+    if restored.next_timer is None or restored.next_timer > time.monotonic():
+        return ['next_timer']
+    return []
+
+
+def check_map(source, directory):
+    '''
+    Assemble a source with a debug map and load the program back, returns
+    the fields of the map that came back different
+    '''
+    program = asm.assemble_file(source, debug=True)
+    output = os.path.join(directory, os.path.basename(source)[:-4] + '.ls8')
+    with open(output, 'w') as f:
+        f.write(program.text())
+    asm.write_debug_map(program, output)
+
+    cpu = CPU()
+    cpu.load(output)
+    expected = asm.debug_map(program).to_dict(program.code)
+    actual = cpu.symbol_map.to_dict(program.code)
+    return [key for key in expected if expected[key] != actual.get(key)]
+
+
+def checks():
+    '''
+    Yield (check, differing fields) for everything
+    '''
+    for name, data in programs():
+        yield from check_engines(name, data)
+        yield from check_batch(name, data)
+        yield f'{name} [image]', check_image(data)
+        yield f'{name} [snapshot]', check_snapshot(data)
+    yield 'overdue wall clock timer [snapshot]', check_wall_timer()
+    with tempfile.TemporaryDirectory() as directory:
+        for source in sorted(glob.glob(os.path.join(SOURCES, '*.asm'))):
+            name = os.path.splitext(os.path.basename(source))[0]
+            yield f'{name} [map]', check_map(source, directory)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='also print the checks that passed')
+    args = parser.parse_args(argv[1:])
+
+    total = failed = 0
+    for check, wrong in checks():
+        total += 1
+        if wrong:
+            failed += 1
+            print(f"MISMATCH {check}: {', '.join(wrong)}")
+        elif args.verbose:
+            print(f'ok {check}')
+    print(f'{total - failed} of {total} checks passed')
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
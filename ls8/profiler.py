@@ -0,0 +1,192 @@
+"""Per-opcode and per-PC profiler for the LS-8."""
+
+import json
+import sys
+import time
+from collections import Counter
+
+from cpu import *
+
+# Rows shown in each table of the text report
+TOP = 10
+
+
+def opcode_name(ir):
+    return OPCODE_NAMES.get(ir, f'{ir:02X}')
+
+
+class Profiler:
+    '''
+    Counts executions per opcode and per PC, times every handler call and
+    records call graph edges from CALL and RET. With a symbol map loaded
+    (see symbols.py) PCs are shown with their label+offset and source line,
+    and counts are also summed per routine, the code from one label to the
+    next.
+
+    Attaching a profiler swaps the CPU's execute hook for a counting version
+    of the interpreter, so a CPU without one pays nothing. When the CPU
+    halts the text report goes to stream, and the JSON report to json_path
+    if given.
+    '''
+
+    def __init__(self, cpu, stream=sys.stderr, json_path=None):
+        self.cpu = cpu
+        self.stream = stream
+        self.json_path = json_path
+        # Indexed by opcode
+        self.opcodes = [0] * 256
+        self.seconds = [0.0] * 256
+        # Indexed by address
+        self.pcs = [0] * 256
+        # (caller, callee) -> number of calls, functions are named by their
+        # entry address
+        self.calls = Counter()
+        # Entry addresses of the functions currently running
+        self.frames = [cpu.pc]
+        cpu.execute = self.execute
+        cpu.on_stop.append(self.finish)
+
+    def execute(self, n):
+        '''
+        Execute up to n instructions like CPU.interpret, counting as we go
+        '''
+        cpu = self.cpu
+        decoded = cpu.decoded
+        opcodes = self.opcodes
+        seconds = self.seconds
+        pcs = self.pcs
+        clock = time.perf_counter
+        count = 0
+
+        while count < n:
+            pc = cpu.pc
+            entry = decoded[pc]
+            if entry is None:
+                entry = cpu.decode(pc)
+            if entry[5] > 1:
+                # Profile each instruction of a fused entry on its own
+                entry = cpu.decode_one(pc)
+            handler, op_a, op_b, run_counter, set_pc, instructions = entry
+            ir = cpu.ram[pc]
+
+            opcodes[ir] += 1
+            pcs[pc] += 1
+            count += 1
+            start = clock()
+            try:
+                handler(op_a, op_b)
+            except Break:
+                # Nothing ran
+                opcodes[ir] -= 1
+                pcs[pc] -= 1
+                count -= 1
+                break
+            except Stop:
+                seconds[ir] += clock() - start
+                break
+            except Fault as e:
+                e.executed = count - 1
+                raise
+            seconds[ir] += clock() - start
+
+            if ir == CALL:
+                self.calls[(self.frames[-1], cpu.pc)] += 1
+                self.frames.append(cpu.pc)
+            elif ir == RET and len(self.frames) > 1:
+                self.frames.pop()
+
+            if not set_pc:
+                cpu.pc = (pc + run_counter) & 0xFF
+
+        return count
+
+    def finish(self, result):
+        '''
+        Dump the reports when the CPU halts
+        '''
+        if not result.halted:
+            return
+        if self.stream is not None:
+            self.stream.write(self.report())
+        if self.json_path is not None:
+            with open(self.json_path, 'w') as f:
+                json.dump(self.to_dict(), f, indent=2)
+
+    def routines(self):
+        '''
+        Return a Counter of executions per label, counting each PC under the
+        nearest label at or before it
+        '''
+        routines = Counter()
+        symbol_map = self.cpu.symbol_map
+        for pc, count in enumerate(self.pcs):
+            if count:
+                found = symbol_map.labels[pc]
+                routines[found[0] if found is not None else None] += count
+        return routines
+
+    def to_dict(self):
+        '''
+        Return the profile as plain data
+        '''
+        symbol_map = self.cpu.symbol_map
+        return {
+            'opcodes': {
+                opcode_name(ir): {'count': count, 'seconds': self.seconds[ir]}
+                for ir, count in enumerate(self.opcodes) if count
+            },
+            'pcs': {f'{pc:02X}': count
+                    for pc, count in enumerate(self.pcs) if count},
+            'calls': [{'caller': f'{caller:02X}', 'callee': f'{callee:02X}',
+                       'count': count}
+                      for (caller, callee), count in self.calls.items()],
+            'locations': {f'{pc:02X}': symbol_map.locate(pc)
+                          for pc, count in enumerate(self.pcs)
+                          if count and symbol_map.locate(pc) is not None},
+            'routines': {name: count for name, count in self.routines().items()
+                         if name is not None},
+        }
+
+    def report(self):
+        '''
+        Return the profile as text
+        '''
+        total = sum(self.opcodes) or 1
+        symbol_map = self.cpu.symbol_map
+        lines = ['Opcodes:', '  op      count      %    total us   us/call']
+        by_count = sorted(range(256), key=lambda ir: -self.opcodes[ir])
+        for ir in by_count:
+            count = self.opcodes[ir]
+            if not count:
+                break
+            us = self.seconds[ir] * 1e6
+            lines.append(f'  {opcode_name(ir):<5} {count:>8} {100 * count / total:>6.1f}'
+                         f' {us:>11.1f} {us / count:>9.3f}')
+
+        lines += ['Hot PCs:', '  pc      count      %']
+        by_count = sorted(range(256), key=lambda pc: -self.pcs[pc])
+        for pc in by_count[:TOP]:
+            count = self.pcs[pc]
+            if not count:
+                break
+            where = symbol_map.locate(pc) or ''
+            lines.append(f'  {pc:02X}   {count:>8} {100 * count / total:>6.1f}'
+                         f'  {where}'.rstrip())
+
+        routines = self.routines()
+        if len(routines) > 1 or None not in routines:
+            lines += ['Routines:', '  label                 count      %']
+            for name, count in routines.most_common(TOP):
+                name = name if name is not None else '(before any label)'
+                lines.append(f'  {name:<18} {count:>8} {100 * count / total:>6.1f}')
+
+        if self.calls:
+            lines += ['Calls:', '  caller -> callee    count']
+            for (caller, callee), count in self.calls.most_common(TOP):
+                names = ''
+                if symbol_map.symbols:
+                    names = (f'  {symbol_map.label(caller) or "?"}'
+                             f' -> {symbol_map.label(callee) or "?"}')
+                lines.append(f'  {caller:02X}     -> {callee:02X}    {count:>8}{names}')
+
+        return '\n'.join(lines) + '\n'
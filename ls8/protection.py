@@ -0,0 +1,121 @@
+"""Optional memory protection for the LS-8."""
+
+from cpu import *
+
+# Permission bits, one byte of them per address
+READ = 0b001
+WRITE = 0b010
+# Part of the stack, PUSH/CALL may write here and POP/RET read from here
+STACK = 0b100
+
+# Keyboard buffer and reserved bytes, programs only read them
+IO_START = KEY_ADDRESS
+
+
+class Protection:
+    '''
+    Enforces a per-address permission table on a CPU's memory instructions,
+    raising a Fault carrying the PC, SP and address of any violation.
+
+    The default layout is
+
+        0x00 .. code_end      read only, the program
+        code_end .. 0xF4      read, write and stack
+        0xF4 .. 0xF7          read only, keyboard buffer and reserved
+        0xF8 .. 0xFF          read and write, interrupt vectors
+
+    so the stack may grow down to the end of the program and no further.
+    code_end defaults to the end of the program in ram when protection is
+    attached, stack_floor to code_end. set_region() changes the table.
+
+    Every check is a single lookup in the table. Protection replaces the
+    handlers of LD, ST, PUSH, POP, CALL and RET in the CPU's branchtable,
+    and its stack_push and stack_pop, with versions that look up the
+    address and then hand over to the originals, so an unprotected CPU runs
+    exactly as before.
+    '''
+
+    def __init__(self, cpu, code_end=None, stack_floor=None):
+        self.cpu = cpu
+        if code_end is None:
+            code_end = program_end(cpu.ram)
+        if stack_floor is None:
+            stack_floor = code_end
+        self.permissions = bytearray(256)
+        self.set_region(0, code_end, READ)
+        self.set_region(code_end, stack_floor, READ | WRITE)
+        self.set_region(stack_floor, IO_START, READ | WRITE | STACK)
+        self.set_region(IO_START, VECTORS, READ)
+        self.set_region(VECTORS, 256, READ | WRITE)
+
+        table = cpu.branchtable
+        self.original = {op: table[op] for op in (LD, ST, PUSH, POP, CALL, RET)}
+        table[LD] = self.ld
+        table[ST] = self.st
+        table[PUSH] = self.push
+        table[POP] = self.pop
+        table[CALL] = self.call
+        table[RET] = self.ret
+        self.next_stack_push = cpu.stack_push
+        self.next_stack_pop = cpu.stack_pop
+        cpu.stack_push = self.stack_push
+        cpu.stack_pop = self.stack_pop
+        cpu.protection = self
+        # Drop anything decoded or compiled with the old handlers
+        cpu.code_changed()
+
+    def set_region(self, start, end, permissions):
+        '''
+        Give addresses start up to end the permission bits
+        '''
+        self.permissions[start:end] = bytes([permissions]) * (end - start)
+
+    def fault(self, kind, address):
+        cpu = self.cpu
+        return Fault(kind, cpu.pc, cpu.register[SP], address)
+
+    def check_push(self):
+        address = (self.cpu.register[SP] - 1) & 0xFF
+        if not self.permissions[address] & STACK:
+            raise self.fault(STACK_OVERFLOW, address)
+
+    def check_pop(self):
+        address = self.cpu.register[SP]
+        if not self.permissions[address] & STACK:
+            raise self.fault(STACK_UNDERFLOW, address)
+
+    def ld(self, op_a, op_b):
+        address = self.cpu.register[op_b]
+        if not self.permissions[address] & READ:
+            raise self.fault(READ_FAULT, address)
+        self.original[LD](op_a, op_b)
+
+    def st(self, op_a, op_b):
+        address = self.cpu.register[op_a]
+        if not self.permissions[address] & WRITE:
+            raise self.fault(WRITE_FAULT, address)
+        self.original[ST](op_a, op_b)
+
+    def push(self, op_a, op_b=None):
+        self.check_push()
+        self.original[PUSH](op_a, op_b)
+
+    def call(self, op_a, op_b=None):
+        self.check_push()
+        self.original[CALL](op_a, op_b)
+
+    def pop(self, op_a, op_b=None):
+        self.check_pop()
+        return self.original[POP](op_a, op_b)
+
+    def ret(self, op_a=None, op_b=None):
+        self.check_pop()
+        self.original[RET](op_a, op_b)
+
+    def stack_push(self, value):
+        self.check_push()
+        self.next_stack_push(value)
+
+    def stack_pop(self):
+        self.check_pop()
+        return self.next_stack_pop()
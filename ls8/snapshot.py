@@ -0,0 +1,135 @@
+"""Snapshots of the full state of an LS-8 machine.
+
+A snapshot is one bytes object:
+
+    magic         4 bytes   b'LS8S'
+    version       1 byte
+    pc            1 byte
+    fl            1 byte
+    flags         1 byte    see the FLAG_ constants
+    cycles        8 bytes   instructions executed so far
+    deadline      8 bytes   cycle count of the next interrupt check
+    timer_cycles  8 bytes   virtual timer period, 0 for the wall clock timer
+    next_timer    8 bytes   cycle count of the next virtual tick, or seconds
+                            until the next wall clock tick (a double), 0
+                            when it is overdue and -1 when not started
+    registers     8 bytes
+    ram           256 bytes
+    output        4 byte length, then the bytes the output device holds
+    keys          4 byte length, then keys queued for the keyboard
+
+Multi-byte fields are little endian. Being a single buffer, a snapshot is
+cheap to copy, pickle to a process pool or fork many machines from.
+"""
+
+import struct
+import time
+
+from cpu import *
+
+MAGIC = b'LS8S'
+VERSION = 1
+
+HEADER = struct.Struct('<4sBBBBQQQ8s8s256sI')
+LENGTH = struct.Struct('<I')
+
+FLAG_INTERRUPTS_ENABLED = 0b001
+FLAG_HALTED = 0b010
+FLAG_VIRTUAL_TIMER = 0b100
+
+# next_timer of a wall clock timer that hasn't started
+NOT_STARTED = -1.0
+
+
+class SnapshotError(Exception):
+    """Raised for a snapshot that can't be restored."""
+
+
+def take(cpu, keys=b''):
+    '''
+    Return a snapshot of cpu, keys are any key presses still queued by the
+    caller's keyboard device
+    '''
+    flags = 0
+    if cpu.interrupts_enabled:
+        flags |= FLAG_INTERRUPTS_ENABLED
+    if cpu.halted:
+        flags |= FLAG_HALTED
+
+    if cpu.timer_cycles is not None:
+        flags |= FLAG_VIRTUAL_TIMER
+        next_timer = struct.pack('<Q', cpu.next_timer)
+    elif cpu.next_timer is None:
+        next_timer = struct.pack('<d', NOT_STARTED)
+    else:
+        # An overdue tick stays due, without looking like NOT_STARTED
+        remaining = max(cpu.next_timer - time.monotonic(), 0.0)
+        next_timer = struct.pack('<d', remaining)
+
+    pending = getattr(cpu.output, 'pending', None)
+    output = pending() if pending is not None else b''
+
+    return b''.join((
+        HEADER.pack(MAGIC, VERSION, cpu.pc, cpu.fl, flags, cpu.cycles,
+                    cpu.deadline, cpu.timer_cycles or 0, next_timer,
+                    bytes(cpu.register), bytes(cpu.ram), len(output)),
+        output,
+        LENGTH.pack(len(keys)),
+        bytes(keys),
+    ))
+
+
+def restore(cpu, data):
+    '''
+    Put cpu in the state held by a snapshot, returns the queued keys
+    '''
+    view = memoryview(data)
+    if bytes(view[:len(MAGIC)]) != MAGIC:
+        raise SnapshotError('not a snapshot')
+
+    (magic, version, pc, fl, flags, cycles, deadline, timer_cycles,
+     next_timer, registers, ram, output_length) = HEADER.unpack_from(view)
+    if version != VERSION:
+        raise SnapshotError(f'unsupported snapshot version {version}')
+
+    cpu.register[:] = registers
+    cpu.ram[:] = ram
+    cpu.pc = pc
+    cpu.fl = fl
+    cpu.cycles = cycles
+    cpu.deadline = deadline
+    cpu.interrupts_enabled = bool(flags & FLAG_INTERRUPTS_ENABLED)
+    cpu.halted = bool(flags & FLAG_HALTED)
+
+    if flags & FLAG_VIRTUAL_TIMER:
+        cpu.timer_cycles = timer_cycles
+        cpu.next_timer, = struct.unpack('<Q', next_timer)
+    else:
+        cpu.timer_cycles = None
+        remaining, = struct.unpack('<d', next_timer)
+        if remaining == NOT_STARTED:
+            cpu.next_timer = None
+        else:
+            cpu.next_timer = time.monotonic() + max(remaining, 0.0)
+
+    offset = HEADER.size
+    output = view[offset:offset + output_length]
+    offset += output_length
+    if hasattr(cpu.output, 'restore'):
+        cpu.output.restore(output)
+    keys_length, = LENGTH.unpack_from(view, offset)
+    offset += LENGTH.size
+    keys = bytes(view[offset:offset + keys_length])
+
+    # Ram was replaced behind ram_write's back
+    cpu.code_changed()
+    return keys
+
+
+def fork(data, **kwargs):
+    '''
+    Return a new CPU restored from a snapshot, kwargs go to CPU()
+    '''
+    cpu = CPU(**kwargs)
+    restore(cpu, data)
+    return cpu
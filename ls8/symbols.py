@@ -0,0 +1,159 @@
+"""Symbol and line maps, for naming addresses in reports.
+
+The assembler writes a map next to its output when asked to (asm.py -g),
+a JSON object with:
+
+    version   MAP_VERSION
+    size      number of program bytes the map describes
+    crc32     CRC-32 of those bytes, a map that doesn't match the program
+              loaded is ignored
+    symbols   label -> address
+    files     source file names
+    lines     [address, index into files, line number] of every
+              instruction and piece of data, in address order
+
+The map of program.ls8 or program.ls8b is program.map.
+"""
+
+import json
+import os
+import zlib
+
+MAP_VERSION = 1
+MAP_EXTENSION = '.map'
+
+
+class SymbolMap:
+    '''
+    Names addresses by the nearest label at or before them and the source
+    line they were assembled from. Both are looked up in tables of one entry
+    per address, built once.
+    '''
+
+    def __init__(self, symbols=None, lines=None, size=256):
+        # Label -> address
+        self.symbols = dict(symbols or {})
+        # (address, filename, line number) in address order
+        self.lines = list(lines or [])
+
+        # Nearest label at or before each address, the first defined wins
+        # when several share one
+        self.label_at = [None] * size
+        for name, address in self.symbols.items():
+            if 0 <= address < size and self.label_at[address] is None:
+                self.label_at[address] = name
+        self.labels = [None] * size
+        label = None
+        for address in range(size):
+            if self.label_at[address] is not None:
+                label = (self.label_at[address], address)
+            self.labels[address] = label
+
+        # Source line of the statement covering each address
+        self.sources = [None] * size
+        for k, (address, filename, line_num) in enumerate(self.lines):
+            end = self.lines[k + 1][0] if k + 1 < len(self.lines) else size
+            for covered in range(address, min(end, size)):
+                self.sources[covered] = (filename, line_num)
+
+    def label(self, address):
+        '''
+        Return 'LABEL' or 'LABEL+offset' for address, or None before any label
+        '''
+        found = self.labels[address]
+        if found is None:
+            return None
+        name, start = found
+        return name if address == start else f'{name}+{address - start}'
+
+    def source(self, address):
+        '''
+        Return 'file:line' address was assembled from, or None
+        '''
+        found = self.sources[address]
+        if found is None:
+            return None
+        return f'{os.path.basename(found[0])}:{found[1]}'
+
+    def locate(self, address):
+        '''
+        Return 'LABEL+offset (file:line)' for address, as far as it's known,
+        or None
+        '''
+        label = self.label(address)
+        source = self.source(address)
+        if source is None:
+            return label
+        if label is None:
+            return f'({source})'
+        return f'{label} ({source})'
+
+    def describe(self, address):
+        '''
+        Return address in hex followed by where it is, as far as it's known
+        '''
+        where = self.locate(address)
+        if where is None:
+            return f'{address:02X}'
+        return f'{address:02X} {where}'
+
+    def to_dict(self, code):
+        '''
+        Return the map of program bytes code as plain data, see above
+        '''
+        files = []
+        index = {}
+        lines = []
+        for address, filename, line_num in self.lines:
+            if filename not in index:
+                index[filename] = len(files)
+                files.append(filename)
+            lines.append([address, index[filename], line_num])
+        return {
+            'version': MAP_VERSION,
+            'size': len(code),
+            'crc32': zlib.crc32(code),
+            'symbols': self.symbols,
+            'files': files,
+            'lines': lines,
+        }
+
+
+def map_path(filename):
+    '''
+    Return where the map of a program file is kept
+    '''
+    return os.path.splitext(filename)[0] + MAP_EXTENSION
+
+
+def write_map(filename, symbol_map, code):
+    '''
+    Write the map of program bytes code to filename
+    '''
+    with open(filename, 'w') as f:
+        json.dump(symbol_map.to_dict(code), f)
+
+
+def read_map(filename, ram=None):
+    '''
+    Read a map written by write_map, returns a SymbolMap
+
+    Returns None if there is no map, it's from another version or, when ram
+    is given, it describes a different program than the one in ram.
+    '''
+    try:
+        with open(filename) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if data.get('version') != MAP_VERSION:
+        return None
+    if ram is not None:
+        size = data['size']
+        if size > len(ram) or zlib.crc32(ram[:size]) != data['crc32']:
+            return None
+
+    files = data['files']
+    lines = [(address, files[file_index], line_num)
+             for address, file_index, line_num in data['lines']]
+    return SymbolMap(data['symbols'], lines)
@@ -0,0 +1,213 @@
+"""Ring buffer of the last instructions executed, for post-mortems."""
+
+import sys
+
+from cpu import *
+
+# Instructions kept by default
+SIZE = 1024
+
+
+class Tracer:
+    '''
+    Records the PC, instruction bytes, FL and registers after each of the
+    last size instructions into preallocated byte buffers, overwriting the
+    oldest, and dumps them to stream when the CPU halts, faults, overflows
+    its stack or raises an exception.
+
+    Attaching a tracer swaps the CPU's execute hook for a recording version
+    of the interpreter, so a CPU without one pays nothing. The stack counts
+    as overflowed when a PUSH or CALL takes SP below stack_limit, by default
+    the end of the program loaded when tracing starts. Runs that stop on a
+    cycle limit are usually one slice of many (aio.py, the debugger), so
+    they only dump once max_cycles instructions have run in total.
+    '''
+
+    def __init__(self, cpu, size=SIZE, stream=sys.stderr, stack_limit=None,
+                 max_cycles=None):
+        self.cpu = cpu
+        self.size = size
+        self.stream = stream
+        self.stack_limit = stack_limit
+        # Instructions the whole program gets, None for no limit
+        self.max_cycles = max_cycles
+        # One byte per record, registers take eight
+        self.pcs = bytearray(size)
+        self.opcodes = bytearray(size)
+        self.ops_a = bytearray(size)
+        self.ops_b = bytearray(size)
+        self.fls = bytearray(size)
+        self.registers = bytearray(size * 8)
+        # Index the next record goes to
+        self.next = 0
+        # Records written over the life of the tracer
+        self.recorded = 0
+        # Set while SP is below the stack limit, so an overflow dumps once
+        self.overflowed = False
+        # Exception last dumped as it was raised, so finish() doesn't dump
+        # the same fault again
+        self.failed = None
+        cpu.execute = self.execute
+        cpu.on_stop.append(self.finish)
+
+    def execute(self, n):
+        '''
+        Execute up to n instructions like CPU.interpret, recording each one
+        '''
+        cpu = self.cpu
+        ram = cpu.ram
+        reg = cpu.register
+        decoded = cpu.decoded
+        pcs = self.pcs
+        opcodes = self.opcodes
+        ops_a = self.ops_a
+        ops_b = self.ops_b
+        fls = self.fls
+        registers = self.registers
+        size = self.size
+        i = self.next
+        if self.stack_limit is None:
+            self.stack_limit = program_end(ram, reg[SP])
+        stack_limit = self.stack_limit
+        recorded = self.recorded
+        count = 0
+
+        try:
+            while count < n:
+                pc = cpu.pc
+                entry = decoded[pc]
+                if entry is None:
+                    entry = cpu.decode(pc)
+                if entry[5] > 1:
+                    # Record each instruction of a fused entry on its own
+                    entry = cpu.decode_one(pc)
+                handler, op_a, op_b, run_counter, set_pc, instructions = entry
+                ir = ram[pc]
+
+                try:
+                    handler(op_a, op_b)
+                except Break:
+                    break
+                except Stop:
+                    stopped = True
+                else:
+                    stopped = False
+                    if not set_pc:
+                        cpu.pc = (pc + run_counter) & 0xFF
+
+                pcs[i] = pc
+                opcodes[i] = ir
+                ops_a[i] = ram[(pc + 1) & 0xFF]
+                ops_b[i] = ram[(pc + 2) & 0xFF]
+                fls[i] = cpu.fl
+                registers[i * 8:i * 8 + 8] = reg
+                i += 1
+                if i == size:
+                    i = 0
+                count += 1
+
+                if (ir == PUSH or ir == CALL) and reg[SP] < stack_limit:
+                    if not self.overflowed:
+                        self.overflowed = True
+                        self.next = i
+                        self.recorded = recorded + count
+                        self.dump(f'stack overflow, SP={reg[SP]:02X}')
+                elif self.overflowed and reg[SP] >= stack_limit:
+                    self.overflowed = False
+
+                if stopped:
+                    break
+        except Exception as e:
+            # Record what the failing instruction left behind, then dump
+            pcs[i] = pc
+            opcodes[i] = ram[pc]
+            ops_a[i] = ram[(pc + 1) & 0xFF]
+            ops_b[i] = ram[(pc + 2) & 0xFF]
+            fls[i] = cpu.fl
+            registers[i * 8:i * 8 + 8] = reg
+            self.next = (i + 1) % size
+            self.recorded = recorded + count + 1
+            if isinstance(e, Fault):
+                e.executed = count
+            self.failed = e
+            self.dump(f'{type(e).__name__}: {e}')
+            raise
+
+        self.next = i
+        self.recorded = recorded + count
+        return count
+
+    def finish(self, result):
+        '''
+        Dump the trace when the CPU halts, faults or runs out of its total
+        budget
+        '''
+        if result.reason == CYCLE_LIMIT:
+            total = self.max_cycles
+            if total is None or not (
+                    self.recorded - result.cycles < total <= self.recorded):
+                # Just the end of a slice, not the one using up the budget
+                return
+        elif result.reason not in (HALTED, FAULT):
+            return
+        if result.fault is not None and result.fault is self.failed:
+            # Already dumped when it was raised
+            return
+        self.dump(result.reason)
+
+    def records(self):
+        '''
+        Return the recorded instructions, oldest first, as
+        (pc, opcode, op_a, op_b, fl, registers) tuples
+        '''
+        count = min(self.recorded, self.size)
+        start = (self.next - count) % self.size
+        records = []
+        for k in range(count):
+            i = (start + k) % self.size
+            records.append((self.pcs[i], self.opcodes[i], self.ops_a[i],
+                            self.ops_b[i], self.fls[i],
+                            bytes(self.registers[i * 8:i * 8 + 8])))
+        return records
+
+    def report(self, reason):
+        '''
+        Return the trace as text, each instruction with the registers and
+        FL it changed, and where it is in the source when a symbol map is
+        loaded
+        '''
+        records = self.records()
+        symbol_map = self.cpu.symbol_map
+        lines = [f'Last {len(records)} of {self.recorded} instructions ({reason}):',
+                 '  pc  instruction      changes']
+        previous = None
+        for pc, ir, op_a, op_b, fl, registers in records:
+            name = OPCODE_NAMES.get(ir, f'{ir:02X}')
+            operands = [op_a, op_b][:ir >> 6]
+            instruction = ' '.join([f'{name:<4}'] + [f'{op:02X}' for op in operands])
+            if previous is None:
+                # Nothing to compare the oldest record with
+                changes = ' '.join(f'R{r}={value:02X}'
+                                   for r, value in enumerate(registers))
+                changes += f' FL={fl:03b}'
+            else:
+                old_registers, old_fl = previous
+                changes = ' '.join(
+                    f'R{r} {old:02X}->{new:02X}'
+                    for r, (old, new) in enumerate(zip(old_registers, registers))
+                    if old != new)
+                if fl != old_fl:
+                    changes += f' FL {old_fl:03b}->{fl:03b}'
+            line = f'  {pc:02X}  {instruction:<16} {changes.strip()}'.rstrip()
+            where = symbol_map.locate(pc)
+            if where is not None:
+                line += f'  ; {where}'
+            lines.append(line)
+            previous = (registers, fl)
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, reason):
+        if self.stream is not None:
+            self.stream.write(self.report(reason))
+            self.stream.flush()
+